@@ -0,0 +1,23 @@
+"""
+Admin API handlers added to the hub through c.JupyterHub.extra_handlers.
+"""
+
+from jupyterhub.apihandlers import APIHandler
+from jupyterhub.scopes import needs_scope
+
+from jupyterhub.spawner_hooks import tas_cache
+
+
+class TasCacheAPIHandler(APIHandler):
+    """Drop a user's cached TAS identity record so the next spawn reloads it"""
+
+    @needs_scope("admin:users")
+    def delete(self, user_name):
+        tas_cache.invalidate(user_name)
+        self.log.info("Invalidated cached TAS record for %s", user_name)
+        self.set_status(204)
+
+
+default_handlers = [
+    (r"/api/tas-cache/users/([^/]+)", TasCacheAPIHandler),
+]
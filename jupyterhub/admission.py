@@ -0,0 +1,137 @@
+"""
+Spawn admission control: FIFO queues with a cap on in-flight work.
+
+When many users start servers at once, every spawn hook hits TAS, LDAP, the
+Tapis meta and projects APIs and the Kubernetes API at the same moment, and
+the slow ones time out. The ``spawn`` queue caps how many spawn hooks run at
+once, and one queue per upstream caps the calls in flight to it. Waiters are
+admitted strictly in arrival order, so a burst is worked off first come,
+first served instead of everyone retrying at once. The spawner reports its
+place in the queue through the spawn progress events, and queue depths are
+exported for the autoscaler.
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from jupyterhub.jhub_metrics import (
+    ADMISSION_IN_FLIGHT,
+    ADMISSION_QUEUE_DEPTH,
+    ADMISSION_WAIT,
+    TENANT_LABELS,
+)
+
+SPAWN_QUEUE = "spawn"
+
+
+def parse_limits(limits):
+    """Parse "name=limit,name=limit" into a dict"""
+    parsed = {}
+    for item in limits.split(","):
+        if item.strip():
+            name, limit = item.split("=", 1)
+            parsed[name.strip()] = int(limit)
+    return parsed
+
+
+class FairQueue:
+    """Admit at most ``limit`` holders at once, queueing the rest in FIFO order.
+
+    A released slot is handed straight to the oldest waiter, so later
+    arrivals cannot overtake the queue.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters = deque()
+
+    @property
+    def depth(self):
+        return len(self._waiters)
+
+    def position(self, owner):
+        """1-based place of owner in the queue, or None if it is not waiting"""
+        for i, (waiting, _) in enumerate(self._waiters):
+            if waiting is owner:
+                return i + 1
+        return None
+
+    async def acquire(self, owner):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            self._report()
+            return
+        waiter = (owner, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._report()
+        start = time.perf_counter()
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._report()
+            elif waiter[1].done() and not waiter[1].cancelled():
+                # admitted just as the wait was cancelled
+                self.release()
+            raise
+        ADMISSION_WAIT.labels(**TENANT_LABELS, queue=self.name).observe(
+            time.perf_counter() - start
+        )
+
+    def release(self):
+        while self._waiters:
+            _, future = self._waiters.popleft()
+            if not future.done():
+                # the slot passes to the waiter, in_flight stays the same
+                future.set_result(None)
+                self._report()
+                return
+        self.in_flight -= 1
+        self._report()
+
+    @asynccontextmanager
+    async def slot(self, owner):
+        await self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _report(self):
+        ADMISSION_QUEUE_DEPTH.labels(**TENANT_LABELS, queue=self.name).set(self.depth)
+        ADMISSION_IN_FLIGHT.labels(**TENANT_LABELS, queue=self.name).set(self.in_flight)
+
+
+class AdmissionController:
+    """The spawn queue plus one queue per capped upstream"""
+
+    def __init__(self, spawn_limit, upstream_limits=None):
+        self.queues = {}
+        if spawn_limit:
+            self.queues[SPAWN_QUEUE] = FairQueue(SPAWN_QUEUE, spawn_limit)
+        for name, limit in (upstream_limits or {}).items():
+            if limit:
+                self.queues[name] = FairQueue(name, limit)
+
+    @asynccontextmanager
+    async def slot(self, name, owner):
+        """Hold a slot in the named queue; names without a cap are not queued"""
+        queue = self.queues.get(name)
+        if queue is None:
+            yield
+            return
+        async with queue.slot(owner):
+            yield
+
+    def waiting(self, owner):
+        """The queue owner is waiting in and its place there, or (None, None)"""
+        for name, queue in self.queues.items():
+            position = queue.position(owner)
+            if position is not None:
+                return name, position
+        return None, None
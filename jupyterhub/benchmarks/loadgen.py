@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+"""HTTP load generator for login and spawn against a running hub.
+
+Each virtual user does what a browser does, over plain HTTP with its own
+cookie jar:
+
+1. login: GET /hub/oauth_login, follow the redirects to the Tapis login
+   form, submit the username and password, approve the client if asked,
+   and follow the callback back to the hub
+2. options_form: GET /hub/spawn
+3. spawn_submit: POST the options form, picking the --image_index-th image
+4. spawn_ready: stream /hub/api/users/<name>/server/progress until the
+   server is ready or failed (or --spawn_timeout passes)
+
+Users are started evenly over --ramp_up seconds and every step is timed.
+At the end the tool prints latency percentiles and error counts per step,
+and reads pod status, events and logs from Kubernetes for the users whose
+spawn failed (with --diagnostics)::
+
+    cd /srv/jupyterhub
+    python -m benchmarks.loadgen --hub_url=https://designsafe.jupyterhub.staging.tacc.cloud \\
+        --users_file=users.csv --ramp_up=60 --max_clients=2000
+
+users.csv holds one "username,password" per line; alternatively
+--user_prefix=test --user_count=200 --password=... generates test1..test200.
+"""
+
+import asyncio
+import csv
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from html.parser import HTMLParser
+from http.cookies import SimpleCookie
+from urllib.parse import quote, urlencode, urljoin, urlparse
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.options import define, options, parse_command_line
+
+from benchmarks.stats import percentile
+
+STEPS = ("login", "options_form", "spawn_submit", "spawn_ready")
+# a login needs a handful of redirects and forms; more means we are going in circles
+MAX_HOPS = 15
+
+
+class StepError(Exception):
+    def __init__(self, kind, detail=""):
+        super().__init__("{} {}".format(kind, detail).strip())
+        self.kind = kind
+
+
+class FormParser(HTMLParser):
+    """Collect the forms on a page with their inputs and select options"""
+
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self._select = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self.forms.append(
+                {
+                    "action": attrs.get("action", ""),
+                    "method": attrs.get("method", "get").lower(),
+                    "inputs": [],
+                    "selects": {},
+                }
+            )
+        elif not self.forms:
+            return
+        elif tag in ("input", "button"):
+            self.forms[-1]["inputs"].append(attrs)
+        elif tag == "select":
+            self._select = attrs.get("name")
+            self.forms[-1]["selects"][self._select] = []
+        elif tag == "option" and self._select is not None:
+            self.forms[-1]["selects"][self._select].append(attrs.get("value", ""))
+
+    def handle_endtag(self, tag):
+        if tag == "select":
+            self._select = None
+
+
+def parse_forms(html):
+    parser = FormParser()
+    parser.feed(html)
+    return parser.forms
+
+
+class VirtualUser:
+    """One browser-like session with its own cookies"""
+
+    def __init__(self, hub_url, username, password, client, request_timeout):
+        self.hub_url = hub_url.rstrip("/")
+        self.username = username
+        self.password = password
+        self.client = client
+        self.request_timeout = request_timeout
+        self.cookies = {}
+
+    async def fetch(self, url, method="GET", body=None, headers=None, **kwargs):
+        """Fetch without following redirects, keeping cookies per host"""
+        host = urlparse(url).netloc
+        jar = self.cookies.setdefault(host, {})
+        headers = dict(headers or {})
+        if jar:
+            headers["Cookie"] = "; ".join("{}={}".format(k, v) for k, v in jar.items())
+        req = HTTPRequest(
+            url,
+            method=method,
+            body=body,
+            headers=headers,
+            follow_redirects=False,
+            request_timeout=kwargs.pop("request_timeout", self.request_timeout),
+            **kwargs,
+        )
+        try:
+            resp = await self.client.fetch(req, raise_error=False)
+        except Exception as e:
+            raise StepError("connection", str(e))
+        for header in resp.headers.get_list("Set-Cookie"):
+            cookie = SimpleCookie()
+            cookie.load(header)
+            for name, morsel in cookie.items():
+                jar[name] = morsel.value
+        if resp.code == 599:
+            raise StepError("timeout" if "Timeout" in str(resp.error) else "connection", str(resp.error))
+        return resp
+
+    async def browse(self, url, method="GET", body=None, stop_at=None):
+        """Follow redirects and login/consent forms until back on the hub.
+
+        With stop_at, stop as soon as a URL whose path contains it has been fetched.
+        """
+        for _ in range(MAX_HOPS):
+            resp = await self.fetch(url, method=method, body=body)
+            if stop_at and stop_at in urlparse(url).path:
+                if resp.code >= 400:
+                    raise StepError("http_{}".format(resp.code), url)
+                return url, resp
+            if resp.code in (301, 302, 303, 307):
+                url = urljoin(url, resp.headers["Location"])
+                method, body = "GET", None
+                continue
+            if resp.code >= 400:
+                raise StepError("http_{}".format(resp.code), url)
+            if url.startswith(self.hub_url):
+                return url, resp
+            form = self._next_form(resp.body.decode("utf8", "replace"))
+            if form is None:
+                raise StepError("no_form", url)
+            url, method, body = form_submission(url, form, self._login_fields(form))
+        raise StepError("too_many_hops", url)
+
+    def _next_form(self, html):
+        forms = parse_forms(html)
+        for form in forms:
+            if any(i.get("type") == "password" for i in form["inputs"]):
+                return form
+        # consent page: approve the client
+        return forms[0] if forms else None
+
+    def _login_fields(self, form):
+        fields = {}
+        for i in form["inputs"]:
+            if i.get("type") == "password":
+                fields[i["name"]] = self.password
+            elif i.get("type") in (None, "text", "email") and i.get("name"):
+                fields[i["name"]] = self.username
+        return fields
+
+    async def login(self):
+        # the callback redirects on to /hub/spawn, which belongs to the next step
+        url, resp = await self.browse(
+            self.hub_url + "/hub/oauth_login", stop_at="/hub/oauth_callback"
+        )
+        if "/hub/login" in resp.headers.get("Location", ""):
+            raise StepError("login_rejected", url)
+
+    async def options_form(self):
+        url, resp = await self.browse(self.hub_url + "/hub/spawn")
+        return url, resp.body.decode("utf8", "replace")
+
+    async def spawn_submit(self, url, html, image_index):
+        forms = [f for f in parse_forms(html) if "image" in f["selects"]]
+        if not forms:
+            # single image tenants skip the form and spawn straight away
+            return url, html
+        images = forms[0]["selects"]["image"]
+        fields = {"image": images[min(image_index, len(images) - 1)]}
+        url, method, body = form_submission(url, forms[0], fields)
+        url, resp = await self.browse(url, method=method, body=body)
+        return url, resp.body.decode("utf8", "replace")
+
+    async def spawn_ready(self, spawn_timeout):
+        """Stream spawn progress events until ready or failed"""
+        url = "{}/hub/api/users/{}/server/progress".format(
+            self.hub_url, quote(self.username, safe="")
+        )
+        xsrf = self.cookies.get(urlparse(url).netloc, {}).get("_xsrf")
+        if xsrf:
+            url += "?" + urlencode({"_xsrf": xsrf})
+        events = []
+        buffer = b""
+
+        def on_chunk(chunk):
+            nonlocal buffer
+            buffer += chunk
+            while b"\n\n" in buffer:
+                raw, buffer = buffer.split(b"\n\n", 1)
+                for line in raw.decode("utf8", "replace").splitlines():
+                    if line.startswith("data:"):
+                        events.append(json.loads(line[5:]))
+
+        # JupyterHub checks the Referer of cookie-authenticated API requests,
+        # as it does for the browser on the spawn-pending page
+        referer = "{}/hub/spawn-pending/{}".format(self.hub_url, quote(self.username, safe=""))
+        resp = await self.fetch(
+            url,
+            headers={"Accept": "text/event-stream", "Referer": referer},
+            streaming_callback=on_chunk,
+            request_timeout=spawn_timeout,
+        )
+        if resp.code >= 400:
+            raise StepError("http_{}".format(resp.code), url)
+        if any(e.get("failed") for e in events):
+            raise StepError("spawn_failed", (events[-1] or {}).get("message", ""))
+        if not any(e.get("ready") for e in events):
+            raise StepError("not_ready", (events[-1] if events else {}).get("message", ""))
+
+
+def form_submission(page_url, form, fields):
+    """URL, method and body to submit a form, keeping its hidden inputs"""
+    data = {
+        i["name"]: i.get("value", "")
+        for i in form["inputs"]
+        if i.get("name") and i.get("type") in ("hidden", "submit")
+    }
+    data.update(fields)
+    url = urljoin(page_url, form["action"] or page_url)
+    if form["method"] == "post":
+        return url, "POST", urlencode(data)
+    return url + ("&" if "?" in url else "?") + urlencode(data), "GET", None
+
+
+async def run_user(vu, results):
+    """Run one user's login and spawn, recording each step"""
+    step = None
+    try:
+        step = "login"
+        start = time.perf_counter()
+        await vu.login()
+        results.record(step, time.perf_counter() - start)
+
+        step = "options_form"
+        start = time.perf_counter()
+        url, html = await vu.options_form()
+        results.record(step, time.perf_counter() - start)
+
+        step = "spawn_submit"
+        start = time.perf_counter()
+        await vu.spawn_submit(url, html, options.image_index)
+        results.record(step, time.perf_counter() - start)
+
+        step = "spawn_ready"
+        start = time.perf_counter()
+        await vu.spawn_ready(options.spawn_timeout)
+        results.record(step, time.perf_counter() - start)
+    except StepError as e:
+        results.fail(vu.username, step, e)
+    except Exception as e:
+        results.fail(vu.username, step, StepError("error", repr(e)))
+
+
+class Results:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.failed = {}
+
+    def record(self, step, seconds):
+        self.timings[step].append(seconds)
+
+    def fail(self, username, step, error):
+        self.errors[step][error.kind] += 1
+        self.failed[username] = (step, str(error))
+
+    def report(self, users, elapsed):
+        print(
+            "{} users in {:.1f}s, {} failed".format(len(users), elapsed, len(self.failed))
+        )
+        for step in STEPS:
+            values = self.timings.get(step, [])
+            attempts = len(values) + sum(self.errors[step].values())
+            print(
+                "  {:<13} n={:<6} err={:>5.1%} p50={:>7.2f}s p95={:>7.2f}s p99={:>7.2f}s max={:>7.2f}s {}".format(
+                    step,
+                    attempts,
+                    sum(self.errors[step].values()) / attempts if attempts else 0,
+                    percentile(values, 50),
+                    percentile(values, 95),
+                    percentile(values, 99),
+                    max(values) if values else float("nan"),
+                    dict(self.errors[step]) or "",
+                )
+            )
+
+
+def load_users():
+    if options.users_file:
+        with open(options.users_file) as f:
+            return [(row[0].strip(), row[1].strip()) for row in csv.reader(f) if row]
+    return [
+        ("{}{}".format(options.user_prefix, i), options.password)
+        for i in range(1, options.user_count + 1)
+    ]
+
+
+async def diagnose(failed):
+    """Print pod status, events and logs for users whose spawn failed"""
+    from jupyterhub.cull_policy import SINGLEUSER_SELECTOR, USERNAME_ANNOTATION
+    from jupyterhub.kube_client import get_core_api, get_namespace
+
+    spawn_failures = {
+        name: error for name, error in failed.items() if error[0] in ("spawn_submit", "spawn_ready")
+    }
+    if not spawn_failures:
+        return
+    loop = asyncio.get_running_loop()
+    api = get_core_api()
+    namespace = get_namespace()
+    pods = await loop.run_in_executor(
+        None, lambda: api.list_namespaced_pod(namespace, label_selector=SINGLEUSER_SELECTOR)
+    )
+    by_user = {
+        (p.metadata.annotations or {}).get(USERNAME_ANNOTATION): p for p in pods.items
+    }
+    for name, (step, error) in sorted(spawn_failures.items())[: options.diagnostics_limit]:
+        print("=== {} failed at {}: {}".format(name, step, error))
+        pod = by_user.get(name)
+        if pod is None:
+            print("  no pod found")
+            continue
+        print("  pod {} phase={}".format(pod.metadata.name, pod.status.phase))
+        for condition in pod.status.conditions or []:
+            print("  condition {}={} {}".format(condition.type, condition.status, condition.message or ""))
+        events = await loop.run_in_executor(
+            None,
+            lambda: api.list_namespaced_event(
+                namespace, field_selector="involvedObject.name={}".format(pod.metadata.name)
+            ),
+        )
+        for event in events.items:
+            print("  event {} {}: {}".format(event.type, event.reason, event.message))
+        try:
+            logs = await loop.run_in_executor(
+                None,
+                lambda: api.read_namespaced_pod_log(
+                    pod.metadata.name, namespace, tail_lines=options.log_lines
+                ),
+            )
+            print("  log:\n    " + "\n    ".join(logs.splitlines()))
+        except Exception as e:
+            print("  no log: {}".format(e))
+
+
+async def main():
+    AsyncHTTPClient.configure(None, max_clients=options.max_clients)
+    client = AsyncHTTPClient()
+    users = load_users()
+    results = Results()
+    interval = options.ramp_up / len(users) if users else 0
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    async def start_user(i, username, password):
+        await asyncio.sleep(max(start + i * interval - loop.time(), 0))
+        vu = VirtualUser(options.hub_url, username, password, client, options.request_timeout)
+        await run_user(vu, results)
+
+    await asyncio.gather(
+        *(start_user(i, username, password) for i, (username, password) in enumerate(users))
+    )
+    results.report(users, loop.time() - start)
+    if options.diagnostics:
+        await diagnose(results.failed)
+
+
+if __name__ == "__main__":
+    define("hub_url", default=os.environ.get("HUB_URL", "http://127.0.0.1:8000"), help="The hub's public URL")
+    define("users_file", default="", help="CSV file of username,password lines")
+    define("user_prefix", default="test", help="Prefix of generated usernames")
+    define("user_count", default=10, help="Number of generated users")
+    define("password", default=os.environ.get("LOADGEN_PASSWORD", ""), help="Password of generated users")
+    define("ramp_up", default=0.0, help="Seconds over which the users are started")
+    define("max_clients", default=1000, help="Concurrent HTTP connections")
+    define("request_timeout", default=60.0, help="Timeout (in seconds) for each page request")
+    define("spawn_timeout", default=300.0, help="Timeout (in seconds) to wait for a spawn to be ready")
+    define("image_index", default=0, help="Which image in the options form to pick")
+    define("diagnostics", default=True, help="Read pod status, events and logs for failed spawns")
+    define("diagnostics_limit", default=20, help="Most failed users to print diagnostics for")
+    define("log_lines", default=50, help="Pod log lines printed per failed spawn")
+    parse_command_line()
+    asyncio.run(main())
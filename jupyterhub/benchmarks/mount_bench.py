@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Per-spawn cost of building a user's volume mounts, over many spawns.
+
+Builds a tenant config with --tenant_mounts volume mounts and
+--group_configs group configs with --group_mounts mounts each (half of them
+repeating tenant mounts), then builds the mounts for --spawns spawns the way
+``get_volume_mounts`` does: look up the mount plan for the config versions
+and render it for the user. The mean and p95 time per spawn are printed for
+every --window spawns; a flat series means the per-spawn cost does not grow
+as the hub keeps running. The same spawns are then timed compiling the plan
+on every spawn, for comparison::
+
+    cd /srv/jupyterhub
+    python -m benchmarks.mount_bench --spawns=20000 --tenant_mounts=20 --group_mounts=10
+
+Runs without the hub environment or any upstreams.
+"""
+
+import time
+
+from tornado.options import define, options, parse_command_line
+
+from benchmarks.stats import percentile
+from jupyterhub.config_model import get_tenant_model, get_user_models
+from jupyterhub.mount_plan import MountPlan, get_mount_plan
+
+
+def tenant_config(mounts):
+    return {
+        "volume_mounts": [
+            {
+                "type": "nfs" if i % 2 else "hostPath",
+                "server": "nfs{}.bench.local".format(i),
+                # every third path is static, the rest are templated
+                "path": "/gpfs/tenant{}/{{username}}".format(i)
+                if i % 3
+                else "/static/tenant{}".format(i),
+                "mountPath": "/home/jupyter/tenant{}/".format(i),
+                "readOnly": "True" if i % 2 else "False",
+            }
+            for i in range(mounts)
+        ]
+    }
+
+
+def group_config(group, mounts, tenant):
+    shared = tenant["volume_mounts"][: mounts // 2]
+    own = [
+        {
+            "type": "hostPath",
+            "path": "/work/group{}/{}/{{tas_homedir}}".format(group, i),
+            "mountPath": "/home/jupyter/group{}-{}".format(group, i),
+            "readOnly": "False",
+        }
+        for i in range(mounts - len(shared))
+    ]
+    return {
+        "name": "group{}.group.config.bench.local.jhub".format(group),
+        "value": {"volume_mounts": shared + own},
+    }
+
+
+def build_mounts(tenant, tenant_version, user_configs, user_version, username, compile_each):
+    tenant_model = get_tenant_model(tenant, tenant_version)
+    user_models = get_user_models(user_configs, user_version)
+    if compile_each:
+        plan = MountPlan(tenant_model, user_models)
+    else:
+        plan = get_mount_plan(tenant_model, tenant_version, user_models, user_version)
+    return plan.render(
+        {"username": username, "tenant_id": "bench", "tas_homedir": "0/" + username},
+        init_gid=800000,
+    )
+
+
+def run(tenant, groups, compile_each):
+    timings = []
+    for i in range(options.spawns):
+        group = i % len(groups)
+        start = time.perf_counter()
+        volumes, volume_mounts = build_mounts(
+            tenant, "tenant-1", [groups[group]], "group-{}".format(group),
+            "benchuser{:05d}".format(i), compile_each,
+        )
+        timings.append(time.perf_counter() - start)
+    print(
+        "{} ({} volumes per spawn)".format(
+            "plan compiled on every spawn" if compile_each else "plan per config version",
+            len(volumes),
+        )
+    )
+    for start in range(0, len(timings), options.window):
+        window = timings[start : start + options.window]
+        print(
+            "  spawns {:>6}-{:<6} mean={:>8.1f}us p95={:>8.1f}us".format(
+                start,
+                start + len(window) - 1,
+                sum(window) / len(window) * 1e6,
+                percentile(window, 95) * 1e6,
+            )
+        )
+
+
+def main():
+    tenant = tenant_config(options.tenant_mounts)
+    groups = [group_config(g, options.group_mounts, tenant) for g in range(options.group_configs)]
+    run(tenant, groups, compile_each=False)
+    run(tenant, groups, compile_each=True)
+    print(
+        "tenant config still lists {} volume mounts".format(len(tenant["volume_mounts"]))
+    )
+
+
+if __name__ == "__main__":
+    define("spawns", default=10000, help="Spawns to build mounts for")
+    define("window", default=1000, help="Spawns per reported window")
+    define("tenant_mounts", default=20, help="Volume mounts in the tenant config")
+    define("group_configs", default=10, help="Distinct group configs the users are spread over")
+    define("group_mounts", default=10, help="Volume mounts in each group config")
+    parse_command_line()
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Offline login and spawn benchmark against stubbed upstreams.
+
+Runs ``TapisOAuthenticator.authenticate``, ``get_notebook_options`` and the
+spawn ``hook`` for --users users, --concurrency at a time, with every upstream
+replaced by the local stand-ins in stubs.py. Each round reports throughput
+and per-step latency percentiles, plus how many requests each upstream got.
+The first round runs with cold caches, later ones show the warm path. Each
+user keeps one spawner across rounds, as the hub does, so later rounds also
+reuse the spawn profile from the user's previous spawn::
+
+    cd /srv/jupyterhub
+    python -m benchmarks.spawn_bench --users=200 --concurrency=50 --rounds=2 \\
+        --tas_latency=0.3 --ldap_latency=0.1 --projects_latency=0.5
+
+Needs the hub image (or its dependencies); no production access is used.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import tempfile
+import time
+from collections import defaultdict
+
+from tornado.options import define, options, parse_command_line
+
+from benchmarks.stats import percentile
+from benchmarks.stubs import NAMESPACE, UPSTREAMS, StubLDAPPool, UpstreamStubs
+
+STEPS = ("authenticate", "options_form", "hook")
+
+
+class BenchUser:
+    def __init__(self, name):
+        self.name = name
+
+
+class BenchSpawner:
+    """The spawner attributes the hook and options form read and write"""
+
+    def __init__(self, username, log):
+        self.user = BenchUser(username)
+        self.log = log
+        self.user_options = {}
+        self.image = None
+        self.notebook_dir = None
+        self.extra_pod_config = {}
+        self.extra_container_config = {}
+        self.mem_limit = None
+        self.cpu_limit = None
+        self.mem_guarantee = None
+        self.cpu_guarantee = None
+        self.extra_labels = {}
+        self.cmd = ["jupyterhub-singleuser"]
+        self.volumes = []
+        self.volume_mounts = []
+        self.init_containers = []
+        self.environment = {}
+
+
+class BenchHandler:
+    """The one request method authenticate uses"""
+
+    def __init__(self, code):
+        self.code = code
+
+    def get_argument(self, name, default=None):
+        return self.code if name == "code" else default
+
+
+def choose_options(form):
+    """Pick the first image in the rendered options form, as a browser would"""
+    if not form:
+        return {}
+    match = re.search(r"<option value='([^']*)'", form)
+    return {"image": [match.group(1)]} if match else {}
+
+
+async def run_session(spawner, authenticator, get_notebook_options, hook, log, timings, errors):
+    username = spawner.user.name
+    step = None
+    try:
+        step = "authenticate"
+        start = time.perf_counter()
+        await authenticator.authenticate(BenchHandler(username), None)
+        timings[step].append(time.perf_counter() - start)
+
+        step = "options_form"
+        start = time.perf_counter()
+        form = await get_notebook_options(spawner)
+        timings[step].append(time.perf_counter() - start)
+
+        step = "hook"
+        spawner.user_options = choose_options(form)
+        start = time.perf_counter()
+        await hook(spawner)
+        timings[step].append(time.perf_counter() - start)
+    except Exception as e:
+        errors[step] += 1
+        log.error("%s failed at %s: %r", username, step, e)
+        return False
+    return True
+
+
+async def run_round(spawners, concurrency, authenticator, get_notebook_options, hook, log):
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def session(spawner):
+        async with slots:
+            return await run_session(
+                spawner, authenticator, get_notebook_options, hook, log, timings, errors
+            )
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(session(s) for s in spawners))
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(results), timings, errors
+
+
+def report(round_number, elapsed, completed, timings, errors, requests):
+    print(
+        "round {}: {} sessions in {:.2f}s, {:.1f} sessions/s".format(
+            round_number, completed, elapsed, completed / elapsed if elapsed else 0
+        )
+    )
+    for step in STEPS:
+        values = timings.get(step, [])
+        print(
+            "  {:<13} n={:<5} err={:<4} p50={:>7.3f}s p95={:>7.3f}s p99={:>7.3f}s max={:>7.3f}s".format(
+                step,
+                len(values),
+                errors.get(step, 0),
+                percentile(values, 50),
+                percentile(values, 95),
+                percentile(values, 99),
+                max(values) if values else float("nan"),
+            )
+        )
+    print(
+        "  upstream requests: "
+        + " ".join("{}={}".format(u, requests.get(u, 0)) for u in UPSTREAMS)
+    )
+
+
+async def main():
+    stubs = UpstreamStubs(
+        latency={u: getattr(options, "{}_latency".format(u)) for u in UPSTREAMS},
+        jitter=options.jitter,
+    )
+    stubs.start()
+    workdir = tempfile.mkdtemp(prefix="jhub-bench-")
+    os.environ.update(
+        stubs.environment(
+            os.path.join(workdir, "tokens"), os.path.join(workdir, "tas_cache.sqlite")
+        )
+    )
+
+    # the hub modules read their configuration from the env at import time
+    from jupyterhub import kube_client, spawner_hooks
+    from oauthenticator.tapis import TapisOAuthenticator
+
+    kube_client.set_api_client(stubs.kubernetes_client(), namespace=NAMESPACE)
+    spawner_hooks.ldap_pool = StubLDAPPool(stubs, size=spawner_hooks.LDAP_POOL_SIZE)
+
+    log = logging.getLogger("spawn_bench")
+    authenticator = TapisOAuthenticator()
+    spawners = [BenchSpawner("benchuser{:05d}".format(i), log) for i in range(options.users)]
+    for round_number in range(1, options.rounds + 1):
+        stubs.requests.clear()
+        elapsed, completed, timings, errors = await run_round(
+            spawners,
+            options.concurrency,
+            authenticator,
+            spawner_hooks.get_notebook_options,
+            spawner_hooks.hook,
+            log,
+        )
+        report(round_number, elapsed, completed, timings, errors, dict(stubs.requests))
+    stubs.stop()
+
+
+if __name__ == "__main__":
+    define("users", default=100, help="Number of distinct users per round")
+    define("concurrency", default=100, help="Sessions in flight at once")
+    define("rounds", default=2, help="Rounds to run; the first one starts with cold caches")
+    define("jitter", default=0.0, help="Random latency spread, as a fraction of each latency")
+    for upstream in UPSTREAMS:
+        define(
+            "{}_latency".format(upstream),
+            default=0.05,
+            help="Seconds each {} request takes".format(upstream),
+        )
+    # the hub code logs every step at info level
+    options.logging = "warning"
+    parse_command_line()
+    asyncio.run(main())
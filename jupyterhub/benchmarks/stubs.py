@@ -0,0 +1,347 @@
+"""
+Local stand-ins for the upstreams the hub talks to, with configurable latency.
+
+One tornado app on a local port serves the Tapis meta API, Tapis OAuth
+/oauth2/tokens, TAS, the v3 to v2 token exchange, the v2 projects listing and
+the configmap part of the Kubernetes API. It runs on its own thread and event
+loop, so the hub code under test sees it as a remote service. LDAP is stubbed
+at the connection pool, since the hub only ever calls ``ldap_pool.search``.
+"""
+
+import asyncio
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+import jwt
+from tornado import web
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+UPSTREAMS = ("meta", "oauth", "tas", "ldap", "v2_token", "projects", "k8s")
+
+TENANT = "bench"
+INSTANCE = "local"
+NAMESPACE = "bench"
+DATABASE = "bench-db"
+COLLECTION = "bench-collection"
+UID_BASE = 800000
+# HS256 keys shorter than 32 bytes make pyjwt warn on every token
+JWT_KEY = "bench-jwt-signing-key-not-a-secret"
+GID = 800000
+
+
+def tenant_config(url):
+    """A tenant config document shaped like the production ones"""
+    return {
+        "tenant": TENANT,
+        "instance": INSTANCE,
+        "config_type": "tenant",
+        "images": [
+            {
+                "name": "taccsciapps/jupyteruser-base:1.0",
+                "display_name": "Base",
+                "extra_pod_config": {"nodeSelector": {"jupyter": "true"}},
+            },
+            {
+                "name": "taccsciapps/jupyteruser-ds:1.2",
+                "display_name": "Data Science",
+                "description": "Python and R data science stack",
+                "notebook_dir": "/home/jupyter",
+            },
+        ],
+        "volume_mounts": [
+            {
+                "type": "hostPath",
+                "path": "/work/{tas_homedir}",
+                "mountPath": "/home/jupyter/work",
+                "readOnly": "False",
+            },
+            {
+                "type": "nfs",
+                "server": "nfs.bench.local",
+                "path": "/gpfs/bench/{username}",
+                "mountPath": "/home/jupyter/bench",
+                "readOnly": "True",
+            },
+        ],
+        "mem_limit": "3G",
+        "cpu_limit": "2",
+        "network_storage": "corral.bench.local",
+        "oauth_callback_url": "{}/hub/oauth_callback".format(url),
+        "oauth_validate_cert": "False",
+        "tapis_base_url": url,
+        "tapis_client_id": "bench-client",
+        "tapis_client_key": "bench-key",
+        "agave_base_url": url,
+        "agave_tenant_id": TENANT,
+        "agave_client_id": "bench-client",
+        "agave_client_secret": "bench-secret",
+        "agave_login_button_text": "Bench",
+    }
+
+
+def user_config(username):
+    return {
+        "name": "{}.user.config.{}.{}.jhub".format(username, TENANT, INSTANCE),
+        "value": {
+            "tenant": TENANT,
+            "instance": INSTANCE,
+            "config_type": "user",
+            "user": username,
+            "images": [
+                {"name": "taccsciapps/jupyteruser-gpu:2.0", "display_name": "GPU"}
+            ],
+            "mem_limit": "5G",
+            "cpu_limit": "4",
+            "volume_mounts": [],
+        },
+    }
+
+
+class StubHandler(web.RequestHandler):
+    upstream = None
+
+    async def prepare(self):
+        stubs = self.settings["stubs"]
+        stubs.requests[self.upstream] += 1
+        await asyncio.sleep(stubs.delay(self.upstream))
+
+    def write_json(self, data, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.finish(json.dumps(data))
+
+
+class MetaHandler(StubHandler):
+    upstream = "meta"
+
+    def get(self, db, collection):
+        query = json.loads(self.get_argument("filter", "{}"))
+        if "value.user" in query:
+            return self.write_json([user_config(query["value.user"])])
+        document = {
+            "name": query.get("name"),
+            "value": self.settings["stubs"].tenant_config,
+            "_etag": {"$oid": "bench-1"},
+        }
+        if self.get_argument("keys", None):
+            document = {"_etag": document["_etag"]}
+        self.write_json([document])
+
+
+class OAuthTokensHandler(StubHandler):
+    upstream = "oauth"
+
+    def post(self):
+        # the authorization code is the username, so every code logs in someone
+        username = self.get_argument("code")
+        now = int(time.time())
+        access_token = jwt.encode(
+            {"tapis/username": username, "exp": now + 14400}, JWT_KEY, algorithm="HS256"
+        )
+        self.write_json(
+            {
+                "result": {
+                    "access_token": {
+                        "access_token": access_token,
+                        "expires_in": 14400,
+                        "expires_at": now + 14400,
+                    },
+                    "refresh_token": {"refresh_token": "refresh-" + username},
+                }
+            }
+        )
+
+
+class TASHandler(StubHandler):
+    upstream = "tas"
+
+    def get(self, username):
+        uid = UID_BASE + sum(username.encode("utf8"))
+        self.write_json(
+            {"result": {"uid": uid, "gid": GID, "homeDirectory": "{}/{}".format(uid, username)}}
+        )
+
+
+class V2TokenHandler(StubHandler):
+    upstream = "v2_token"
+
+    def post(self):
+        self.write_json({"access_token": "v2-bench-token", "expires_in": 3600})
+
+
+class ProjectsHandler(StubHandler):
+    upstream = "projects"
+
+    def get(self):
+        self.write_json(
+            {
+                "mounts": [
+                    {"mountPath": "/PRJ-1001", "path": "/corral-repl/projects/PRJ-1001", "pems": "rw"},
+                    {"mountPath": "/PRJ-1002", "path": "/work/projects/PRJ-1002", "pems": "ro"},
+                ]
+            }
+        )
+
+
+class ConfigMapsHandler(StubHandler):
+    upstream = "k8s"
+
+    def get(self, namespace):
+        configmaps = self.settings["stubs"].configmaps
+        self.write_json(
+            {
+                "kind": "ConfigMapList",
+                "apiVersion": "v1",
+                "metadata": {},
+                "items": list(configmaps.values()),
+            }
+        )
+
+    def post(self, namespace):
+        body = json.loads(self.request.body)
+        self.settings["stubs"].configmaps[body["metadata"]["name"]] = body
+        self.write_json(body, status=201)
+
+
+class ConfigMapHandler(StubHandler):
+    upstream = "k8s"
+
+    def get(self, namespace, name):
+        configmap = self.settings["stubs"].configmaps.get(name)
+        if configmap is None:
+            return self.not_found(name)
+        self.write_json(configmap)
+
+    def put(self, namespace, name):
+        configmaps = self.settings["stubs"].configmaps
+        if name not in configmaps:
+            return self.not_found(name)
+        configmaps[name] = json.loads(self.request.body)
+        self.write_json(configmaps[name])
+
+    def not_found(self, name):
+        self.write_json(
+            {
+                "kind": "Status",
+                "apiVersion": "v1",
+                "status": "Failure",
+                "reason": "NotFound",
+                "message": 'configmaps "{}" not found'.format(name),
+                "code": 404,
+            },
+            status=404,
+        )
+
+
+class StubLDAPPool:
+    """Stands in for LDAPConnectionPool: same bound on concurrent searches, fixed latency"""
+
+    def __init__(self, stubs, size=8):
+        self.stubs = stubs
+        self._slots = threading.BoundedSemaphore(size)
+
+    def search(self, base, search_filter, attributes):
+        with self._slots:
+            self.stubs.requests["ldap"] += 1
+            time.sleep(self.stubs.delay("ldap"))
+            return [
+                {"type": "searchResEntry", "dn": "cn=G-{},ou=Groups,dc=tacc,dc=utexas,dc=edu".format(gid)}
+                for gid in (GID + 1, GID + 2)
+            ]
+
+
+class UpstreamStubs:
+    """Serve every stand-in from one local port on a background thread.
+
+    ``latency`` maps upstream names (see UPSTREAMS) to seconds; each request
+    waits that long, give or take ``jitter`` (a fraction of it).
+    """
+
+    def __init__(self, latency=None, jitter=0.0):
+        self.latency = dict.fromkeys(UPSTREAMS, 0.0)
+        self.latency.update(latency or {})
+        self.jitter = jitter
+        self.requests = Counter()
+        self.configmaps = {}
+        self.port = None
+        self.url = None
+        self.tenant_config = None
+        self._loop = None
+
+    def delay(self, upstream):
+        latency = self.latency[upstream]
+        if self.jitter:
+            latency *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(latency, 0)
+
+    def make_app(self):
+        return web.Application(
+            [
+                (r"/v3/meta/([^/]+)/([^/]+)", MetaHandler),
+                (r"/oauth2/tokens", OAuthTokensHandler),
+                (r"/tas/users/username/([^/]+)", TASHandler),
+                (r"/v3/oauth2/v2/token", V2TokenHandler),
+                (r"/projects/v2/?", ProjectsHandler),
+                (r"/api/v1/namespaces/([^/]+)/configmaps", ConfigMapsHandler),
+                (r"/api/v1/namespaces/([^/]+)/configmaps/([^/]+)", ConfigMapHandler),
+            ],
+            stubs=self,
+            # expected 404s (configmap upserts) would drown the report
+            log_function=lambda handler: None,
+        )
+
+    def start(self):
+        """Start serving and return the base URL"""
+        sockets = bind_sockets(0, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:{}".format(self.port)
+        self.tenant_config = tenant_config(self.url)
+        ready = threading.Event()
+        thread = threading.Thread(
+            target=self._serve, args=(sockets, ready), name="upstream-stubs", daemon=True
+        )
+        thread.start()
+        ready.wait()
+        return self.url
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def environment(self, token_dir, tas_cache_db):
+        """Hub env vars pointing every upstream at the stand-ins"""
+        return {
+            "TAPIS_SERVICE_TOKEN": "bench-service-token",
+            "TAPIS_BASE_URL": self.url,
+            "AGAVE_BASE_URL": self.url,
+            "V2_TOKEN_URL": "{}/v3/oauth2/v2/token".format(self.url),
+            "TAPIS_DATABASE": DATABASE,
+            "TAPIS_COLLECTION": COLLECTION,
+            "TENANT": TENANT,
+            "INSTANCE": INSTANCE,
+            "TAS_URL_BASE": "{}/tas".format(self.url),
+            "TAS_ROLE_PASS": "bench",
+            "TAS_CACHE_DB": tas_cache_db,
+            "LDAP_PASS": "bench",
+            "JHUB_TOKEN_DIR": token_dir,
+        }
+
+    def kubernetes_client(self):
+        """An ApiClient for the configmap stand-in"""
+        from kubernetes import client
+
+        configuration = client.Configuration()
+        configuration.host = self.url
+        return client.ApiClient(configuration)
+
+    def _serve(self, sockets, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        server = HTTPServer(self.make_app())
+        server.add_sockets(sockets)
+        ready.set()
+        self._loop.run_forever()
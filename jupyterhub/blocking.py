@@ -0,0 +1,26 @@
+"""
+The thread pool the hub and its services run blocking calls on.
+
+Kept apart from common.py so the hub services can share it without the
+Tapis environment common.py needs.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# threads available for blocking upstream calls made on behalf of the event loop
+blocking_workers = int(os.environ.get("HUB_BLOCKING_WORKERS", 32))
+
+blocking_executor = ThreadPoolExecutor(
+    max_workers=blocking_workers, thread_name_prefix="jhub-blocking"
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call on the shared executor so the hub event loop keeps serving"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        blocking_executor, functools.partial(func, *args, **kwargs)
+    )
@@ -0,0 +1,342 @@
+"""
+In-process caches for the hub's metadata and upstream lookups.
+"""
+
+import asyncio
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from tornado.log import app_log
+
+from jupyterhub.jhub_metrics import (
+    CACHE_REFRESHES,
+    CACHE_REQUESTS,
+    CACHE_SERVED_AGE,
+    TENANT_LABELS,
+)
+
+
+class CacheEntry:
+    __slots__ = ("value", "version", "fetched_at")
+
+    def __init__(self, value, version, fetched_at):
+        self.value = value
+        self.version = version
+        self.fetched_at = fetched_at
+
+    @property
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+
+class StaleWhileRevalidateCache:
+    """Serve the last good value for a key and refresh it in the background.
+
+    ``loader(key)`` returns a ``(value, version)`` tuple. Entries younger than
+    ``ttl`` seconds are served as-is. Older entries are still served right
+    away while one background refresh per key runs; if a ``version_loader(key)``
+    is given it is asked first, and when it reports the cached version the
+    entry is only re-stamped instead of reloaded. A failed refresh keeps
+    serving the last good value. Keys with no entry yet are loaded inline.
+    With ``max_age``, entries older than that many seconds are no longer
+    served, and are dropped by a sweep that runs at most once per ``ttl``.
+    """
+
+    def __init__(self, name, loader, ttl, version_loader=None, executor=None, max_age=None):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.version_loader = version_loader
+        self.executor = executor
+        self.max_age = max_age
+        self._swept_at = time.monotonic()
+        self._entries = {}
+        self._refreshing = set()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key=None):
+        """Return the cached value for key, loading it inline on a miss"""
+        entry = self._lookup(key)
+        if entry is None:
+            entry = self._load(key)
+        return entry.value
+
+    async def get_async(self, key=None):
+        """Return the cached value for key without blocking the event loop.
+
+        A miss is loaded on the executor; concurrent misses for the same key
+        share one load.
+        """
+        return (await self.get_entry_async(key)).value
+
+    async def get_entry_async(self, key=None):
+        """Like get_async, but return the entry so value and version match"""
+        entry = self._lookup(key)
+        if entry is None:
+            future = self._pending.get(key)
+            if future is None:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(self.executor, self._load, key)
+                self._pending[key] = future
+                future.add_done_callback(lambda f: self._pending.pop(key, None))
+            entry = await asyncio.shield(future)
+        return entry
+
+    def version(self, key=None):
+        """Return the version of the cached value for key, or None"""
+        entry = self._entries.get(key)
+        return entry.version if entry else None
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and self.max_age and entry.age >= self.max_age:
+            entry = None
+        if entry is None:
+            CACHE_REQUESTS.labels(**TENANT_LABELS, cache=self.name, result="miss").inc()
+            return None
+        age = entry.age
+        CACHE_SERVED_AGE.labels(**TENANT_LABELS, cache=self.name).observe(age)
+        if age < self.ttl:
+            CACHE_REQUESTS.labels(**TENANT_LABELS, cache=self.name, result="hit").inc()
+        else:
+            CACHE_REQUESTS.labels(**TENANT_LABELS, cache=self.name, result="stale").inc()
+            self._schedule_refresh(key)
+        return entry
+
+    def _load(self, key):
+        value, version = self.loader(key)
+        entry = CacheEntry(value, version, time.monotonic())
+        with self._lock:
+            self._entries[key] = entry
+            if self.max_age and entry.fetched_at - self._swept_at >= self.ttl:
+                self._swept_at = entry.fetched_at
+                for old in [k for k, e in self._entries.items() if e.age >= self.max_age]:
+                    self._entries.pop(old, None)
+        return entry
+
+    def _schedule_refresh(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        if self.executor is not None:
+            self.executor.submit(self._refresh, key)
+        else:
+            threading.Thread(target=self._refresh, args=(key,), daemon=True).start()
+
+    def _refresh(self, key):
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and self.version_loader is not None:
+                version = self.version_loader(key)
+                if version is not None and version == entry.version:
+                    with self._lock:
+                        self._entries[key] = CacheEntry(
+                            entry.value, entry.version, time.monotonic()
+                        )
+                    CACHE_REFRESHES.labels(
+                        **TENANT_LABELS, cache=self.name, outcome="unchanged"
+                    ).inc()
+                    return
+            self._load(key)
+            CACHE_REFRESHES.labels(**TENANT_LABELS, cache=self.name, outcome="reloaded").inc()
+        except Exception as e:
+            CACHE_REFRESHES.labels(**TENANT_LABELS, cache=self.name, outcome="failed").inc()
+            app_log.warning(
+                "Could not refresh %s cache for key %s, serving stale value: %s",
+                self.name,
+                key,
+                e,
+            )
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+class LRUCache:
+    """Objects built from versioned configs, kept for the ``maxsize`` most
+    recently used keys.
+
+    ``get(key, build)`` returns the object kept for key, or calls ``build()``
+    and keeps its result. A key of None means there is no version to key on,
+    so the object is built every time and not kept.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        if key is None:
+            return build()
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                return value
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+
+class TTLCache:
+    """Keyed in-memory cache whose entries expire after ``ttl`` seconds.
+
+    A loader result of None is a failure. It is cached as a negative entry
+    for ``negative_ttl`` seconds when that is set, and not cached otherwise.
+    ``ttl_for(value)``, when given, picks the lifetime of each loaded value,
+    e.g. from a token's expiry. Once more than ``maxsize`` entries are held,
+    expired ones are dropped.
+    """
+
+    def __init__(self, name, ttl, negative_ttl=None, ttl_for=None, maxsize=None):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.ttl_for = ttl_for
+        self.maxsize = maxsize
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader(key) on a miss.
+
+        Concurrent misses for one key share a single load. When the loader
+        fails but an expired value is still on hand, that value is served
+        instead of caching the failure.
+        """
+        hit, value = self._get(key)
+        if hit:
+            return value
+        with self._key_lock(key):
+            hit, value = self._get(key, count=False)
+            if hit:
+                return value
+            value = loader(key)
+            if value is not None:
+                ttl = self.ttl_for(value) if self.ttl_for else self.ttl
+                self._set(key, value, ttl)
+                return value
+            expired = self._read(key)
+            if expired is not None and expired[0] is not None:
+                CACHE_REQUESTS.labels(**TENANT_LABELS, cache=self.name, result="stale").inc()
+                return expired[0]
+            if self.negative_ttl:
+                self._set(key, None, self.negative_ttl)
+            return None
+
+    def put(self, key, value, ttl=None):
+        """Cache value for key, for ttl seconds or the cache's ttl"""
+        self._set(key, value, self.ttl if ttl is None else ttl)
+
+    def peek(self, key):
+        """Return the unexpired value for key, or None, without loading it"""
+        hit, value = self._get(key, count=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def _get(self, key, count=True):
+        entry = self._read(key)
+        if entry is None or entry[1] < time.time():
+            if count:
+                CACHE_REQUESTS.labels(**TENANT_LABELS, cache=self.name, result="miss").inc()
+            return False, None
+        if count:
+            result = "hit" if entry[0] is not None else "negative"
+            CACHE_REQUESTS.labels(**TENANT_LABELS, cache=self.name, result=result).inc()
+        return True, entry[0]
+
+    def _set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._write(key, value, now + ttl)
+            if self.maxsize and len(self._entries) > self.maxsize:
+                for expired in [k for k, e in self._entries.items() if e[1] < now]:
+                    self._entries.pop(expired, None)
+
+    def _read(self, key):
+        return self._entries.get(key)
+
+    def _write(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+
+    def _delete(self, key):
+        self._entries.pop(key, None)
+
+    @contextlib.contextmanager
+    def _key_lock(self, key):
+        # a key's lock lives only while a load for it is running or waiting
+        with self._lock:
+            lock, holders = self._key_locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._key_locks[key] = (lock, holders + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, holders = self._key_locks[key]
+                if holders == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (lock, holders - 1)
+
+
+class PersistentTTLCache(TTLCache):
+    """TTLCache written through to a small SQLite file.
+
+    Values must be JSON serializable. Entries survive restarts, so a freshly
+    started hub does not have to reload every key at once.
+    """
+
+    def __init__(self, name, path, ttl, negative_ttl):
+        super().__init__(name, ttl, negative_ttl)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+
+    def _read(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = (json.loads(row[0]), row[1])
+                    self._entries[key] = entry
+            return entry
+
+    def _write(self, key, value, expires_at):
+        super()._write(key, value, expires_at)
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+
+    def _delete(self, key):
+        super()._delete(key)
+        with self._db:
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
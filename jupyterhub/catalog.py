@@ -0,0 +1,118 @@
+"""
+Image catalog behind the options form and the spawn hook's image check.
+"""
+
+import hashlib
+import html
+import json
+import os
+from collections import OrderedDict
+
+from jupyterhub.caching import LRUCache
+
+# catalogs kept, one per distinct (tenant config version, user configs version)
+IMAGE_CATALOG_CACHE_SIZE = int(os.environ.get("IMAGE_CATALOG_CACHE_SIZE", 512))
+
+# option values are short image ids; description and hpc ride along as data attributes
+HPC_JS = """(function hpc(){
+                var select_element = document.getElementById('image');
+                var option = select_element.options[select_element.selectedIndex];
+                document.getElementById('image_description').innerText = option.dataset.description || '';
+                var display = option.dataset.hpc === 'true' ? 'inline-block' : 'none';
+                document.getElementById('hpc').checked = false;
+                document.getElementById('hpc').style.display = display;
+                document.getElementById('hpc_label').style.display = display;
+            })()"""
+HPC_INPUT = """<input type="checkbox" id="hpc" name="hpc" style="display: none">
+                <label for="hpc" id="hpc_label" style="display: none">Run on HPC</label>
+                """
+DESCRIPTION_JS = """(function hpc(){
+                            var select_element = document.getElementById('image');
+                            var option = select_element.options[select_element.selectedIndex];
+                            document.getElementById('image_description').innerText = option.dataset.description || '';
+                        })()"""
+IMAGE_DESCRIPTION = '<p id="image_description" style="display: inline-block"> </p>'
+
+
+def image_id(key):
+    """Short id for an image key, stable across config versions"""
+    return hashlib.sha256(json.dumps(key).encode("utf8")).hexdigest()[:12]
+
+
+class ImageCatalog:
+    """The images a user can pick, deduplicated by (name, display_name).
+
+    Tenant images come before user and group config images, so the tenant
+    entry wins when both define the same key. The images are the compiled
+    config_model.Image objects, shared with every catalog built from the same
+    config versions.
+    """
+
+    def __init__(self, tenant_model, user_models):
+        images = OrderedDict()
+        for model in (tenant_model,) + tuple(user_models):
+            for image in model.images:
+                images.setdefault(image.key, image)
+        # the form lists images by name
+        self.images = OrderedDict(sorted(images.items(), key=lambda item: item[1].name))
+        self.hpc = {key: image.hpc_available for key, image in self.images.items()}
+        self.hpc_available = any(self.hpc.values())
+        self.ids = {image_id(key): key for key in self.images}
+        self._form = None
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, name, display_name=None):
+        return self.images.get((name, display_name))
+
+    def resolve(self, value):
+        """Return the key and image for an id posted by the form, or (None, None)"""
+        key = self.ids.get(value)
+        if key is None and value.startswith("{"):
+            # the full image JSON posted by forms rendered before image ids
+            image = json.loads(value)
+            key = image["name"], image.get("display_name")
+        return key, self.images.get(key)
+
+    def first(self):
+        return next(iter(self.images.values()))
+
+    @property
+    def show_form(self):
+        """A single image without HPC needs no choice, so the form is skipped"""
+        return len(self.images) > 1 or self.hpc_available
+
+    def form(self):
+        """The options form HTML, rendered once per catalog"""
+        if self._form is None:
+            self._form = self._render_form()
+        return self._form
+
+    def _render_form(self):
+        options = "".join(
+            " <option value='{}' data-description=\"{}\" data-hpc=\"{}\"> {} </option>".format(
+                image_id(key),
+                html.escape(image.description),
+                "true" if self.hpc[key] else "false",
+                html.escape(image.label),
+            )
+            for key, image in self.images.items()
+        )
+        if self.hpc_available:
+            js, hpc = HPC_JS, HPC_INPUT
+        else:
+            js, hpc = DESCRIPTION_JS, ""
+        select_images = '<select id="image" name="image" size="10" onchange="{}"> {} </select>'.format(
+            js, options
+        )
+        return "{}{}{}".format(select_images, IMAGE_DESCRIPTION, hpc)
+
+
+_catalogs = LRUCache(IMAGE_CATALOG_CACHE_SIZE)
+
+
+def get_image_catalog(tenant_model, tenant_version, user_models, user_version):
+    """Return the catalog for these config versions, building it on first use"""
+    key = (tenant_version, user_version) if tenant_version is not None else None
+    return _catalogs.get(key, lambda: ImageCatalog(tenant_model, user_models))
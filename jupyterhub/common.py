@@ -1,9 +1,17 @@
+import copy
+import hashlib
 import os
 import string
 import sys
 import json
 
-from tapipy.tapis import Tapis
+import requests
+from requests.adapters import HTTPAdapter
+from tornado.log import app_log
+
+from jupyterhub.blocking import blocking_executor, blocking_workers, run_blocking
+from jupyterhub.caching import StaleWhileRevalidateCache
+from jupyterhub.jhub_metrics import META_REQUEST_DURATION, time_phase
 
 INSTANCE = os.environ.get("INSTANCE")
 TENANT = os.environ.get("TENANT")
@@ -13,11 +21,55 @@ tapis_base_url = os.environ.get("TAPIS_BASE_URL", "https://tacc.tapis.io")
 v2_token_url = os.environ.get("V2_TOKEN_URL", "https://tacc.develop.tapis.io/v3/oauth2/v2/token")
 database = os.environ.get("TAPIS_DATABASE")
 collection = os.environ.get("TAPIS_COLLECTION")
+# shared volume the login handler writes token files to and the spawn hook reads them from
+token_dir = os.environ.get("JHUB_TOKEN_DIR", "/agave/jupyter/tokens")
+# seconds a cached tenant config is served before it is revalidated in the background
+tenant_config_ttl = int(os.environ.get("TENANT_CONFIG_TTL", 60))
+meta_timeout = float(os.environ.get("TAPIS_META_TIMEOUT", 10))
 
 if not tapis_service_token:
     raise Exception("Missing TAPIS_SERVICE_TOKEN configuration.")
 
 
+class TapisMetaClient:
+    """Client for the Tapis meta API with a pooled, keep-alive HTTP session.
+
+    Its methods block, and are safe to call from the executor threads; the
+    ``*_async`` lookups below run them there so callers on the event loop
+    never block on the HTTP round-trip.
+    """
+
+    def __init__(self, base_url, token, pool_size=blocking_workers, timeout=meta_timeout):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(
+            {"X-Tapis-Token": token, "Accept": "application/json"}
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def list_documents(self, db, collection, filter, keys=None, page=None, pagesize=None):
+        """Return the documents in db/collection matching the filter"""
+        params = {"filter": json.dumps(filter)}
+        if keys:
+            params["keys"] = json.dumps(keys)
+        if page:
+            params["page"] = page
+            params["pagesize"] = pagesize
+        rsp = self.session.get(
+            f"{self.base_url}/v3/meta/{db}/{collection}",
+            params=params,
+            timeout=self.timeout,
+        )
+        rsp.raise_for_status()
+        return rsp.json()
+
+
+meta_client = TapisMetaClient(tapis_base_url, tapis_service_token)
+
+
 def get_config_metadata_name():
     """Return name of config metadata"""
     return f"config.{TENANT}.{INSTANCE}.jhub"
@@ -25,24 +77,116 @@ def get_config_metadata_name():
 
 def get_tenant_configs():
     """Retrive tenant config from metadata"""
-    t = Tapis(base_url=tapis_base_url, jwt=tapis_service_token)
+    return copy.deepcopy(tenant_configs_cache.get())
+
+
+async def get_tenant_configs_async():
+    """Retrive tenant config from metadata without blocking the event loop"""
+    return copy.deepcopy(await tenant_configs_cache.get_async())
+
+
+async def get_tenant_configs_versioned_async():
+    """Return the tenant config and the version it was loaded at.
+
+    The config is the cached document itself, shared with every caller, so
+    it is only to be compiled (config_model.get_tenant_model), never changed.
+    """
+    entry = await tenant_configs_cache.get_entry_async()
+    return entry.value, entry.version
+
+
+def get_tenant_configs_version():
+    """Return the version of the tenant config currently being served"""
+    return tenant_configs_cache.version()
+
+
+def _load_tenant_configs(key=None):
     q = {"name": get_config_metadata_name()}
-    print(f"tenant query: {q}")
-    metadata = json.loads(
-        t.meta.listDocuments(db=database, collection=collection, filter=json.dumps(q))
-    )[0]["value"]
-    return metadata
+    app_log.debug(f"tenant query: {q}")
+    with time_phase(META_REQUEST_DURATION, lookup="tenant_configs"):
+        document = meta_client.list_documents(database, collection, q)[0]
+    return document["value"], _document_version(document)
+
+
+def _load_tenant_configs_version(key=None):
+    """Fetch only the etag of the tenant config document"""
+    q = {"name": get_config_metadata_name()}
+    with time_phase(META_REQUEST_DURATION, lookup="tenant_configs_version"):
+        document = meta_client.list_documents(database, collection, q, keys={"_etag": 1})[0]
+    if "_etag" not in document:
+        return None
+    return _document_version(document)
+
+
+def _document_version(document):
+    """Use the document etag as its version, falling back to a content hash"""
+    if "_etag" in document:
+        return json.dumps(document["_etag"], sort_keys=True)
+    return hashlib.sha256(
+        json.dumps(document.get("value"), sort_keys=True).encode("utf8")
+    ).hexdigest()
+
+
+tenant_configs_cache = StaleWhileRevalidateCache(
+    "tenant_configs",
+    _load_tenant_configs,
+    ttl=tenant_config_ttl,
+    version_loader=_load_tenant_configs_version,
+    executor=blocking_executor,
+)
 
 
 def get_user_configs(username):
     """Retrieve any groups user belongs to"""
-    t = Tapis(base_url=tapis_base_url, jwt=tapis_service_token)
     q = {"value.user": username, "value.tenant": TENANT, "value.instance": INSTANCE}
-    print(f"user query: {q}")
-    metadata = json.loads(
-        t.meta.listDocuments(db=database, collection=collection, filter=json.dumps(q))
+    app_log.debug(f"user query: {q}")
+    with time_phase(META_REQUEST_DURATION, lookup="user_configs"):
+        return meta_client.list_documents(database, collection, q)
+
+
+async def get_user_configs_async(username):
+    """Retrieve any groups user belongs to without blocking the event loop"""
+    return await run_blocking(get_user_configs, username)
+
+
+def get_all_user_configs(pagesize=100):
+    """Retrieve the user and group config documents of every user of the tenant"""
+    q = {
+        "value.tenant": TENANT,
+        "value.instance": INSTANCE,
+        "value.config_type": {"$ne": "tenant"},
+    }
+    documents = []
+    page = 1
+    while True:
+        with time_phase(META_REQUEST_DURATION, lookup="all_user_configs"):
+            batch = meta_client.list_documents(
+                database, collection, q, page=page, pagesize=pagesize
+            )
+        documents.extend(batch)
+        if len(batch) < pagesize:
+            return documents
+        page += 1
+
+
+async def get_all_user_configs_async():
+    return await run_blocking(get_all_user_configs)
+
+
+def get_user_configs_version(user_configs):
+    """Content hash of a user's config documents, to key what is derived from them"""
+    return hashlib.sha256(
+        json.dumps(user_configs, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+
+
+def get_credentials_configmap_name(username):
+    """Return the name of the configmap holding a user's .agpy and current files"""
+    return "{}-{}-{}-jhub".format(
+        safe_string(username).lower(),
+        safe_string(TENANT).lower(),
+        safe_string(INSTANCE).lower(),
     )
-    return metadata
 
 
 def safe_string(
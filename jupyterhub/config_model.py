@@ -0,0 +1,269 @@
+"""
+Compiled, immutable views of the tenant and user config documents.
+
+The config documents come from the Tapis meta API as plain dicts, with flags
+as "True"/"False" strings and limits as strings. They are compiled once per
+config version into ``__slots__`` objects that are parsed and validated up
+front, and every spawner with the same config versions shares the same
+objects. Nothing here may be mutated; values a spawner needs to change, like
+an image's ``extra_pod_config``, are handed out as copies.
+"""
+
+import copy
+import json
+import os
+import re
+from types import MappingProxyType
+
+import humanfriendly
+
+from jupyterhub.caching import LRUCache
+
+# compiled configs kept, one per distinct config version
+COMPILED_CONFIG_CACHE_SIZE = int(os.environ.get("COMPILED_CONFIG_CACHE_SIZE", 4096))
+
+
+def as_bool(value):
+    """Read the "True"/"False" strings the tenant configs use for flags"""
+    if isinstance(value, str):
+        return value.strip().lower() == "true"
+    return bool(value)
+
+
+def parse_memory(value):
+    """Bytes in a memory limit like "3G", or None if unset"""
+    if value in (None, ""):
+        return None
+    try:
+        return humanfriendly.parse_size(str(value))
+    except humanfriendly.InvalidSize as e:
+        raise ValueError("invalid mem_limit {!r}: {}".format(value, e))
+
+
+def parse_id(value):
+    """A uid or gid as an int, or None if unset"""
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("invalid uid/gid {!r}".format(value))
+
+
+def parse_cpu(value):
+    """A cpu limit like "4" or 0.5 as a float, or None if unset"""
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError("invalid cpu_limit {!r}".format(value))
+
+
+class Frozen:
+    """Base for the compiled objects: attributes are set once, in __init__"""
+
+    __slots__ = ()
+
+    def _set(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__),
+        )
+
+
+class ResourceLimits(Frozen):
+    """A memory limit (as configured and in bytes) and a cpu limit"""
+
+    __slots__ = ("mem_limit", "mem_bytes", "cpu_limit")
+
+    def __init__(self, mem_limit=None, cpu_limit=None):
+        self._set(
+            mem_limit=mem_limit or None,
+            mem_bytes=parse_memory(mem_limit),
+            cpu_limit=parse_cpu(cpu_limit),
+        )
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("mem_limit"), config.get("cpu_limit"))
+
+    @classmethod
+    def highest(cls, limits):
+        """The highest memory and cpu limits among limits, each compared by value"""
+        highest = cls()
+        mem = [l for l in limits if l.mem_bytes is not None]
+        cpu = [l.cpu_limit for l in limits if l.cpu_limit is not None]
+        if mem:
+            top = max(mem, key=lambda l: l.mem_bytes)
+            highest._set(mem_limit=top.mem_limit, mem_bytes=top.mem_bytes)
+        if cpu:
+            highest._set(cpu_limit=max(cpu))
+        return highest
+
+    @property
+    def threads(self):
+        """Thread count for the BLAS/OpenMP env vars, at least one"""
+        return str(max(1, int(self.cpu_limit or 1)))
+
+
+class VolumeMount(Frozen):
+    """A volume_mounts entry with its flags parsed and its volume name derived"""
+
+    __slots__ = ("type", "path", "mount_path", "read_only", "server", "name", "key")
+
+    def __init__(self, item):
+        try:
+            volume_type = item["type"]
+            path = item["path"]
+            mount_path = item["mountPath"]
+        except KeyError as e:
+            raise ValueError("volume mount {} is missing {}".format(item, e))
+        if volume_type == "nfs" and not item.get("server"):
+            raise ValueError("nfs volume mount {} has no server".format(item))
+        if mount_path.endswith("/"):
+            mount_path = mount_path[:-1]
+        self._set(
+            type=volume_type,
+            path=path,
+            mount_path=mount_path,
+            read_only=as_bool(item.get("readOnly", "False")),
+            server=item.get("server"),
+            name=volume_name(mount_path),
+            # entries are deduplicated on their whole content
+            key=json.dumps(item, sort_keys=True),
+        )
+
+    def __eq__(self, other):
+        return isinstance(other, VolumeMount) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+
+def volume_name(mount_path):
+    """Volume name from the last path component of the mount path.
+
+    Volume names must consist of lower case alphanumeric characters or '-',
+    and must start and end with an alphanumeric character.
+    """
+    return re.sub(r"([^a-z0-9-\s]+?)", "", mount_path.split("/")[-1].lower())
+
+
+class Image(Frozen):
+    """An images entry of a tenant, user or group config"""
+
+    __slots__ = (
+        "name",
+        "display_name",
+        "description",
+        "notebook_dir",
+        "hpc_available",
+        "node_selector",
+        "tolerations",
+        "key",
+        "_extra_pod_config",
+        "_extra_container_config",
+    )
+
+    def __init__(self, item):
+        if not item.get("name"):
+            raise ValueError("image {} has no name".format(item))
+        pod_config = copy.deepcopy(item.get("extra_pod_config") or {})
+        self._set(
+            name=item["name"],
+            display_name=item.get("display_name"),
+            description=item.get("description", ""),
+            notebook_dir=item.get("notebook_dir", ""),
+            hpc_available=as_bool(item.get("hpc_available", "False")),
+            node_selector=MappingProxyType(dict(pod_config.get("nodeSelector") or {})),
+            tolerations=tuple(
+                MappingProxyType(dict(t)) for t in pod_config.get("tolerations") or []
+            ),
+            key=(item["name"], item.get("display_name")),
+            _extra_pod_config=pod_config,
+            _extra_container_config=copy.deepcopy(item.get("extra_container_config") or {}),
+        )
+
+    @property
+    def label(self):
+        return self.display_name or self.name
+
+    def extra_pod_config(self):
+        """A copy of the image's extra_pod_config, for the spawner to merge into"""
+        return copy.deepcopy(self._extra_pod_config)
+
+    def extra_container_config(self):
+        return copy.deepcopy(self._extra_container_config)
+
+
+class CompiledConfig(Frozen):
+    """The settings the hub reads from one config document.
+
+    Only the tenant config's uid, gid, credentials_mode, network_storage and
+    pod configs are used; user and group configs contribute limits, volume
+    mounts and images.
+    """
+
+    __slots__ = (
+        "limits",
+        "volume_mounts",
+        "images",
+        "uid",
+        "gid",
+        "credentials_mode",
+        "network_storage",
+        "_extra_pod_config",
+        "_extra_container_config",
+    )
+
+    def __init__(self, config):
+        self._set(
+            limits=ResourceLimits.from_config(config),
+            volume_mounts=tuple(VolumeMount(item) for item in config.get("volume_mounts") or []),
+            images=tuple(Image(item) for item in config.get("images") or []),
+            uid=parse_id(config.get("uid")),
+            gid=parse_id(config.get("gid")),
+            credentials_mode=config.get("credentials_mode") or None,
+            network_storage=config.get("network_storage"),
+            _extra_pod_config=copy.deepcopy(config.get("extra_pod_config") or {}),
+            _extra_container_config=copy.deepcopy(config.get("extra_container_config") or {}),
+        )
+
+    def extra_pod_config(self):
+        """A copy of the config's extra_pod_config, for the spawner to merge into"""
+        return copy.deepcopy(self._extra_pod_config)
+
+    def extra_container_config(self):
+        return copy.deepcopy(self._extra_container_config)
+
+
+_compiled = LRUCache(COMPILED_CONFIG_CACHE_SIZE)
+
+
+def _cached(key, build):
+    # nothing to key it on without a version
+    return _compiled.get(key if key[1] is not None else None, build)
+
+
+def get_tenant_model(tenant_configs, tenant_version):
+    """The compiled tenant config for this version, compiled on first use"""
+    return _cached(("tenant", tenant_version), lambda: CompiledConfig(tenant_configs))
+
+
+def get_user_models(user_configs, user_version):
+    """The compiled user and group configs for this version, compiled on first use"""
+    return _cached(
+        ("user", user_version),
+        lambda: tuple(CompiledConfig(item["value"]) for item in user_configs),
+    )
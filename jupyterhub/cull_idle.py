@@ -16,98 +16,368 @@ You can run this as a service managed by JupyterHub with this in your config::
 Or run it manually by generating an API token and storing it in `JUPYTERHUB_API_TOKEN`:
     export JUPYTERHUB_API_TOKEN=`jupyterhub token`
     python cull_idle_servers.py [--timeout=900] [--url=http://127.0.0.1:8081/hub/api]
+Users are fetched a page at a time (--page_size) with the hub filtering on
+server state, and at most --concurrency DELETE requests are in flight at once.
+Each hub request times out after --request_timeout seconds and is retried up
+to --max_retries times with exponential backoff.
+Between full scans (every --cull_every seconds, default the timeout, and
+never longer than the shortest tenant, image or pressure-scaled timeout) each
+server is re-checked on its own as soon as its idle deadline passes, so it is
+culled close to last_activity + timeout rather than up to a scan later.
+With --pressure_tiers the timeouts shrink as cluster memory fills up and the
+biggest idle servers go first (see cull_policy.py); --tenant_timeouts reads
+per-tenant and per-image cull_timeout overrides from the tenant config.
 """
 
+import asyncio
 import datetime
+import heapq
 import json
 import os
+from urllib.parse import quote
 
-from dateutil.parser import parse as parse_date
-
-from tornado.gen import coroutine
 from tornado.log import app_log
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
-from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.httpclient import HTTPClientError
+from tornado.ioloop import IOLoop
 from tornado.options import define, options, parse_command_line
 
+from jupyterhub.cull_policy import (
+    CullPolicy,
+    KubernetesUtilization,
+    ServerResources,
+    StaticUtilization,
+    UtilizationSample,
+    parse_tiers,
+)
+from jupyterhub.hub_api import HubAPI, parse_hub_date, utcnow
 
-@coroutine
-def cull_idle(url, api_token, timeout, cull_users=False):
-    """Shutdown idle single-user servers
-    If cull_users, inactive *users* will be deleted as well.
+
+class IdleCuller:
+    """Cull servers as they reach their idle deadline.
+
+    Every known server sits in a heap keyed by its projected cull deadline,
+    last_activity + its timeout. The culler sleeps until the earliest
+    deadline and then re-checks only the servers that are due, culling them
+    if they are still idle and pushing them back otherwise. A full paged scan
+    of the hub (``resync``) runs every ``resync_every`` seconds to pick up
+    servers started since the last one.
+
+    Timeouts and cull order come from a ``CullPolicy`` fed by a utilisation
+    source sampled every ``sample_every`` seconds; when the pressure tier
+    changes, a resync runs right away so every deadline is recomputed.
     """
-    auth_header = {
-        'Authorization': 'token %s' % api_token
-    }
-    req = HTTPRequest(url=url + '/users',
-                      headers=auth_header,
-                      )
-    now = datetime.datetime.utcnow()
-    cull_limit = now - datetime.timedelta(seconds=timeout)
-    app_log.info("Current cull limit now ( %s) is  %s", now, cull_limit)
-    client = AsyncHTTPClient()
-    resp = yield client.fetch(req)
-    users = json.loads(resp.body.decode('utf8', 'replace'))
-    futures = []
-
-    @coroutine
-    def cull_one(user, last_activity):
-        """cull one user"""
 
+    def __init__(
+        self,
+        hub,
+        timeout,
+        cull_users=False,
+        concurrency=10,
+        page_size=200,
+        policy=None,
+        utilization=None,
+        config_loader=None,
+        sample_every=60,
+    ):
+        self.hub = hub
+        self.cull_users = cull_users
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.policy = policy or CullPolicy(timeout)
+        self.utilization = utilization or StaticUtilization()
+        self.config_loader = config_loader
+        self.sample_every = sample_every
+        self.sample = UtilizationSample()
+        self.deadlines = []
+        # latest deadline per (user, server), to skip superseded heap entries
+        self.scheduled = {}
+        self.queue = asyncio.Queue(maxsize=concurrency * 2)
+        self.workers = []
+
+    def start_workers(self):
+        self.workers = [
+            asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    def stop_workers(self):
+        for w in self.workers:
+            w.cancel()
+        self.workers = []
+
+    async def run(self, resync_every):
+        self.start_workers()
+        try:
+            loop = asyncio.get_running_loop()
+            next_resync = next_sample = loop.time()
+            while True:
+                if loop.time() >= next_sample:
+                    factor = self.policy.factor(self.sample.memory)
+                    await self.refresh_sample()
+                    next_sample = loop.time() + self.sample_every
+                    if self.policy.factor(self.sample.memory) != factor:
+                        app_log.info(
+                            "Memory utilisation now %.2f, recomputing deadlines",
+                            self.sample.memory,
+                        )
+                        next_resync = loop.time()
+                if loop.time() >= next_resync:
+                    await self.resync(refresh=False)
+                    # servers are only discovered here, so a server started just
+                    # after it must not outlive its timeout waiting for the next one
+                    next_resync = loop.time() + min(
+                        resync_every, self.policy.shortest_timeout(self.sample.memory)
+                    )
+                wait = min(next_resync, next_sample) - loop.time()
+                if self.deadlines:
+                    wait = min(wait, (self.deadlines[0][0] - utcnow()).total_seconds())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self.check_due()
+        finally:
+            self.stop_workers()
+
+    async def refresh_sample(self):
+        try:
+            self.sample = await self.utilization.sample()
+        except Exception as e:
+            app_log.error("Could not sample cluster utilisation: %s", e)
+
+    async def resync(self, refresh=True):
+        """Scan all users, culling idle servers and scheduling the rest"""
+        if refresh:
+            await self.refresh_sample()
+        if self.config_loader is not None:
+            try:
+                self.policy.load_tenant_config(await self.config_loader())
+            except Exception as e:
+                app_log.error("Could not load cull timeouts from tenant config: %s", e)
+        app_log.info(
+            "Full resync, memory utilisation %.2f, timeout factor %s",
+            self.sample.memory,
+            self.policy.factor(self.sample.memory),
+        )
+        self.deadlines = []
+        self.scheduled = {}
+        candidates = []
+        states = ["active", "inactive"] if self.cull_users else ["active"]
+        for state in states:
+            async for users in self.hub.iter_user_pages(state, self.page_size):
+                for user in users:
+                    candidates.extend(self._candidates(user))
+        await self._cull(candidates)
+        app_log.info("Resync done, %i servers scheduled", len(self.scheduled))
+
+    async def check_due(self):
+        """Re-check the servers whose deadline has passed"""
+        now = utcnow()
+        due = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, name, server_name = heapq.heappop(self.deadlines)
+            if self.scheduled.get((name, server_name)) == deadline:
+                del self.scheduled[(name, server_name)]
+                due.append((name, server_name))
+        for name, server_name in due:
+            await self.queue.put((self._check_one, (name, server_name)))
+        await self.queue.join()
+
+    def schedule(self, name, server_name, deadline):
+        self.scheduled[(name, server_name)] = deadline
+        heapq.heappush(self.deadlines, (deadline, name, server_name))
+
+    def _candidates(self, user, server_names=None):
+        """Return cull candidates among the user's servers, scheduling the others"""
+        now = utcnow()
+        candidates = []
+        for server_name, last_activity in _server_activity(user, self.cull_users):
+            if server_names is not None and server_name not in server_names:
+                continue
+            resources = self.sample.resources.get(
+                (user["name"], server_name or ""), ServerResources()
+            )
+            timeout = datetime.timedelta(
+                seconds=self.policy.timeout_for(resources.image, self.sample.memory)
+            )
+            if last_activity is None:
+                # still starting, look again once it could have gone idle
+                self.schedule(user["name"], server_name, now + timeout)
+            elif last_activity + timeout <= now:
+                idle = (now - last_activity).total_seconds()
+                candidates.append((idle, resources, (user, server_name, last_activity)))
+            else:
+                app_log.debug("Not culling %s (active since %s)", user["name"], last_activity)
+                if server_name is not None:
+                    self.schedule(user["name"], server_name, last_activity + timeout)
+        return candidates
+
+    async def _cull(self, candidates):
+        to_cull, deferred = self.policy.select(
+            candidates, self.sample.memory, self.sample.allocatable
+        )
+        for user, server_name, last_activity in deferred:
+            # enough is being freed for now, look again after the next sample
+            self.schedule(
+                user["name"],
+                server_name,
+                utcnow() + datetime.timedelta(seconds=self.sample_every),
+            )
+        for args in to_cull:
+            await self.queue.put((self.cull_one, args))
+        await self.queue.join()
+
+    async def _check_one(self, name, server_name):
+        try:
+            resp = await self.hub.fetch("/users/%s" % quote(name, safe=""))
+        except HTTPClientError as e:
+            if e.code == 404:
+                return
+            raise
+        user = json.loads(resp.body.decode("utf8", "replace"))
+        for idle, resources, args in self._candidates(user, server_names={server_name}):
+            to_cull, deferred = self.policy.select(
+                [(idle, resources, args)], self.sample.memory, self.sample.allocatable
+            )
+            if deferred:
+                self.schedule(
+                    name, server_name, utcnow() + datetime.timedelta(seconds=self.sample_every)
+                )
+            for args in to_cull:
+                await self.cull_one(*args)
+
+    async def cull_one(self, user, server_name, last_activity):
+        """cull one server, and the user if they have no servers left"""
+        name = quote(user["name"], safe="")
         # shutdown server first. Hub doesn't allow deleting users with running servers.
-        if user['server']:
-            app_log.info("Culling server for %s (inactive since %s)", user['name'], last_activity)
-            req = HTTPRequest(url=url + '/users/%s/server' % user['name'],
-                              method='DELETE',
-                              headers=auth_header,
-                              )
-            yield client.fetch(req)
-        if cull_users:
-            app_log.info("Culling user %s (inactive since %s)", user['name'], last_activity)
-            req = HTTPRequest(url=url + '/users/%s' % user['name'],
-                              method='DELETE',
-                              headers=auth_header,
-                              )
-            yield client.fetch(req)
-
-    for user in users:
-        if not user['server'] and not cull_users:
-            # server not running and not culling users, nothing to do
-            continue
-        last_activity = parse_date(user['last_activity'])
-        if last_activity < cull_limit:
-            futures.append((user['name'], cull_one(user, last_activity)))
-        else:
-            app_log.debug("Not culling %s (active since %s)", user['name'], last_activity)
+        if server_name is not None:
+            app_log.info(
+                "Culling server %r for %s (inactive since %s)",
+                server_name,
+                user["name"],
+                last_activity,
+            )
+            if server_name:
+                path = "/users/%s/servers/%s" % (name, quote(server_name, safe=""))
+            else:
+                path = "/users/%s/server" % name
+            await self.hub.fetch(path, method="DELETE")
+        if self.cull_users and len(user.get("servers", {})) <= 1:
+            app_log.info("Culling user %s (inactive since %s)", user["name"], last_activity)
+            await self.hub.fetch("/users/%s" % name, method="DELETE")
+
+    async def _worker(self):
+        while True:
+            func, args = await self.queue.get()
+            try:
+                await func(*args)
+            except Exception as e:
+                app_log.error("Failed to cull or check %s: %s", args[0], e)
+            finally:
+                self.queue.task_done()
+
+
+async def cull_idle(
+    url,
+    api_token,
+    timeout,
+    cull_users=False,
+    concurrency=10,
+    page_size=200,
+    request_timeout=30,
+    max_retries=3,
+):
+    """Shutdown idle single-user servers in one full pass
+    If cull_users, inactive *users* will be deleted as well.
+    """
+    hub = HubAPI(url, api_token, request_timeout, max_retries)
+    culler = IdleCuller(hub, timeout, cull_users, concurrency, page_size)
+    culler.start_workers()
+    try:
+        await culler.resync()
+    finally:
+        culler.stop_workers()
+
 
-    for (name, f) in futures:
-        yield f
-        app_log.debug("Finished culling %s", name)
+def _server_activity(user, cull_users):
+    """Yield (server_name, last_activity) for the user's servers.
+
+    last_activity is None for servers that are still starting. A user with
+    no servers yields (None, last_activity) when users are being culled.
+    """
+    servers = user.get("servers")
+    if servers is None:
+        # hub did not report per-server state, fall back on the user's activity
+        servers = {"": user} if user.get("server") else {}
+    if not servers:
+        if cull_users and user.get("last_activity"):
+            yield None, parse_hub_date(user["last_activity"])
+        return
+    for server_name, server in servers.items():
+        if server.get("pending") or not server.get("last_activity"):
+            yield server_name, None
+        else:
+            yield server_name, parse_hub_date(server["last_activity"])
 
 
 if __name__ == '__main__':
     define('url', default=os.environ.get('JUPYTERHUB_API_URL'), help="The JupyterHub API URL")
     define('timeout', default=600, help="The idle timeout (in seconds)")
-    define('cull_every', default=0, help="The interval (in seconds) for checking for idle servers to cull")
+    define('cull_every', default=0,
+           help="""The interval (in seconds) between full scans of all users.
+                Servers are otherwise re-checked individually when their idle deadline passes.
+                Defaults to the timeout.""",
+           )
     define('cull_users', default=False,
            help="""Cull users in addition to servers.
                 This is for use in temporary-user cases such as tmpnb.""",
            )
+    define('concurrency', default=10, help="The maximum number of cull requests in flight at once")
+    define('page_size', default=200, help="The number of users fetched from the hub per request")
+    define('request_timeout', default=30, help="The timeout (in seconds) for each hub API request")
+    define('max_retries', default=3, help="How often a failed hub API request is retried")
+    define('pressure_tiers', default="",
+           help="""Comma separated utilisation:factor pairs, e.g. "0.75:0.5,0.9:0.25".
+                Once cluster memory utilisation reaches a threshold, idle timeouts are
+                multiplied by its factor and the biggest idle servers are culled first.""",
+           )
+    define('node_selector', default="", help="Label selector for the nodes notebook pods run on")
+    define('sample_every', default=60, help="The interval (in seconds) between utilisation samples")
+    define('tenant_timeouts', default=False,
+           help="""Read per-tenant and per-image cull_timeout overrides from the tenant config.
+                The service needs the hub's TAPIS_* environment for this.""",
+           )
 
     parse_command_line()
     if not options.cull_every:
-        options.cull_every = options.timeout // 2
+        options.cull_every = options.timeout
 
     api_token = os.environ['JUPYTERHUB_API_TOKEN']
 
-    loop = IOLoop.current()
-    cull = lambda: cull_idle(options.url, api_token, options.timeout, options.cull_users)
-    # run once before scheduling periodic call
-    loop.run_sync(cull)
-    # schedule periodic cull
-    pc = PeriodicCallback(cull, 1e3 * options.cull_every)
-    pc.start()
+    hub = HubAPI(options.url, api_token, options.request_timeout, options.max_retries)
+    tiers = parse_tiers(options.pressure_tiers)
+    utilization = None
+    # per-image timeouts need the image of each running pod, too
+    if tiers or options.tenant_timeouts:
+        from jupyterhub.kube_client import get_core_api, get_namespace
+
+        utilization = KubernetesUtilization(
+            get_core_api(), get_namespace(), node_selector=options.node_selector
+        )
+    config_loader = None
+    if options.tenant_timeouts:
+        from jupyterhub.common import get_tenant_configs_async
+
+        config_loader = get_tenant_configs_async
+    culler = IdleCuller(
+        hub,
+        options.timeout,
+        options.cull_users,
+        options.concurrency,
+        options.page_size,
+        policy=CullPolicy(options.timeout, tiers),
+        utilization=utilization,
+        config_loader=config_loader,
+        sample_every=options.sample_every,
+    )
     try:
-        loop.start()
+        IOLoop.current().run_sync(lambda: culler.run(options.cull_every))
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,231 @@
+"""
+Idle-cull policy that tightens timeouts as the cluster fills up.
+
+The culler asks a ``CullPolicy`` how long each server may stay idle. The base
+timeout can be overridden per tenant (``cull_timeout`` in the tenant config)
+and per image (``cull_timeout`` on an entry of the tenant ``images`` list).
+As cluster memory utilisation crosses the configured pressure tiers, every
+timeout is scaled down, and the servers that are only idle past the
+shortened timeout are culled biggest first, and only until utilisation is
+projected to fall back under the lowest tier.
+
+Utilisation and per-server resources come from pluggable sources, so the
+policy can run against static stand-ins in tests.
+"""
+
+import asyncio
+import functools
+
+SINGLEUSER_SELECTOR = "component=singleuser-server"
+USERNAME_ANNOTATION = "hub.jupyter.org/username"
+SERVERNAME_ANNOTATION = "hub.jupyter.org/servername"
+
+
+class ServerResources:
+    __slots__ = ("image", "mem_limit", "cpu_limit")
+
+    def __init__(self, image=None, mem_limit=0, cpu_limit=0.0):
+        self.image = image
+        self.mem_limit = mem_limit
+        self.cpu_limit = cpu_limit
+
+
+class UtilizationSample:
+    """Memory utilisation (0-1), allocatable bytes and per-server resources.
+
+    ``resources`` maps ``(username, servername)`` to ``ServerResources``.
+    """
+
+    __slots__ = ("memory", "allocatable", "resources")
+
+    def __init__(self, memory=0.0, allocatable=0, resources=None):
+        self.memory = memory
+        self.allocatable = allocatable
+        self.resources = resources or {}
+
+
+class StaticUtilization:
+    """Utilisation source that always reports the same sample"""
+
+    def __init__(self, memory=0.0, allocatable=0, resources=None):
+        self._sample = UtilizationSample(memory, allocatable, resources)
+
+    async def sample(self):
+        return self._sample
+
+
+class KubernetesUtilization:
+    """Utilisation from the Kubernetes API.
+
+    Memory utilisation is the sum of the memory limits of running notebook
+    pods over the allocatable memory of the eligible nodes. The limits are
+    the ones ``hook`` sets on each pod; the guarantees are deliberately tiny
+    and say nothing about real usage.
+    """
+
+    def __init__(self, api, namespace, node_selector=None, pod_selector=SINGLEUSER_SELECTOR):
+        self.api = api
+        self.namespace = namespace
+        self.node_selector = node_selector
+        self.pod_selector = pod_selector
+
+    async def sample(self):
+        loop = asyncio.get_running_loop()
+        nodes, pods = await asyncio.gather(
+            loop.run_in_executor(
+                None,
+                functools.partial(self.api.list_node, label_selector=self.node_selector or ""),
+            ),
+            loop.run_in_executor(
+                None,
+                functools.partial(
+                    self.api.list_namespaced_pod,
+                    self.namespace,
+                    label_selector=self.pod_selector,
+                    field_selector="status.phase=Running",
+                ),
+            ),
+        )
+        allocatable = sum(
+            _parse_memory(n.status.allocatable["memory"])
+            for n in nodes.items
+            if n.status.allocatable and "memory" in n.status.allocatable
+        )
+        resources = {}
+        for pod in pods.items:
+            annotations = pod.metadata.annotations or {}
+            username = annotations.get(USERNAME_ANNOTATION)
+            if not username:
+                continue
+            container = pod.spec.containers[0]
+            limits = (container.resources and container.resources.limits) or {}
+            resources[(username, annotations.get(SERVERNAME_ANNOTATION, ""))] = ServerResources(
+                image=container.image,
+                mem_limit=_parse_memory(limits.get("memory")),
+                cpu_limit=_parse_cpu(limits.get("cpu")),
+            )
+        used = sum(r.mem_limit for r in resources.values())
+        memory = used / allocatable if allocatable else 0.0
+        return UtilizationSample(memory, allocatable, resources)
+
+
+class CullPolicy:
+    """Decide idle timeouts and cull order from utilisation.
+
+    ``tiers`` is a list of ``(utilisation, factor)`` pairs: once memory
+    utilisation reaches a tier's threshold, every timeout is multiplied by
+    its factor (the highest tier reached wins).
+    """
+
+    def __init__(self, timeout, tiers=None, tenant_config=None):
+        self.timeout = timeout
+        self.tiers = sorted(tiers or [])
+        self.tenant_timeout = timeout
+        self.image_timeouts = {}
+        if tenant_config:
+            self.load_tenant_config(tenant_config)
+
+    def load_tenant_config(self, tenant_config):
+        self.tenant_timeout = int(tenant_config.get("cull_timeout", self.timeout))
+        self.image_timeouts = {
+            image["name"]: int(image["cull_timeout"])
+            for image in tenant_config.get("images", [])
+            if image.get("cull_timeout")
+        }
+
+    def factor(self, utilization):
+        factor = 1.0
+        for threshold, tier_factor in self.tiers:
+            if utilization >= threshold:
+                factor = tier_factor
+        return factor
+
+    def base_timeout(self, image=None):
+        return self.image_timeouts.get(image, self.tenant_timeout)
+
+    def timeout_for(self, image, utilization):
+        return self.base_timeout(image) * self.factor(utilization)
+
+    def shortest_timeout(self, utilization):
+        """The shortest timeout any server can get at this utilisation"""
+        return min([self.tenant_timeout, *self.image_timeouts.values()]) * self.factor(
+            utilization
+        )
+
+    def select(self, candidates, utilization, total_memory=None):
+        """Order idle candidates and drop the ones that need not be culled yet.
+
+        ``candidates`` are ``(idle_seconds, resources, item)`` tuples for
+        servers idle past their pressure-adjusted timeout. Servers idle past
+        their base timeout are always culled. The rest are culled biggest
+        (memory, then cpu) first, until the memory they free brings
+        utilisation under the lowest tier, when ``total_memory`` is known.
+        Returns ``(to_cull, deferred)`` lists of items.
+        """
+        to_cull = []
+        pressure = []
+        for idle, resources, item in candidates:
+            if idle >= self.base_timeout(resources.image):
+                to_cull.append((resources, item))
+            else:
+                pressure.append((resources, item))
+        to_cull.sort(key=lambda c: (c[0].mem_limit, c[0].cpu_limit), reverse=True)
+        pressure.sort(key=lambda c: (c[0].mem_limit, c[0].cpu_limit), reverse=True)
+
+        deferred = []
+        if pressure and self.tiers and total_memory:
+            target = self.tiers[0][0]
+            projected = utilization - sum(r.mem_limit for r, _ in to_cull) / total_memory
+            for resources, item in pressure:
+                if projected < target:
+                    deferred.append(item)
+                    continue
+                to_cull.append((resources, item))
+                projected -= resources.mem_limit / total_memory
+        else:
+            to_cull.extend(pressure)
+        return [item for _, item in to_cull], deferred
+
+
+def parse_tiers(value):
+    """Parse "0.75:0.5,0.9:0.25" into [(0.75, 0.5), (0.9, 0.25)]"""
+    tiers = []
+    for part in filter(None, (p.strip() for p in value.split(","))):
+        threshold, factor = part.split(":")
+        tiers.append((float(threshold), float(factor)))
+    return tiers
+
+
+QUANTITY_SUFFIXES = {
+    "Ki": 2 ** 10,
+    "Mi": 2 ** 20,
+    "Gi": 2 ** 30,
+    "Ti": 2 ** 40,
+    "Pi": 2 ** 50,
+    "k": 10 ** 3,
+    "M": 10 ** 6,
+    "G": 10 ** 9,
+    "T": 10 ** 12,
+    "P": 10 ** 15,
+}
+
+
+def _parse_memory(value):
+    """Bytes in a Kubernetes memory quantity such as 512Mi or 4G"""
+    if not value:
+        return 0
+    value = str(value)
+    for suffix, multiplier in QUANTITY_SUFFIXES.items():
+        if value.endswith(suffix):
+            return int(float(value[: -len(suffix)]) * multiplier)
+    return int(float(value))
+
+
+def _parse_cpu(value):
+    """Cores in a Kubernetes cpu quantity such as 500m or 2"""
+    if not value:
+        return 0.0
+    value = str(value)
+    if value.endswith("m"):
+        return float(value[:-1]) / 1000
+    return float(value)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""Garbage collect stopped notebook pods and unused per-user configmaps.
+
+With c.KubeSpawner.delete_stopped_pods = False, pods whose notebook exited on
+its own stay behind in the Succeeded or Failed phase, and the credentials
+configmaps written at login are never removed. Both slow down every list
+against the API server as they pile up.
+
+This service finds, by label selector (by default limited to this hub's
+``tenant`` and ``instance`` labels, so it leaves alone the objects of other
+hubs sharing the namespace):
+
+- stopped pods (Succeeded/Failed) that finished more than --retention
+  seconds ago and whose user has no active server
+- configmaps labelled with a username whose user has no active server and
+  has not been active for --retention seconds (users the hub no longer
+  knows about fall back on the configmap's creation time)
+
+and deletes them in batches of --batch_size, pausing --batch_interval
+seconds between batches, then logs how many objects were reclaimed.
+Run it as a hub service::
+
+    c.JupyterHub.services = [
+        {
+            'name': 'gc',
+            'admin': True,
+            'command': 'python /srv/jupyterhub/gc_service.py --retention=604800'.split(),
+        }
+    ]
+
+The hub re-reads a configmap before trusting its remembered content hash
+(see CONFIGMAP_VERIFY_AFTER in kube_client.py), so a user coming back after
+their configmap was collected gets it written again on spawn.
+"""
+
+import asyncio
+import datetime
+import os
+
+from kubernetes.client import ApiException
+from tornado.log import app_log
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+from jupyterhub.blocking import run_blocking
+from jupyterhub.cull_policy import SINGLEUSER_SELECTOR, USERNAME_ANNOTATION
+from jupyterhub.hub_api import HubAPI, parse_hub_date, utcnow
+from jupyterhub.kube_client import get_core_api, get_namespace, hub_selector
+
+STOPPED_PHASES = {"Succeeded", "Failed"}
+# label write_credentials_configmap puts on every per-user configmap
+CONFIGMAP_USERNAME_LABEL = "username"
+
+
+class GarbageCollector:
+    def __init__(
+        self,
+        hub,
+        api,
+        namespace,
+        retention,
+        pod_selector=None,
+        configmap_selector=None,
+        batch_size=20,
+        batch_interval=1.0,
+        page_size=200,
+        dry_run=False,
+    ):
+        self.hub = hub
+        self.api = api
+        self.namespace = namespace
+        self.retention = datetime.timedelta(seconds=retention)
+        self.pod_selector = pod_selector or hub_selector(SINGLEUSER_SELECTOR)
+        self.configmap_selector = configmap_selector or hub_selector(CONFIGMAP_USERNAME_LABEL)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.page_size = page_size
+        self.dry_run = dry_run
+
+    async def collect(self):
+        """Run one collection pass and return the reclaimed counts"""
+        active, last_activity = await self.user_activity()
+        cutoff = utcnow() - self.retention
+        pods, configmaps = await asyncio.gather(
+            run_blocking(
+                self.api.list_namespaced_pod,
+                self.namespace,
+                label_selector=self.pod_selector,
+            ),
+            run_blocking(
+                self.api.list_namespaced_config_map,
+                self.namespace,
+                label_selector=self.configmap_selector,
+            ),
+        )
+        stale_pods = [
+            pod for pod in pods.items if self._pod_is_stale(pod, active, cutoff)
+        ]
+        stale_configmaps = [
+            cm
+            for cm in configmaps.items
+            if self._configmap_is_stale(cm, active, last_activity, cutoff)
+        ]
+        app_log.info(
+            "Found %i stale pods of %i and %i stale configmaps of %i",
+            len(stale_pods),
+            len(pods.items),
+            len(stale_configmaps),
+            len(configmaps.items),
+        )
+        reclaimed = {
+            "pods": await self.delete_in_batches(
+                "pod", stale_pods, self.api.delete_namespaced_pod
+            ),
+            "configmaps": await self.delete_in_batches(
+                "configmap", stale_configmaps, self.api.delete_namespaced_config_map
+            ),
+        }
+        app_log.info(
+            "%s %i pods and %i configmaps",
+            "Would reclaim" if self.dry_run else "Reclaimed",
+            reclaimed["pods"],
+            reclaimed["configmaps"],
+        )
+        return reclaimed
+
+    async def user_activity(self):
+        """Return the users with an active server, and every user's last activity"""
+        active = set()
+        last_activity = {}
+        async for users in self.hub.iter_user_pages(None, self.page_size):
+            for user in users:
+                if user.get("last_activity"):
+                    last_activity[user["name"]] = parse_hub_date(user["last_activity"])
+                servers = user.get("servers")
+                if servers is None:
+                    servers = {"": user} if user.get("server") else {}
+                if servers:
+                    active.add(user["name"])
+        return active, last_activity
+
+    def _pod_is_stale(self, pod, active, cutoff):
+        if pod.status.phase not in STOPPED_PHASES:
+            return False
+        username = (pod.metadata.annotations or {}).get(USERNAME_ANNOTATION)
+        if username in active:
+            return False
+        return _pod_finished_at(pod) < cutoff
+
+    def _configmap_is_stale(self, configmap, active, last_activity, cutoff):
+        username = (configmap.metadata.labels or {}).get(CONFIGMAP_USERNAME_LABEL)
+        if not username or username in active:
+            return False
+        seen = last_activity.get(username, configmap.metadata.creation_timestamp)
+        return seen < cutoff
+
+    async def delete_in_batches(self, kind, objects, delete):
+        """Delete objects batch_size at a time, returning how many were deleted"""
+        reclaimed = 0
+        for start in range(0, len(objects), self.batch_size):
+            if start:
+                await asyncio.sleep(self.batch_interval)
+            batch = objects[start : start + self.batch_size]
+            if self.dry_run:
+                for obj in batch:
+                    app_log.info("Would delete %s %s", kind, obj.metadata.name)
+                reclaimed += len(batch)
+                continue
+            results = await asyncio.gather(
+                *(run_blocking(delete, obj.metadata.name, self.namespace) for obj in batch),
+                return_exceptions=True,
+            )
+            for obj, result in zip(batch, results):
+                if isinstance(result, ApiException) and result.status == 404:
+                    # already gone
+                    continue
+                if isinstance(result, Exception):
+                    app_log.error("Failed to delete %s %s: %s", kind, obj.metadata.name, result)
+                    continue
+                app_log.debug("Deleted %s %s", kind, obj.metadata.name)
+                reclaimed += 1
+        return reclaimed
+
+def _pod_finished_at(pod):
+    """When the pod's containers last terminated, or when it was created"""
+    finished = [
+        status.state.terminated.finished_at
+        for status in (pod.status.container_statuses or [])
+        if status.state and status.state.terminated and status.state.terminated.finished_at
+    ]
+    return max(finished) if finished else pod.metadata.creation_timestamp
+
+
+async def run(collector, gc_every, once=False):
+    while True:
+        try:
+            await collector.collect()
+        except Exception as e:
+            app_log.error("Garbage collection failed: %s", e)
+        if once:
+            return
+        await asyncio.sleep(gc_every)
+
+
+if __name__ == '__main__':
+    define('url', default=os.environ.get('JUPYTERHUB_API_URL'), help="The JupyterHub API URL")
+    define('retention', default=7 * 24 * 60 * 60,
+           help="How long (in seconds) stopped pods and unused configmaps are kept")
+    define('gc_every', default=60 * 60, help="The interval (in seconds) between collections")
+    define('pod_selector', default="",
+           help="Label selector for notebook pods, by default this hub's tenant and instance")
+    define('configmap_selector', default="",
+           help="Label selector for per-user configmaps, by default this hub's tenant and instance")
+    define('batch_size', default=20, help="The number of objects deleted at once")
+    define('batch_interval', default=1.0, help="The pause (in seconds) between delete batches")
+    define('page_size', default=200, help="The number of users fetched from the hub per request")
+    define('dry_run', default=False, help="Only log what would be deleted")
+    define('once', default=False, help="Run a single collection and exit")
+
+    parse_command_line()
+
+    api_token = os.environ['JUPYTERHUB_API_TOKEN']
+    if not (options.pod_selector and options.configmap_selector) and not (
+        os.environ.get("TENANT") and os.environ.get("INSTANCE")
+    ):
+        raise Exception("TENANT and INSTANCE are needed to select this hub's objects.")
+
+    collector = GarbageCollector(
+        HubAPI(options.url, api_token),
+        get_core_api(),
+        get_namespace(),
+        options.retention,
+        pod_selector=options.pod_selector,
+        configmap_selector=options.configmap_selector,
+        batch_size=options.batch_size,
+        batch_interval=options.batch_interval,
+        page_size=options.page_size,
+        dry_run=options.dry_run,
+    )
+    try:
+        IOLoop.current().run_sync(lambda: run(collector, options.gc_every, options.once))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,82 @@
+"""
+Hub REST API client and date helpers shared by the hub services.
+"""
+
+import asyncio
+import datetime
+import json
+from urllib.parse import urlencode
+
+from dateutil.parser import parse as parse_date
+
+from tornado.log import app_log
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+PAGINATION_MEDIA_TYPE = "application/jupyterhub-pagination+json"
+# status codes worth retrying: timeouts/connection errors (599), throttling and hub errors
+RETRY_STATUSES = {429, 500, 502, 503, 504, 599}
+
+
+class HubAPI:
+    """Minimal hub API client with per-request timeouts and retries"""
+
+    def __init__(self, url, api_token, request_timeout=30, max_retries=3):
+        self.url = url.rstrip("/")
+        self.auth_header = {"Authorization": "token %s" % api_token}
+        self.request_timeout = request_timeout
+        self.max_retries = max_retries
+        self.client = AsyncHTTPClient()
+
+    async def fetch(self, path, method="GET", headers=None):
+        req = HTTPRequest(
+            url=self.url + path,
+            method=method,
+            headers={**self.auth_header, **(headers or {})},
+            request_timeout=self.request_timeout,
+        )
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.client.fetch(req)
+            except HTTPClientError as e:
+                if e.code not in RETRY_STATUSES or attempt == self.max_retries:
+                    raise
+                delay = 2 ** attempt
+                app_log.warning(
+                    "%s %s failed with %s, retrying in %ss", method, path, e.code, delay
+                )
+                await asyncio.sleep(delay)
+
+    async def iter_user_pages(self, state, page_size):
+        """Yield the users in the given server state (all users if None), one page at a time"""
+        offset = 0
+        while True:
+            params = {"offset": offset, "limit": page_size}
+            if state:
+                params["state"] = state
+            query = urlencode(params)
+            resp = await self.fetch(
+                "/users?" + query, headers={"Accept": PAGINATION_MEDIA_TYPE}
+            )
+            page = json.loads(resp.body.decode("utf8", "replace"))
+            if isinstance(page, list):
+                # hub without pagination support returned everything at once
+                yield page
+                return
+            yield page["items"]
+            next_page = page.get("_pagination", {}).get("next")
+            if not next_page:
+                return
+            offset = next_page["offset"]
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def parse_hub_date(value):
+    """Parse a timestamp from the hub API as an aware datetime"""
+    date = parse_date(value)
+    if date.tzinfo is None:
+        # the hub reports UTC
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
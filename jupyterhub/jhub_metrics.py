@@ -0,0 +1,143 @@
+"""
+Prometheus metrics for the TACC JupyterHub customizations.
+
+The metrics are registered in the default prometheus_client registry, so the
+hub serves them on its own /hub/metrics endpoint next to the built-in
+JupyterHub metrics.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# every hub metric carries the hub's tenant and instance, so dashboards over
+# several hubs can tell them apart
+TENANT_LABELS = {
+    "tenant": os.environ.get("TENANT", ""),
+    "instance": os.environ.get("INSTANCE", ""),
+}
+# upstream calls time out after 5-15s, so the buckets reach past that
+UPSTREAM_BUCKETS = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, float("inf")
+]
+
+CACHE_REQUESTS = Counter(
+    "jhub_cache_requests",
+    "Lookups served by the in-process caches, by result (hit, negative, stale, miss)",
+    ["tenant", "instance", "cache", "result"],
+)
+
+CACHE_SERVED_AGE = Histogram(
+    "jhub_cache_served_age_seconds",
+    "Age of the cached value at the time it was served",
+    ["tenant", "instance", "cache"],
+    buckets=[1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, float("inf")],
+)
+
+CACHE_REFRESHES = Counter(
+    "jhub_cache_refreshes",
+    "Background cache refreshes, by outcome (reloaded, unchanged, failed)",
+    ["tenant", "instance", "cache", "outcome"],
+)
+
+LDAP_LATENCY = Histogram(
+    "jhub_ldap_latency_seconds",
+    "Time spent in LDAP operations, by operation (bind, search)",
+    ["tenant", "instance", "operation"],
+)
+
+LDAP_POOL_SIZE = Gauge(
+    "jhub_ldap_pool_size",
+    "Maximum number of pooled LDAP connections",
+    ["tenant", "instance"],
+)
+
+LDAP_POOL_IN_USE = Gauge(
+    "jhub_ldap_pool_in_use",
+    "Pooled LDAP connections currently checked out",
+    ["tenant", "instance"],
+)
+
+LDAP_POOL_WAIT = Histogram(
+    "jhub_ldap_pool_wait_seconds",
+    "Time spent waiting for a free pooled LDAP connection",
+    ["tenant", "instance"],
+)
+
+LOGIN_CALLBACK_DURATION = Histogram(
+    "jhub_login_callback_duration_seconds",
+    "Time to handle the OAuth callback, from code exchange to saved tokens",
+    ["tenant", "instance", "status"],
+)
+
+SPAWN_PHASE_DURATION = Histogram(
+    "jhub_spawn_phase_duration_seconds",
+    "Time spent in each phase of the spawn hook (configs, token_file, tas, ldap, "
+    "credentials_configmap, v2_token, projects, profile, limits, mounts, warm_pool)",
+    ["tenant", "instance", "phase"],
+    buckets=UPSTREAM_BUCKETS,
+)
+
+LOGIN_PHASE_DURATION = Histogram(
+    "jhub_login_phase_duration_seconds",
+    "Time spent in each step of the login callback (token_post, token_files, configmap_write)",
+    ["tenant", "instance", "phase"],
+    buckets=UPSTREAM_BUCKETS,
+)
+
+META_REQUEST_DURATION = Histogram(
+    "jhub_meta_request_duration_seconds",
+    "Time spent on Tapis meta requests, by lookup (tenant_configs, tenant_configs_version, user_configs, "
+    "all_user_configs)",
+    ["tenant", "instance", "lookup"],
+    buckets=UPSTREAM_BUCKETS,
+)
+
+IMAGE_CACHED_FRACTION = Gauge(
+    "jhub_image_cached_fraction",
+    "Fraction of the nodes eligible for a catalog image that have it cached",
+    ["image"],
+)
+
+WARM_POOL_TARGET = Gauge(
+    "jhub_warm_pool_target",
+    "Placeholder pods the warm pool keeps for a spawn profile",
+    ["profile"],
+)
+
+WARM_POOL_CLAIMS = Counter(
+    "jhub_warm_pool_claims",
+    "Spawns that found a warm placeholder for their profile (hit) or not (miss)",
+    ["result"],
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "jhub_admission_queue_depth",
+    "Spawns waiting for admission, by queue (spawn, or the upstream they wait on)",
+    ["tenant", "instance", "queue"],
+)
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "jhub_admission_in_flight",
+    "Spawns holding an admission slot, by queue",
+    ["tenant", "instance", "queue"],
+)
+
+ADMISSION_WAIT = Histogram(
+    "jhub_admission_wait_seconds",
+    "Time spent queued for admission, by queue",
+    ["tenant", "instance", "queue"],
+    buckets=UPSTREAM_BUCKETS,
+)
+
+
+@contextmanager
+def time_phase(histogram, **labels):
+    """Observe the time spent in the block on histogram, with the tenant labels"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(**TENANT_LABELS, **labels).observe(time.perf_counter() - start)
@@ -1,8 +1,12 @@
 # Configuration file for jupyterhub.
-from jupyterhub.spawner_hooks import hook, get_notebook_options, parse_form_data
+from jupyterhub.spawner_hooks import hook, get_notebook_options, parse_form_data, start_warm_pool
 from oauthenticator.tapis import TapisOAuthenticator
+from jupyterhub import admin_handlers
+from jupyterhub.tapis_spawner import TapisKubeSpawner
 import os
 
+from tornado.ioloop import IOLoop
+
 from jupyterhub.common import get_tenant_configs
 
 CONFIGS = get_tenant_configs()
@@ -163,6 +167,11 @@ c.Authenticator.admin_users = CONFIGS.get("admin_users", [])
 #
 #  If set to 0, no limit is enforced.
 # c.JupyterHub.concurrent_spawn_limit = 100
+# Spawns queued for admission (SPAWN_ADMISSION_LIMIT, see admission.py) count as
+# pending here, so the hub-wide cap is off by default and bursts queue instead of
+# getting a 429. Set CONCURRENT_SPAWN_LIMIT to cap the queue as well; keep it
+# well above SPAWN_ADMISSION_LIMIT.
+c.JupyterHub.concurrent_spawn_limit = int(os.environ.get("CONCURRENT_SPAWN_LIMIT", 0))
 
 # The config file to load
 # c.JupyterHub.config_file = 'jupyterhub_config.py'
@@ -210,6 +219,7 @@ c.Authenticator.admin_users = CONFIGS.get("admin_users", [])
 #
 #  The Hub prefix will be added, so `/my-page` will be served at `/hub/my-page`.
 # c.JupyterHub.extra_handlers = []
+c.JupyterHub.extra_handlers = admin_handlers.default_handlers
 
 # DEPRECATED: use output redirection instead, e.g.
 #
@@ -395,7 +405,8 @@ c.JupyterHub.services = CONFIGS.get("services", [])
 #
 #  Should be a subclass of Spawner.
 # c.JupyterHub.spawner_class = 'jupyterhub.spawner.LocalProcessSpawner'
-c.JupyterHub.spawner_class = "kubespawner.KubeSpawner"
+# KubeSpawner with spawn admission control; c.KubeSpawner settings still apply
+c.JupyterHub.spawner_class = TapisKubeSpawner
 
 # Path to SSL certificate file for the public facing interface of the proxy
 #
@@ -991,4 +1002,7 @@ c.KubeSpawner.delete_stopped_pods = False
 # setup
 c.KubeSpawner.pre_spawn_hook = hook
 c.KubeSpawner.options_form = get_notebook_options
-c.KubeSpawner.options_from_form = parse_form_data
\ No newline at end of file
+c.KubeSpawner.options_from_form = parse_form_data
+
+# the config is loaded on the hub's event loop, so the warm pool starts with the hub
+IOLoop.current().add_callback(start_warm_pool)
\ No newline at end of file
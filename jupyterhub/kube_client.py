@@ -0,0 +1,202 @@
+"""
+Process-wide Kubernetes API clients for the hub and its services.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from kubernetes import client, config
+
+from jupyterhub.blocking import blocking_workers
+
+SERVICE_ACCOUNT_DIR = "/run/secrets/kubernetes.io/serviceaccount"
+CONTENT_HASH_ANNOTATION = "jhub.tacc.utexas.edu/content-hash"
+# set on notebook pods to tell apart how their credentials were delivered
+CREDENTIALS_MODE_LABEL = "hub.jupyter.org/credentials-mode"
+# how long a remembered content hash is trusted before the configmap is read
+# back, so one removed by the GC service is written again
+CONFIGMAP_VERIFY_AFTER = int(os.environ.get("CONFIGMAP_VERIFY_AFTER", 3600))
+
+_lock = threading.Lock()
+_api_client = None
+_namespace = None
+
+
+def get_api_client():
+    """Return the shared ApiClient, creating it on first use.
+
+    The client keeps a pooled connection to the API server, and the in-cluster
+    config re-reads the service account token when it is rotated.
+    """
+    global _api_client
+    with _lock:
+        if _api_client is None:
+            configuration = client.Configuration()
+            config.load_incluster_config(client_configuration=configuration)
+            # one pooled connection per thread that may call the API at once
+            configuration.connection_pool_maxsize = blocking_workers
+            _api_client = client.ApiClient(configuration)
+        return _api_client
+
+
+def set_api_client(api_client, namespace=None):
+    """Use the given ApiClient (and namespace) instead of the in-cluster one"""
+    global _api_client, _namespace
+    with _lock:
+        _api_client = api_client
+        if namespace is not None:
+            _namespace = namespace
+
+
+def get_core_api():
+    return client.CoreV1Api(get_api_client())
+
+
+def get_apps_api():
+    return client.AppsV1Api(get_api_client())
+
+
+def get_namespace():
+    global _namespace
+    with _lock:
+        if _namespace is None:
+            with open(os.path.join(SERVICE_ACCOUNT_DIR, "namespace")) as f:
+                _namespace = f.read().strip()
+        return _namespace
+
+
+def hub_labels():
+    """The tenant and instance labels that tell this hub's objects from other hubs'"""
+    return {
+        "tenant": os.environ.get("TENANT", ""),
+        "instance": os.environ.get("INSTANCE", ""),
+    }
+
+
+def hub_selector(*selectors):
+    """A label selector for this hub's objects, narrowed by any extra selectors"""
+    terms = ["{}={}".format(k, v) for k, v in sorted(hub_labels().items())]
+    return ",".join(terms + [s for s in selectors if s])
+
+
+def content_hash(data):
+    """Stable hash of a configmap's data, stored as an annotation"""
+    digest = hashlib.sha256()
+    for key in sorted(data):
+        digest.update(key.encode("utf8"))
+        digest.update(b"\0")
+        digest.update(str(data[key]).encode("utf8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+_applied_hashes = {}
+_hashes_lock = threading.Lock()
+_hashes_swept_at = time.monotonic()
+_seeded_selectors = set()
+
+
+def _expire_applied_hashes():
+    """Forget hashes not written or verified within CONFIGMAP_VERIFY_AFTER.
+
+    They would be read back before being trusted anyway, so dropping them
+    keeps the map to the recently active users. Runs at most once per
+    CONFIGMAP_VERIFY_AFTER.
+    """
+    global _hashes_swept_at
+    now = time.monotonic()
+    with _hashes_lock:
+        if now - _hashes_swept_at < CONFIGMAP_VERIFY_AFTER:
+            return
+        _hashes_swept_at = now
+        for name, (_, applied_at) in list(_applied_hashes.items()):
+            if now - applied_at >= CONFIGMAP_VERIFY_AFTER:
+                del _applied_hashes[name]
+
+
+def upsert_configmap(name, data, labels, log, seed_selector=None):
+    """Create or replace a configmap with one API call, skipping unchanged data.
+
+    The content hash of the data is kept as an annotation. When the hash last
+    written for this configmap matches, no write is made at all; otherwise
+    the configmap is replaced, or created if it does not exist yet. The
+    first call for a ``seed_selector`` lists the matching configmaps once to
+    learn their hashes, so a restarted hub still skips unchanged writes.
+    Hashes not written within ``CONFIGMAP_VERIFY_AFTER`` seconds are checked
+    against the configmap with a read before a write is skipped.
+    """
+    namespace = get_namespace()
+    api = get_core_api()
+    if seed_selector and seed_selector not in _seeded_selectors:
+        _seed_applied_hashes(api, namespace, seed_selector)
+    _expire_applied_hashes()
+    digest = content_hash(data)
+    applied = _applied_hashes.get(name)
+    if applied and applied[0] == digest:
+        unchanged = time.monotonic() - applied[1] < CONFIGMAP_VERIFY_AFTER
+        if not unchanged and _read_content_hash(api, namespace, name) == digest:
+            _applied_hashes[name] = (digest, time.monotonic())
+            unchanged = True
+        if unchanged:
+            log.info("{} configmap unchanged, skipping write".format(name))
+            return False
+
+    body = client.V1ConfigMap(
+        data=data,
+        metadata=client.V1ObjectMeta(
+            name=name,
+            labels=labels,
+            annotations={CONTENT_HASH_ANNOTATION: digest},
+        ),
+    )
+    try:
+        api.replace_namespaced_config_map(name, namespace, body)
+        log.info("{} configmap replaced".format(name))
+    except client.ApiException as e:
+        if e.status != 404:
+            raise
+        api.create_namespaced_config_map(namespace, body)
+        log.info("{} configmap created".format(name))
+    _applied_hashes[name] = (digest, time.monotonic())
+    return True
+
+
+def _read_content_hash(api, namespace, name):
+    try:
+        configmap = api.read_namespaced_config_map(name, namespace)
+    except client.ApiException as e:
+        if e.status != 404:
+            raise
+        return None
+    return (configmap.metadata.annotations or {}).get(CONTENT_HASH_ANNOTATION)
+
+
+def _seed_applied_hashes(api, namespace, label_selector):
+    configmaps = api.list_namespaced_config_map(
+        namespace, label_selector=label_selector
+    )
+    for configmap in configmaps.items:
+        annotations = configmap.metadata.annotations or {}
+        if CONTENT_HASH_ANNOTATION in annotations:
+            # never trusted without a read, the GC service may remove it
+            _applied_hashes.setdefault(
+                configmap.metadata.name,
+                (annotations[CONTENT_HASH_ANNOTATION], float("-inf")),
+            )
+    _seeded_selectors.add(label_selector)
+
+
+def write_credentials_configmap(username, data, log):
+    """Upsert the configmap holding a user's .agpy and current files"""
+    # imported here so hub services can use this module without the Tapis env
+    from jupyterhub.common import get_credentials_configmap_name
+
+    configmap_name = get_credentials_configmap_name(username)
+    labels = {
+        "app": configmap_name,
+        **hub_labels(),
+        "username": username,
+    }
+    return upsert_configmap(configmap_name, data, labels, log, seed_selector=hub_selector())
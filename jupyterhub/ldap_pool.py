@@ -0,0 +1,117 @@
+"""
+Bounded pool of long-lived, bound ldap3 connections.
+"""
+
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from ldap3 import Connection, SAFE_SYNC, Server
+from ldap3.core.exceptions import LDAPException
+
+from jupyterhub.jhub_metrics import (
+    LDAP_LATENCY,
+    LDAP_POOL_IN_USE,
+    LDAP_POOL_SIZE,
+    LDAP_POOL_WAIT,
+    TENANT_LABELS,
+)
+
+
+class LDAPConnectionPool:
+    """Hand out at most ``size`` bound connections, reusing idle ones.
+
+    Connections stay open between searches, so a search only pays the TLS
+    handshake and bind when a connection is first opened or has been dropped
+    by the server. A connection that fails is thrown away and the search is
+    retried once on a freshly bound one.
+    """
+
+    def __init__(self, url, bind_dn, password, size=8, timeout=10):
+        self.server = Server(url, connect_timeout=timeout)
+        self.bind_dn = bind_dn
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._in_use = 0
+        self._lock = threading.Lock()
+        LDAP_POOL_SIZE.labels(**TENANT_LABELS).set(size)
+
+    def search(self, base, search_filter, attributes):
+        """Run a search and return its response entries"""
+        for attempt in (1, 2):
+            try:
+                with self.connection() as conn:
+                    start = time.perf_counter()
+                    status, result, response, _ = conn.search(
+                        base, search_filter, attributes=attributes
+                    )
+                    LDAP_LATENCY.labels(**TENANT_LABELS, operation="search").observe(
+                        time.perf_counter() - start
+                    )
+                    return response
+            except LDAPException:
+                if attempt == 2:
+                    raise
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise LDAPException(
+                f"no LDAP connection free after {self.timeout}s ({self.size} in use)"
+            )
+        LDAP_POOL_WAIT.labels(**TENANT_LABELS).observe(time.perf_counter() - start)
+        self._track_in_use(1)
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except LDAPException:
+            if conn is not None:
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._idle.put(conn)
+            self._track_in_use(-1)
+            self._slots.release()
+
+    def _checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+        if conn is not None and not conn.closed and conn.bound:
+            return conn
+        if conn is not None:
+            self._discard(conn)
+        return self._connect()
+
+    def _connect(self):
+        start = time.perf_counter()
+        conn = Connection(
+            self.server,
+            self.bind_dn,
+            self.password,
+            client_strategy=SAFE_SYNC,
+            auto_bind=True,
+            receive_timeout=self.timeout,
+        )
+        LDAP_LATENCY.labels(**TENANT_LABELS, operation="bind").observe(time.perf_counter() - start)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+
+    def _track_in_use(self, delta):
+        with self._lock:
+            self._in_use += delta
+            LDAP_POOL_IN_USE.labels(**TENANT_LABELS).set(self._in_use)
@@ -0,0 +1,84 @@
+"""
+Volume mount plans, compiled once per config version and rendered per user.
+
+A plan holds the tenant config's volume mounts followed by the user and
+group config mounts that are not already in it, deduplicated by each mount's
+content key. Mount paths are split into their literal text and template
+fields when the plan is compiled, and the volume and volumeMount entries are
+prebuilt, so rendering a plan for a user only fills in the templated paths.
+Plans are shared by every spawner with the same config versions; rendering
+returns fresh lists and never changes the plan.
+"""
+
+import os
+import string
+from collections import OrderedDict
+
+from jupyterhub.caching import LRUCache
+
+# plans kept, one per distinct (tenant config version, user configs version)
+MOUNT_PLAN_CACHE_SIZE = int(os.environ.get("MOUNT_PLAN_CACHE_SIZE", 4096))
+# mounted only for users whose TAS gid is not 0
+ROOT_GID_EXCLUDED_PATH = "/work2/{tas_homedir}"
+
+_formatter = string.Formatter()
+
+
+class MountTemplate:
+    """One volume mount with its path template parsed"""
+
+    __slots__ = ("mount", "fields", "volume", "volume_mount", "root_gid_excluded")
+
+    def __init__(self, mount):
+        self.mount = mount
+        parsed = list(_formatter.parse(mount.path))
+        self.fields = tuple(field for _, field, _, _ in parsed if field is not None)
+        volume = {"readOnly": mount.read_only}
+        if mount.type == "nfs":
+            volume["server"] = mount.server
+        if not self.fields:
+            volume["path"] = mount.path
+        self.volume = volume
+        self.volume_mount = {"mountPath": mount.mount_path, "name": mount.name}
+        self.root_gid_excluded = mount.path == ROOT_GID_EXCLUDED_PATH
+
+    def render(self, template_vars):
+        volume = dict(self.volume)
+        if self.fields:
+            volume["path"] = self.mount.path.format(**template_vars)
+        return {"name": self.mount.name, self.mount.type: volume}, dict(self.volume_mount)
+
+
+class MountPlan:
+    """The deduplicated volume mounts of a tenant config and a user's configs"""
+
+    def __init__(self, tenant_model, user_models):
+        mounts = OrderedDict()
+        for model in (tenant_model,) + tuple(user_models):
+            for mount in model.volume_mounts:
+                mounts.setdefault(mount.key, mount)
+        self.templates = tuple(MountTemplate(mount) for mount in mounts.values())
+
+    def __len__(self):
+        return len(self.templates)
+
+    def render(self, template_vars, init_gid=None):
+        """Fresh volumes and volume_mounts lists for one user"""
+        volumes = []
+        volume_mounts = []
+        for template in self.templates:
+            if template.root_gid_excluded and init_gid == 0:
+                continue
+            volume, volume_mount = template.render(template_vars)
+            volumes.append(volume)
+            volume_mounts.append(volume_mount)
+        return volumes, volume_mounts
+
+
+_plans = LRUCache(MOUNT_PLAN_CACHE_SIZE)
+
+
+def get_mount_plan(tenant_model, tenant_version, user_models, user_version):
+    """Return the plan for these config versions, compiling it on first use"""
+    key = (tenant_version, user_version) if tenant_version is not None else None
+    return _plans.get(key, lambda: MountPlan(tenant_model, user_models))
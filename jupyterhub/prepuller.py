@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""Keep the catalog images pulled on the nodes notebook pods can land on.
+
+A spawn whose image is not cached on its node waits for the pull, which for
+the larger notebook images takes most of the start timeout. This service
+builds the same image catalog as the options form (catalog.py) from the
+tenant config and every user and group config, and keeps one DaemonSet per
+placement running. A placement is an image's ``extra_pod_config``
+nodeSelector and tolerations, merged with --node_selector. Each DaemonSet
+pod pulls the placement's images as init containers and then idles in a
+pause container, so every matching node, including new ones, has them
+cached.
+
+The DaemonSets carry this hub's ``tenant`` and ``instance`` labels, in their
+names too, so the prepullers of several hubs can share a namespace without
+replacing or deleting each other's DaemonSets.
+
+The DaemonSet template carries a hash of its images. When a tag changes in
+the catalog the hash changes, the DaemonSet is replaced and its pods roll
+over, pulling the new tag. With --repull_every the pods also roll over on
+that interval with imagePullPolicy Always, to refresh mutable tags. Images
+that leave the catalog are dropped from their DaemonSet, and DaemonSets
+for placements no longer in use are deleted.
+
+After every sync the fraction of eligible nodes that have each image cached
+(from the node status image list) is logged and exported as the
+``jhub_image_cached_fraction{image}`` gauge, served on --metrics_port.
+Run it as a hub service with the hub's TAPIS_SERVICE_TOKEN, TENANT and
+INSTANCE in its environment::
+
+    c.JupyterHub.services = [
+        {
+            'name': 'prepuller',
+            'command': 'python /srv/jupyterhub/prepuller.py --node_selector=jupyter=true'.split(),
+        }
+    ]
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import time
+
+from kubernetes import client
+from tornado.log import app_log
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+from jupyterhub.blocking import run_blocking
+from jupyterhub.jhub_metrics import IMAGE_CACHED_FRACTION
+from jupyterhub.kube_client import content_hash, hub_labels, hub_selector
+
+PREPULLER_LABELS = {"app": "jhub-prepuller", "component": "image-prepuller"}
+PREPULLER_SELECTOR = "component=image-prepuller"
+IMAGES_HASH_ANNOTATION = "jhub.tacc.utexas.edu/images-hash"
+PLACEMENT_ANNOTATION = "jhub.tacc.utexas.edu/placement"
+PAUSE_IMAGE = "registry.k8s.io/pause:3.9"
+DEFAULT_REGISTRY = "docker.io"
+
+
+class Placement:
+    """Where an image's notebook pods may run: a nodeSelector plus tolerations"""
+
+    def __init__(self, node_selector=None, tolerations=None, hub=None):
+        self.node_selector = dict(sorted((node_selector or {}).items()))
+        self.tolerations = sorted(
+            (tolerations or []), key=lambda t: json.dumps(t, sort_keys=True)
+        )
+        self.key = json.dumps([self.node_selector, self.tolerations], sort_keys=True)
+        hub = hub_labels() if hub is None else hub
+        owner = json.dumps(hub, sort_keys=True)
+        digest = hashlib.sha256((owner + self.key).encode("utf8")).hexdigest()[:10]
+        self.name = "-".join(
+            part for part in ("jhub-prepuller", _name_part(hub), digest) if part
+        )
+
+    def matches(self, node):
+        labels = node.metadata.labels or {}
+        return all(labels.get(k) == v for k, v in self.node_selector.items())
+
+
+def _name_part(hub):
+    """The hub's tenant and instance, shortened to fit in a DaemonSet name"""
+    part = "-".join(v for _, v in sorted(hub.items()) if v).lower()
+    return re.sub(r"[^a-z0-9-]+", "-", part)[:30].strip("-")
+
+
+def pull_plan(catalog, node_selector=None, hub=None):
+    """Map each placement's key to the placement and the images to pull for it"""
+    plan = {}
+    for image in catalog.images.values():
+        placement = Placement(
+            {**(node_selector or {}), **image.node_selector},
+            [dict(t) for t in image.tolerations],
+            hub,
+        )
+        _, images = plan.setdefault(placement.key, (placement, []))
+        if image.name not in images:
+            images.append(image.name)
+    for _, images in plan.values():
+        images.sort()
+    return plan
+
+
+def normalize_image(name):
+    """Fully qualify an image reference the way the node status lists it"""
+    name, _, digest = name.partition("@")
+    first, _, rest = name.partition("/")
+    if not rest:
+        name = "{}/library/{}".format(DEFAULT_REGISTRY, name)
+    elif "." not in first and ":" not in first and first != "localhost":
+        name = "{}/{}".format(DEFAULT_REGISTRY, name)
+    repository, slash, last = name.rpartition("/")
+    last, _, tag = last.partition(":")
+    name = repository + slash + last
+    if digest:
+        return "{}@{}".format(name, digest)
+    return "{}:{}".format(name, tag or "latest")
+
+
+def node_images(node):
+    """The normalized image references cached on a node.
+
+    The kubelet reports at most 50 images per node by default
+    (nodeStatusMaxImages), so on busy nodes the fraction can read low.
+    """
+    return {
+        normalize_image(name)
+        for image in (node.status.images or [])
+        for name in (image.names or [])
+    }
+
+
+class Prepuller:
+    def __init__(
+        self,
+        core_api,
+        apps_api,
+        namespace,
+        catalog_loader,
+        node_selector=None,
+        repull_every=0,
+        pause_image=PAUSE_IMAGE,
+        image_pull_secrets=None,
+    ):
+        self.core_api = core_api
+        self.apps_api = apps_api
+        self.namespace = namespace
+        self.catalog_loader = catalog_loader
+        self.node_selector = node_selector or {}
+        self.repull_every = repull_every
+        self.pause_image = pause_image
+        self.image_pull_secrets = image_pull_secrets or []
+        self.hub = hub_labels()
+        self._exported = set()
+
+    async def sync(self):
+        """Bring the prepuller DaemonSets in line with the catalog and report the cache"""
+        catalog = await self.catalog_loader()
+        plan = pull_plan(catalog, self.node_selector, self.hub)
+        existing = await run_blocking(
+            self.apps_api.list_namespaced_daemon_set,
+            self.namespace,
+            label_selector=hub_selector(PREPULLER_SELECTOR),
+        )
+        current = {ds.metadata.name: ds for ds in existing.items}
+        wanted = set()
+        for placement, images in plan.values():
+            wanted.add(placement.name)
+            await self.apply(placement, images, current.get(placement.name))
+        for name in set(current) - wanted:
+            app_log.info("Deleting prepuller %s, its placement is no longer used", name)
+            await run_blocking(self.apps_api.delete_namespaced_daemon_set, name, self.namespace)
+        return await self.report(plan)
+
+    async def apply(self, placement, images, existing):
+        """Create or replace a placement's DaemonSet when its images changed"""
+        body = self.daemon_set(placement, images)
+        digest = body.spec.template.metadata.annotations[IMAGES_HASH_ANNOTATION]
+        if existing is not None:
+            annotations = existing.spec.template.metadata.annotations or {}
+            if annotations.get(IMAGES_HASH_ANNOTATION) == digest:
+                return False
+            app_log.info("Rolling prepuller %s over to %s", placement.name, ", ".join(images))
+            await run_blocking(
+                self.apps_api.replace_namespaced_daemon_set,
+                placement.name,
+                self.namespace,
+                body,
+            )
+        else:
+            app_log.info("Creating prepuller %s for %s", placement.name, ", ".join(images))
+            await run_blocking(self.apps_api.create_namespaced_daemon_set, self.namespace, body)
+        return True
+
+    def daemon_set(self, placement, images):
+        pull_policy = "Always" if self.repull_every else "IfNotPresent"
+        hashed = {"images": json.dumps(images)}
+        if self.repull_every:
+            # a new value every interval rolls the pods over and re-pulls mutable tags
+            hashed["repull"] = str(int(time.time() // self.repull_every))
+        init_containers = [
+            client.V1Container(
+                name="pull-{}".format(i),
+                image=image,
+                image_pull_policy=pull_policy,
+                command=["/bin/sh", "-c", "true"],
+                resources=client.V1ResourceRequirements(
+                    requests={"cpu": "0", "memory": "0"}
+                ),
+            )
+            for i, image in enumerate(images)
+        ]
+        labels = {**PREPULLER_LABELS, **self.hub, "placement": placement.name}
+        return client.V1DaemonSet(
+            metadata=client.V1ObjectMeta(
+                name=placement.name,
+                labels=labels,
+                annotations={PLACEMENT_ANNOTATION: placement.key},
+            ),
+            spec=client.V1DaemonSetSpec(
+                selector=client.V1LabelSelector(match_labels=labels),
+                update_strategy=client.V1DaemonSetUpdateStrategy(
+                    type="RollingUpdate",
+                    rolling_update=client.V1RollingUpdateDaemonSet(max_unavailable="100%"),
+                ),
+                template=client.V1PodTemplateSpec(
+                    metadata=client.V1ObjectMeta(
+                        labels=labels,
+                        annotations={IMAGES_HASH_ANNOTATION: content_hash(hashed)},
+                    ),
+                    spec=client.V1PodSpec(
+                        node_selector=placement.node_selector or None,
+                        tolerations=placement.tolerations or None,
+                        init_containers=init_containers,
+                        containers=[
+                            client.V1Container(
+                                name="pause",
+                                image=self.pause_image,
+                                resources=client.V1ResourceRequirements(
+                                    requests={"cpu": "0", "memory": "0"}
+                                ),
+                            )
+                        ],
+                        image_pull_secrets=[
+                            client.V1LocalObjectReference(name=name)
+                            for name in self.image_pull_secrets
+                        ]
+                        or None,
+                        termination_grace_period_seconds=0,
+                        automount_service_account_token=False,
+                    ),
+                ),
+            ),
+        )
+
+    async def report(self, plan):
+        """Export, per image, the fraction of its eligible nodes that have it cached"""
+        nodes = (await run_blocking(self.core_api.list_node)).items
+        cached = {node.metadata.name: node_images(node) for node in nodes}
+        eligible = {}
+        have = {}
+        for placement, images in plan.values():
+            matching = [node.metadata.name for node in nodes if placement.matches(node)]
+            for image in images:
+                reference = normalize_image(image)
+                eligible.setdefault(image, set()).update(matching)
+                have.setdefault(image, set()).update(
+                    name for name in matching if reference in cached[name]
+                )
+        fractions = {}
+        for image, names in eligible.items():
+            fractions[image] = len(have[image]) / len(names) if names else 0.0
+            IMAGE_CACHED_FRACTION.labels(image=image).set(fractions[image])
+            app_log.info(
+                "%s cached on %i of %i eligible nodes", image, len(have[image]), len(names)
+            )
+        for image in self._exported - set(fractions):
+            IMAGE_CACHED_FRACTION.remove(image)
+        self._exported = set(fractions)
+        return fractions
+
+async def load_catalog():
+    """The catalog over the tenant images and every user and group config's images"""
+    # imported here so the Prepuller can be used without the Tapis env
+    from jupyterhub.catalog import ImageCatalog
+    from jupyterhub.common import get_all_user_configs_async, get_tenant_configs_async
+    from jupyterhub.config_model import CompiledConfig
+
+    tenant_configs, user_configs = await asyncio.gather(
+        get_tenant_configs_async(), get_all_user_configs_async()
+    )
+    user_models = []
+    for item in user_configs:
+        try:
+            user_models.append(CompiledConfig(item["value"]))
+        except ValueError as e:
+            app_log.warning("Skipping config %s: %s", item.get("name"), e)
+    return ImageCatalog(CompiledConfig(tenant_configs), user_models)
+
+
+def parse_selector(selector):
+    """Parse "key=value,key=value" into a nodeSelector dict"""
+    return dict(item.split("=", 1) for item in selector.split(",") if item.strip())
+
+
+async def run(prepuller, sync_every, once=False):
+    while True:
+        try:
+            await prepuller.sync()
+        except Exception as e:
+            app_log.error("Prepuller sync failed: %s", e)
+        if once:
+            return
+        await asyncio.sleep(sync_every)
+
+
+if __name__ == '__main__':
+    define('sync_every', default=300, help="The interval (in seconds) between catalog syncs")
+    define('node_selector', default="",
+           help="key=value pairs every notebook node has, merged into each image's nodeSelector")
+    define('repull_every', default=0,
+           help="Roll the prepuller pods over on this interval (in seconds) to refresh mutable tags")
+    define('pause_image', default=PAUSE_IMAGE, help="The image the prepuller pods idle in")
+    define('image_pull_secrets', default="", help="Comma separated image pull secret names")
+    define('metrics_port', default=0, help="Serve the cached fraction gauge on this port")
+    define('once', default=False, help="Run a single sync and exit")
+
+    parse_command_line()
+
+    from prometheus_client import start_http_server
+
+    from jupyterhub.kube_client import get_apps_api, get_core_api, get_namespace
+
+    if options.metrics_port:
+        start_http_server(options.metrics_port)
+    prepuller = Prepuller(
+        get_core_api(),
+        get_apps_api(),
+        get_namespace(),
+        load_catalog,
+        node_selector=parse_selector(options.node_selector),
+        repull_every=options.repull_every,
+        pause_image=options.pause_image,
+        image_pull_secrets=[s for s in options.image_pull_secrets.split(",") if s],
+    )
+    try:
+        IOLoop.current().run_sync(lambda: run(prepuller, options.sync_every, options.once))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Report notebook pod startup latency, grouped by credentials mode.
+
+Reads the condition timestamps of the singleuser pods in the hub's namespace
+and prints, for each value of the hub.jupyter.org/credentials-mode label, how
+long pods took from creation to scheduled, to initialized (the init container
+phase) and to ready. Spawning the same users with CREDENTIALS_MODE set to
+"init-container" and then "entrypoint" gives the before/after comparison::
+
+    python spawn_latency.py [--selector=component=singleuser-server] [--since=3600]
+"""
+
+import datetime
+from collections import defaultdict
+
+from tornado.options import define, options, parse_command_line
+
+from benchmarks.stats import percentile
+from jupyterhub.kube_client import CREDENTIALS_MODE_LABEL, get_core_api, get_namespace
+
+PHASES = [
+    ("scheduled", "PodScheduled"),
+    ("initialized", "Initialized"),
+    ("ready", "Ready"),
+]
+
+
+def pod_phase_durations(pod):
+    """Seconds from pod creation to each condition turning true"""
+    created = pod.metadata.creation_timestamp
+    conditions = {
+        c.type: c.last_transition_time
+        for c in (pod.status.conditions or [])
+        if c.status == "True" and c.last_transition_time
+    }
+    return {
+        phase: (conditions[condition] - created).total_seconds()
+        for phase, condition in PHASES
+        if condition in conditions
+    }
+
+
+def collect(selector, since):
+    api = get_core_api()
+    pods = api.list_namespaced_pod(get_namespace(), label_selector=selector).items
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        seconds=since
+    )
+    durations = defaultdict(lambda: defaultdict(list))
+    for pod in pods:
+        if pod.metadata.creation_timestamp < cutoff:
+            continue
+        mode = (pod.metadata.labels or {}).get(CREDENTIALS_MODE_LABEL, "unlabelled")
+        for phase, seconds in pod_phase_durations(pod).items():
+            durations[mode][phase].append(seconds)
+    return durations
+
+
+def report(durations):
+    for mode, phases in sorted(durations.items()):
+        print(f"credentials mode: {mode}")
+        for phase, _ in PHASES:
+            values = phases.get(phase, [])
+            print(
+                "  {:<12} n={:<5} p50={:>7.1f}s p95={:>7.1f}s max={:>7.1f}s".format(
+                    phase,
+                    len(values),
+                    percentile(values, 50),
+                    percentile(values, 95),
+                    max(values) if values else float("nan"),
+                )
+            )
+
+
+if __name__ == "__main__":
+    define("selector", default="component=singleuser-server", help="Label selector for notebook pods")
+    define("since", default=24 * 60 * 60, help="Only include pods created in the last N seconds")
+    parse_command_line()
+    report(collect(options.selector, options.since))
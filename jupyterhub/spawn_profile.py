@@ -0,0 +1,86 @@
+"""
+Per-user spawn profiles: what the spawn hook resolved for a user, kept for
+their next spawn.
+
+A profile holds the spawner settings the hook derives from the configs and
+the user's identity (image, limits, environment, command, init containers,
+volumes and volume mounts), under a key hashed from every input they were
+derived from: the user, the tenant and user config versions, the TAS record
+and LDAP gids, the project mounts, the posted options and the hub-side
+settings (credentials mode, base command, credentials entrypoint and
+resource guarantees) the hook applies. A spawn whose key
+matches the stored profile applies it instead of resolving the image,
+limits and mounts again; any changed input gives a new key and a fresh
+profile. The profile lives on the spawner and in its saved state (see
+``TapisKubeSpawner.get_state``), so it survives hub restarts.
+"""
+
+import copy
+import hashlib
+import json
+
+# bump when the hook changes how a profile is derived, to drop saved profiles
+SPAWN_PROFILE_FORMAT = 2
+# the spawner settings a profile holds
+SPAWN_PROFILE_FIELDS = (
+    "image",
+    "notebook_dir",
+    "extra_pod_config",
+    "extra_container_config",
+    "mem_limit",
+    "cpu_limit",
+    "mem_guarantee",
+    "cpu_guarantee",
+    "environment",
+    "cmd",
+    "init_containers",
+    "volumes",
+    "volume_mounts",
+    "extra_labels",
+)
+
+
+def spawn_profile_key(spawner, projects, hub_settings):
+    """Hash of everything the profile is derived from, or None if it can't be keyed"""
+    if spawner.configs_version is None:
+        return None
+    inputs = {
+        "format": SPAWN_PROFILE_FORMAT,
+        "user": spawner.user.name,
+        "configs_version": spawner.configs_version,
+        "user_configs_version": spawner.user_configs_version,
+        "identity": [
+            getattr(spawner, name, None)
+            for name in ("tas_uid", "tas_gid", "init_gid", "tas_homedir", "supplemental_gids")
+        ],
+        "projects": projects or [],
+        "user_options": spawner.user_options or {},
+        # saved profiles outlive a hub restart, which may come with new hub settings
+        "hub_settings": hub_settings,
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf8")
+    ).hexdigest()
+
+
+def capture_spawn_profile(spawner, key):
+    """The spawner's resolved settings as a profile, safe to save in its state"""
+    return {
+        "key": key,
+        "values": {
+            name: copy.deepcopy(getattr(spawner, name)) for name in SPAWN_PROFILE_FIELDS
+        },
+    }
+
+
+def apply_spawn_profile(spawner, profile, key):
+    """Set a stored profile's settings on the spawner if it was saved under key"""
+    if not key or not profile or profile.get("key") != key:
+        return False
+    values = profile.get("values") or {}
+    if set(values) != set(SPAWN_PROFILE_FIELDS):
+        return False
+    for name in SPAWN_PROFILE_FIELDS:
+        # copied, so later changes to the spawner never reach the stored profile
+        setattr(spawner, name, copy.deepcopy(values[name]))
+    return True
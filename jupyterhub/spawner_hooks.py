@@ -1,133 +1,305 @@
-import ast
-import humanfriendly
+import asyncio
+import hashlib
 import json
 import os
-import re
 import requests
+import time
 
 from tornado import web
-from ldap3 import Server, Connection, SAFE_SYNC
+from tornado.log import app_log
+from ldap3 import NO_ATTRIBUTES
 from agavepy.agave import Agave
+from jupyterhub.admission import AdmissionController, parse_limits
+from jupyterhub.caching import PersistentTTLCache, StaleWhileRevalidateCache, TTLCache
+from jupyterhub.catalog import get_image_catalog
+from jupyterhub.config_model import ResourceLimits, get_tenant_model, get_user_models
 from jupyterhub.common import (
     TENANT,
     INSTANCE,
     base_url,
     v2_token_url,
-    get_tenant_configs,
+    get_tenant_configs_versioned_async,
     safe_string,
-    get_user_configs,
+    get_user_configs_async,
+    get_user_configs_version,
+    get_credentials_configmap_name,
+    run_blocking,
+    blocking_executor,
+    token_dir,
 )
+from jupyterhub.jhub_metrics import SPAWN_PHASE_DURATION, time_phase
+from jupyterhub.kube_client import (
+    CREDENTIALS_MODE_LABEL,
+    get_core_api,
+    get_namespace,
+    hub_labels,
+    write_credentials_configmap,
+)
+from jupyterhub.ldap_pool import LDAPConnectionPool
+from jupyterhub.mount_plan import get_mount_plan
+from jupyterhub.spawn_profile import (
+    apply_spawn_profile,
+    capture_spawn_profile,
+    spawn_profile_key,
+)
+from jupyterhub.warm_pool import SpawnHistory, WarmPool, clear_claim_affinity
 
 # TAS configuration:
 # base URL for TAS API.
 TAS_URL_BASE = os.environ.get("TAS_URL_BASE", "https://tas.tacc.utexas.edu/api/v1")
 TAS_ROLE_ACCT = os.environ.get("TAS_ROLE_ACCT", "tas-jetstream")
 TAS_ROLE_PASS = os.environ.get("TAS_ROLE_PASS")
+LDAP_URL = os.environ.get("LDAP_URL", "ldaps://ldap.tacc.utexas.edu:636")
+LDAP_BIND_DN = os.environ.get(
+    "LDAP_BIND_DN", "uid=ldapbind,ou=People,dc=tacc,dc=utexas,dc=edu"
+)
 LDAP_PASS = os.environ.get("LDAP_PASS")
+LDAP_POOL_SIZE = int(os.environ.get("LDAP_POOL_SIZE", 8))
+LDAP_GID_CACHE_TTL = int(os.environ.get("LDAP_GID_CACHE_TTL", 60 * 15))
+# TAS identity records rarely change, so they are cached on local disk across
+# restarts; put the file on a persistent volume for that to hold
+TAS_CACHE_DB = os.environ.get("TAS_CACHE_DB", "/srv/jupyterhub/tas_cache.sqlite")
+TAS_CACHE_TTL = int(os.environ.get("TAS_CACHE_TTL", 60 * 60 * 24))
+TAS_CACHE_NEGATIVE_TTL = int(os.environ.get("TAS_CACHE_NEGATIVE_TTL", 60))
+
+# seconds the spawn waits on each upstream before carrying on without it; without
+# a TAS record the spawn fails unless the tenant config sets the uid and gid
+TOKEN_FILE_TIMEOUT = float(os.environ.get("TOKEN_FILE_TIMEOUT", 5))
+TAS_TIMEOUT = float(os.environ.get("TAS_TIMEOUT", 10))
+LDAP_TIMEOUT = float(os.environ.get("LDAP_TIMEOUT", 10))
+PROJECTS_TIMEOUT = float(os.environ.get("PROJECTS_TIMEOUT", 15))
+
+# v2 tokens are reused until they expire; this is the lifetime assumed when
+# the token endpoint does not report one
+V2_TOKEN_TTL = int(os.environ.get("V2_TOKEN_TTL", 60 * 60))
+# project mounts older than this are still served, but refreshed in the background
+PROJECTS_CACHE_TTL = int(os.environ.get("PROJECTS_CACHE_TTL", 60 * 5))
+# project mounts older than this are dropped, and the next spawn loads them inline
+PROJECTS_CACHE_MAX_AGE = int(os.environ.get("PROJECTS_CACHE_MAX_AGE", 60 * 60))
+# how long a spawn's access token is kept for the projects refresh it may start
+PROJECTS_TOKEN_TTL = int(os.environ.get("PROJECTS_TOKEN_TTL", 60))
+
+# how credentials reach the notebook pod: "init-container" copies them with a
+# busybox init container, "entrypoint" copies them in a startup step of the
+# notebook container itself. The tenant config key credentials_mode overrides this.
+CREDENTIALS_MODE = os.environ.get("CREDENTIALS_MODE", "init-container")
+CREDENTIALS_DIR = "/etc/jhub-credentials"
+CREDENTIALS_ENTRYPOINT = [
+    "/bin/sh",
+    "-c",
+    'cp {0}/current {0}/.agpy /home/jupyter/.agave/ && exec "$@"'.format(CREDENTIALS_DIR),
+    "jhub-credentials",
+]
+# resource requests, set really low because when None or 0 KubeSpawner
+# requests an amount equal to the limit
+MEM_GUARANTEE = ".001K"
+CPU_GUARANTEE = 0.001
+
+# spawn hooks running at once, and calls in flight per upstream (named by
+# spawn phase); the rest wait their turn in FIFO order
+SPAWN_ADMISSION_LIMIT = int(os.environ.get("SPAWN_ADMISSION_LIMIT", 50))
+UPSTREAM_ADMISSION_LIMITS = parse_limits(
+    os.environ.get(
+        "UPSTREAM_ADMISSION_LIMITS",
+        "configs=16,tas=16,ldap=8,credentials_configmap=16,projects=16",
+    )
+)
 
+# warm placeholder pods (see warm_pool.py), enabled by naming their priority
+# class; it needs a lower value than the notebook pods' priority
+WARM_POOL_PRIORITY_CLASS = os.environ.get("WARM_POOL_PRIORITY_CLASS")
+WARM_POOL_HISTORY_DB = os.environ.get("WARM_POOL_HISTORY_DB", "/srv/jupyterhub/warm_pool.sqlite")
+WARM_POOL_BUCKET = int(os.environ.get("WARM_POOL_BUCKET", 60 * 15))
+WARM_POOL_HISTORY_WEEKS = int(os.environ.get("WARM_POOL_HISTORY_WEEKS", 4))
+WARM_POOL_PROFILES = int(os.environ.get("WARM_POOL_PROFILES", 5))
+WARM_POOL_MIN = int(os.environ.get("WARM_POOL_MIN", 0))
+WARM_POOL_MAX = int(os.environ.get("WARM_POOL_MAX", 10))
+WARM_POOL_HEADROOM = float(os.environ.get("WARM_POOL_HEADROOM", 1.0))
+WARM_POOL_RECONCILE_EVERY = int(os.environ.get("WARM_POOL_RECONCILE_EVERY", 60))
+
+tas_cache = PersistentTTLCache(
+    "tas_identity", TAS_CACHE_DB, TAS_CACHE_TTL, TAS_CACHE_NEGATIVE_TTL
+)
+ldap_pool = LDAPConnectionPool(
+    LDAP_URL, LDAP_BIND_DN, LDAP_PASS, size=LDAP_POOL_SIZE, timeout=LDAP_TIMEOUT
+)
+# failed LDAP lookups are not cached, the spawn just goes without supplemental gids
+ldap_gid_cache = TTLCache("ldap_gids", LDAP_GID_CACHE_TTL)
+warm_pool = None
+admission = AdmissionController(SPAWN_ADMISSION_LIMIT, UPSTREAM_ADMISSION_LIMITS)
 
-def hook(spawner):
+
+async def hook(spawner):
     spawner.start_timeout = 60 * 5
-    spawner.log.info("👻 tenant configs 👻 {}".format(spawner.configs))
-    spawner.log.info("👽 user configs 👽 {}".format(spawner.user_configs))
+    # the spawner is reused, a failed TAS lookup must not leave the last spawn's identity
+    spawner.tas_uid = spawner.tas_gid = spawner.tas_homedir = spawner.init_gid = None
+    # reload configs here too; the options form is skipped for API spawns
+    with time_phase(SPAWN_PHASE_DURATION, phase="configs"):
+        async with admission.slot("configs", spawner):
+            await load_configs(spawner)
+    spawner.log.info("👻 tenant configs 👻 {}".format(spawner.config_model))
+    spawner.log.info("👽 user configs 👽 {}".format(spawner.user_config_models))
     spawner.log.info("😱 user options (from form) 😱 {}".format(spawner.user_options))
 
-    get_agave_access_data(spawner)
+    # TAS and LDAP only need the username, so start them right away; the
+    # projects lookup joins them once the token file has been read
+    tas_data = asyncio.ensure_future(get_tas_data(spawner))
+    await get_agave_access_data(spawner)
     spawner.log.info(
         "access token: {}, refresh token: {}, url: {}".format(
             spawner.access_token, spawner.refresh_token, spawner.url
         )
     )
-    # check if access token is valid
-    
-    get_tas_data(spawner)
-
-    spawner.uid = int(spawner.configs.get("uid", spawner.tas_uid))
-    spawner.gid = int(spawner.configs.get("gid", spawner.tas_gid))
+    projects, _, _ = await asyncio.gather(
+        get_projects(spawner),
+        tas_data,
+        call_upstream(
+            spawner,
+            "credentials configmap",
+            TOKEN_FILE_TIMEOUT,
+            sync_credentials_configmap,
+            spawner.user.name,
+            spawner.log,
+            phase="credentials_configmap",
+        ),
+    )
 
-    spawner.extra_pod_config = spawner.configs.get("extra_pod_config", {})
-    spawner.extra_container_config = spawner.configs.get("extra_container_config", {})
+    config = spawner.config_model
+    uid = spawner.tas_uid if config.uid is None else config.uid
+    gid = spawner.tas_gid if config.gid is None else config.gid
+    if uid is None or gid is None:
+        spawner.log.error(
+            "no TAS record for {} and no uid/gid in the tenant config".format(
+                spawner.user.name
+            )
+        )
+        raise web.HTTPError(
+            503, "Could not look up your TACC account, please try again in a few minutes"
+        )
+    spawner.uid = int(uid)
+    spawner.gid = int(gid)
+
+    # a repeat spawn with unchanged inputs reuses what its last spawn resolved
+    key = spawn_profile_key(spawner, projects, spawn_profile_settings(spawner))
+    with time_phase(SPAWN_PHASE_DURATION, phase="profile"):
+        reused = apply_spawn_profile(spawner, getattr(spawner, "spawn_profile", None), key)
+    if reused:
+        spawner.log.info("reusing the spawn profile of {}".format(spawner.user.name))
+    else:
+        resolve_spawn(spawner, projects)
+        if key:
+            spawner.spawn_profile = capture_spawn_profile(spawner, key)
+    if WARM_POOL_PRIORITY_CLASS:
+        # an hpc spawn claims nothing, but must not follow an earlier claim either
+        clear_claim_affinity(spawner)
+        if not spawner.user_options.get("hpc"):
+            with time_phase(SPAWN_PHASE_DURATION, phase="warm_pool"):
+                await claim_warm_placeholder(spawner)
+
+
+def resolve_spawn(spawner, projects):
+    """Resolve the image, limits and mounts from the configs and the user's identity"""
+    spawner.extra_pod_config = spawner.config_model.extra_pod_config()
+    spawner.extra_container_config = spawner.config_model.extra_container_config()
     
-    if (
-        len(spawner.configs.get("images")) == 1 and not spawner.hpc_available
-    ):  # only 1 image option, so we skipped the form
-        spawner.image = spawner.configs.get("images")[0]["name"]
+    catalog = get_spawner_catalog(spawner)
+    if not catalog.show_form:  # only 1 image option, so we skipped the form
+        spawner.image = catalog.first().name
     else:
         # verify form data
-        image_options = spawner.configs.get("images")
-        spawner.log.info(f"Verifiying image: {image_options}")
-        user_configs = spawner.user_configs
-        spawner.log.info(f"User configs: {user_configs}")
-        for item in spawner.user_configs:
-            spawner.log.info(f"Item: {item}")
-            for image in item["value"]["images"]:
-                spawner.log.info(f"Image: {image}")
-                image_options.append(image)
         user_options = spawner.user_options        
         spawner.log.info(f"User options: {user_options}")
-        image = ast.literal_eval(spawner.user_options["image"][0])
-        spawner.log.info(f"Image: {image}")
         try:
-            spawner.log.info(
-                "Checking user options: image-{} hpc-{} against metadata: {}".format(
-                    image, spawner.user_options.get("hpc"), image_options
-                )
-            )
-            allowed_options = next(
-                option for option in image_options if option["name"] == image["name"] and option["display_name"] == image["display_name"]
-            )
-            if spawner.user_options.get("hpc"):
-                if not eval(allowed_options.get("hpc_available", "False")):
-                    spawner.log.error(
-                        "hpc is not available for this image. {} -- {}".format(
-                            spawner.user.name, allowed_options
-                        )
+            key, image = catalog.resolve(spawner.user_options["image"][0])
+            spawner.log.info(f"Image: {image}")
+            if image is None:
+                raise ValueError("{} is not in the image catalog".format(key))
+            if spawner.user_options.get("hpc") and not catalog.hpc[key]:
+                spawner.log.error(
+                    "hpc is not available for this image. {} -- {}".format(
+                        spawner.user.name, image
                     )
-                    raise web.HTTPError(403)
+                )
+                raise web.HTTPError(403)
+        except web.HTTPError:
+            raise
         except Exception as e:
             spawner.log.error(
                 "{} user options not allowed. selected options {}. allowed options {}. got an error:{}".format(
-                    spawner.user.name, spawner.user_options, image_options, e
+                    spawner.user.name, spawner.user_options, list(catalog.images), e
                 )
             )
             raise web.HTTPError(403)
 
-        spawner.image = image["name"]
-        if image.get("extra_pod_config"):
-            merge_configs(image["extra_pod_config"], spawner.extra_pod_config)
-        if image.get("extra_container_config"):
-            merge_configs(image["extra_container_config"], spawner.extra_pod_config)
-        spawner.notebook_dir = image.get("notebook_dir", "")
+        spawner.image = image.name
+        if image.extra_pod_config():
+            merge_configs(image.extra_pod_config(), spawner.extra_pod_config)
+        if image.extra_container_config():
+            merge_configs(image.extra_container_config(), spawner.extra_pod_config)
+        spawner.notebook_dir = image.notebook_dir
+
+    with time_phase(SPAWN_PHASE_DURATION, phase="limits"):
+        resolve_limits(spawner)
+    with time_phase(SPAWN_PHASE_DURATION, phase="mounts"):
+        get_mounts(spawner)
+        add_project_mounts(spawner, projects)
+
 
+def resolve_limits(spawner):
+    """Set the highest limits found in the tenant and user configs on the spawner"""
     if not spawner.user_options.get("hpc"):
         # find highest available limit between tenant/user/group configs
-        tenant_mem_limit = spawner.configs.get("mem_limit")
-        mem_limits = {tenant_mem_limit: humanfriendly.parse_size(tenant_mem_limit)}
-        cpu_limits = [spawner.configs.get("cpu_limit")]
-        for item in spawner.user_configs:
-            mem_limit = item["value"].get("mem_limit")
-            cpu_limit = item["value"].get("cpu_limit")
-            if mem_limit:
-                mem_limits.update({mem_limit: humanfriendly.parse_size(mem_limit)})
-            if cpu_limit:
-                cpu_limits.append(cpu_limit)
-        spawner.log.info(
-            "available limits -- mem: {} cpu:{}".format(mem_limits, cpu_limits)
-        )
-        spawner.mem_limit = max(mem_limits, key=mem_limits.get)
-        spawner.cpu_limit = float(max(cpu_limits))
-        # Set the guarantees really low because when None or 0,it sets a resource request for an amount equal to the limit
-        spawner.mem_guarantee = ".001K"
-        spawner.cpu_guarantee = float(0.001)
+        available = [spawner.config_model.limits] + [
+            model.limits for model in spawner.user_config_models
+        ]
+        limits = ResourceLimits.highest(available)
+        spawner.log.info("available limits -- {}".format(available))
+        spawner.mem_limit = limits.mem_limit
+        spawner.cpu_limit = limits.cpu_limit
+        spawner.mem_guarantee = MEM_GUARANTEE
+        spawner.cpu_guarantee = CPU_GUARANTEE
         spawner.environment = {
-            "MKL_NUM_THREADS": max(cpu_limits),
-            "NUMEXPR_NUM_THREADS": max(cpu_limits),
-            "OMP_NUM_THREADS": max(cpu_limits),
-            "OPENBLAS_NUM_THREADS": max(cpu_limits),
+            "MKL_NUM_THREADS": limits.threads,
+            "NUMEXPR_NUM_THREADS": limits.threads,
+            "OMP_NUM_THREADS": limits.threads,
+            "OPENBLAS_NUM_THREADS": limits.threads,
             "SCINCO_JUPYTERHUB_IMAGE": spawner.image,
         }
-    get_mounts(spawner)
-    get_projects(spawner)
+
+
+def get_warm_pool():
+    """Return the warm pool, creating it on first use"""
+    global warm_pool
+    if warm_pool is None:
+        warm_pool = WarmPool(
+            get_core_api(),
+            get_namespace(),
+            SpawnHistory(WARM_POOL_HISTORY_DB, WARM_POOL_BUCKET, WARM_POOL_HISTORY_WEEKS),
+            WARM_POOL_PRIORITY_CLASS,
+            labels={"tenant": TENANT, "instance": INSTANCE},
+            profiles=WARM_POOL_PROFILES,
+            min_size=WARM_POOL_MIN,
+            max_size=WARM_POOL_MAX,
+            headroom=WARM_POOL_HEADROOM,
+            reconcile_every=WARM_POOL_RECONCILE_EVERY,
+        )
+    return warm_pool
+
+
+def start_warm_pool():
+    """Start sizing the warm pool when the hub starts, instead of on the first spawn"""
+    if WARM_POOL_PRIORITY_CLASS:
+        get_warm_pool().start()
+
+
+async def claim_warm_placeholder(spawner):
+    """Take a warm placeholder's node for this spawn; the spawn goes on cold without one"""
+    try:
+        await get_warm_pool().claim(spawner)
+    except Exception as e:
+        spawner.log.error(
+            "warm pool claim for {} failed: {}".format(spawner.user.name, e)
+        )
 
 
 def merge_configs(x, y):
@@ -137,87 +309,68 @@ def merge_configs(x, y):
             merged_pod_config[key].update(x[key])
 
 async def get_notebook_options(spawner):
-    spawner.configs = get_tenant_configs()
-    spawner.log.info(f"spawner configs: {spawner.configs}")
-    spawner.user_configs = get_user_configs(spawner.user.name)
-    spawner.log.info(f"spawner user configs: {spawner.configs}")
-
-    image_options = spawner.configs.get("images")
-
-    for item in spawner.user_configs:
-        for image in item["value"].get("images"):
-            if image not in image_options:
-                image_options += [image]
-            if eval(image.get("hpc_available", "False")):
-                spawner.hpc_available = True
-
-    if not hasattr(
-        spawner, "hpc_available"
-    ):  # only looped through user options -- check the tenant options for hpc
-        for image in spawner.configs.get("images"):
-            if eval(image.get("hpc_available", "False")):
-                spawner.hpc_available = True
-                break
-            spawner.hpc_available = False
-
-    image_options = sorted(image_options, key=lambda d: d["name"])
-    if len(image_options) > 1 or spawner.hpc_available:
-        options = ""
-        for image in image_options:
-            options = options + " <option value='{}'> {} </option>".format(
-                json.dumps(image), image.get("display_name", image["name"])
-            )
-
-        if spawner.hpc_available:
-            hpc = """<input type="checkbox" id="hpc" name="hpc" style="display: none">
-                <label for="hpc" id="hpc_label" style="display: none">Run on HPC</label>
-                """
-            js = """(function hpc(){
-                var select_element = document.getElementById('image');
-                var value = select_element.value || select_element.options[select_element.selectedIndex].value;
-                var value = JSON.parse(value);
-                document.getElementById('image_description').innerText = ''
-                if ('description' in value) {
-                    document.getElementById('image_description').innerText = value['description'];
-                }
-                if (value['hpc_available']) {
-                    document.getElementById('hpc').checked = false;
-                    document.getElementById('hpc').style.display = 'inline-block';
-                    document.getElementById('hpc_label').style.display = 'inline-block';
-                } else {
-                    document.getElementById('hpc').checked = false;
-                    document.getElementById('hpc').style.display = 'none';
-                    document.getElementById('hpc_label').style.display = 'none';
-                }
-            })()"""
-        else:
-            js = """(function hpc(){
-                            var select_element = document.getElementById('image');
-                            var value = select_element.value || select_element.options[select_element.selectedIndex].value;
-                            var value = JSON.parse(value);
-                            document.getElementById('image_description').innerText = ''
-                            if ('description' in value) {
-                                document.getElementById('image_description').innerText = value['description'];
-                            }
-                        })()"""
-
-            hpc = ""
-
-        image_description = (
-            '<p id="image_description" style="display: inline-block"> </p>'
-        )
-        select_images = '<select id="image" name="image" size="10" onchange="{}"> {} </select>'.format(
-            js, options
-        )
-        spawner.log.info(select_images)
-        return "{}{}{}".format(select_images, image_description, hpc)
+    await load_configs(spawner)
+    spawner.log.info(f"spawner configs: {spawner.config_model}")
+    spawner.log.info(f"spawner user configs: {spawner.user_config_models}")
+    catalog = get_spawner_catalog(spawner)
+    if catalog.show_form:
+        return catalog.form()
+
+
+async def load_configs(spawner):
+    """Set the compiled tenant and user configs, and their versions, on the spawner"""
+    configs, spawner.configs_version = await get_tenant_configs_versioned_async()
+    user_configs = await get_user_configs_async(spawner.user.name)
+    spawner.user_configs_version = get_user_configs_version(user_configs)
+    # compiled once per version and shared by every spawner; the raw documents
+    # are not kept on the spawner
+    spawner.config_model = get_tenant_model(configs, spawner.configs_version)
+    spawner.user_config_models = get_user_models(user_configs, spawner.user_configs_version)
+
+
+def get_spawner_catalog(spawner):
+    return get_image_catalog(
+        spawner.config_model,
+        spawner.configs_version,
+        spawner.user_config_models,
+        spawner.user_configs_version,
+    )
 
 async def parse_form_data(formdata, spawner):
     spawner.log.info(f"FORM DATA: {formdata}")
     return formdata
 
 
-def get_agave_access_data(spawner):
+async def call_upstream(spawner, name, timeout, func, *args, phase):
+    """Run a blocking upstream call off the event loop, giving up after timeout seconds"""
+    try:
+        with time_phase(SPAWN_PHASE_DURATION, phase=phase):
+            # the timeout starts once admitted, queueing is not the upstream's fault
+            async with admission.slot(phase, spawner):
+                return await asyncio.wait_for(run_blocking(func, *args), timeout)
+    except asyncio.TimeoutError:
+        spawner.log.error(
+            "{} lookup for {} timed out after {}s".format(
+                name, spawner.user.name, timeout
+            )
+        )
+        return None
+
+
+async def get_agave_access_data(spawner):
+    """Set the access token and base URL cached in the agavepy file on the spawner"""
+    spawner.access_token = spawner.refresh_token = spawner.url = None
+    await call_upstream(
+        spawner,
+        "token file",
+        TOKEN_FILE_TIMEOUT,
+        read_agave_access_data,
+        spawner,
+        phase="token_file",
+    )
+
+
+def read_agave_access_data(spawner):
     """
     Returns the access token and base URL cached in the agavepy file
     :return:
@@ -260,7 +413,7 @@ def get_agave_access_data(spawner):
         return None
 
 
-def get_tas_data(spawner):
+async def get_tas_data(spawner):
     """Get the TACC uid, gid and homedir for this user from the TAS API."""
     if not TAS_ROLE_ACCT:
         spawner.log.error("No TAS_ROLE_ACCT configured. Aborting.")
@@ -268,99 +421,195 @@ def get_tas_data(spawner):
     if not TAS_ROLE_PASS:
         spawner.log.error("No TAS_ROLE_PASS configured. Aborting.")
         return
-    url = "{}/users/username/{}".format(TAS_URL_BASE, spawner.user.name)
+    result, gids = await asyncio.gather(
+        call_upstream(
+            spawner,
+            "TAS",
+            TAS_TIMEOUT,
+            get_tas_record,
+            spawner.user.name,
+            spawner.log,
+            phase="tas",
+        ),
+        call_upstream(
+            spawner,
+            "LDAP",
+            LDAP_TIMEOUT,
+            get_ldap_gids,
+            spawner.user.name,
+            spawner.log,
+            phase="ldap",
+        ),
+    )
+    spawner.tas_gid = None
+    if result is None:
+        return
+    spawner.tas_uid = result["uid"]
+    spawner.tas_gid = result["gid"]
+    spawner.init_gid = result["gid"]
+    spawner.tas_homedir = result["homeDirectory"]
+
+    if gids:
+        spawner.supplemental_gids = gids
+
+    # if the instance has a configured TAS_GID to use we will use that; otherwise,
+    # we fall back on using the user's uid as the gid, which is (almost) always safe)
+    if not spawner.tas_gid:
+        gid = spawner.config_model.gid
+        spawner.tas_gid = spawner.tas_uid if gid is None else gid
+    spawner.log.info(
+        # "Setting the following TAS data: uid:{} gid:{} homedir:{}".format(
+        #     spawner.tas_uid, spawner.tas_gid, spawner.tas_homedir
+        # )
+        "Setting the following TAS data: uid:{} gid:{}".format(
+            spawner.tas_uid, spawner.tas_gid
+        )
+    )
+
+
+def get_tas_record(username, log):
+    """Return the TAS identity record for username from the cache, or TAS on a miss"""
+    return tas_cache.get_or_load(username, lambda name: fetch_tas_record(name, log))
+
+
+def fetch_tas_record(username, log):
+    """Return the TAS uid, gid and homeDirectory for username, or None"""
+    url = "{}/users/username/{}".format(TAS_URL_BASE, username)
     headers = {"Content-type": "application/json", "Accept": "application/json"}
     try:
         rsp = requests.get(
             url,
             headers=headers,
             auth=requests.auth.HTTPBasicAuth(TAS_ROLE_ACCT, TAS_ROLE_PASS),
+            timeout=TAS_TIMEOUT,
         )
     except Exception as e:
-        spawner.log.error(
+        log.error(
             "Got an exception from TAS API. "
             "Exception: {}. url: {}. TAS_ROLE_ACCT: {}".format(e, url, TAS_ROLE_ACCT)
         )
-        return
+        return None
     try:
         data = rsp.json()
-        spawner.log.info("TAS DATA: %s", data)
+        log.info("TAS DATA: %s", data)
     except Exception as e:
-        spawner.log.error(
+        log.error(
             "Did not get JSON from TAS API. rsp: {}"
             "Exception: {}. url: {}. TAS_ROLE_ACCT: {}".format(
                 rsp, e, url, TAS_ROLE_ACCT
             )
         )
-        return
-    spawner.tas_gid = None
+        return None
     try:
-        spawner.tas_uid = data["result"]["uid"]
-        spawner.tas_gid = data["result"]["gid"]
-        spawner.init_gid = data["result"]["gid"]
-        spawner.tas_homedir = data["result"]["homeDirectory"]
+        result = data["result"]
+        return {
+            "uid": result["uid"],
+            "gid": result["gid"],
+            "homeDirectory": result["homeDirectory"],
+        }
     except Exception as e:
-        spawner.log.error(
+        log.error(
             "Did not get attributes from TAS API. rsp: {}"
             "Exception: {}. url: {}. TAS_ROLE_ACCT: {}".format(
                 rsp, e, url, TAS_ROLE_ACCT
             )
         )
-        return
-    
+        return None
+
+
+def get_ldap_gids(username, log):
+    """Return the user's supplemental gids from the cache, or LDAP on a miss"""
+    return ldap_gid_cache.get_or_load(username, lambda name: fetch_ldap_gids(name, log))
+
+
+def fetch_ldap_gids(username, log):
+    """Return the supplemental gids of the LDAP groups username is a member of, or None"""
     gids = []
 
     try:
-        server = Server('ldaps://ldap.tacc.utexas.edu:636')
-        conn = Connection(server, 'uid=ldapbind,ou=People,dc=tacc,dc=utexas,dc=edu', LDAP_PASS, client_strategy=SAFE_SYNC, auto_bind=True)
-        status, result, response, _ = conn.search('ou=Groups,dc=tacc,dc=utexas,dc=edu', f'(uniqueMember=uid={spawner.user.name},ou=People,dc=tacc,dc=utexas,dc=edu)')
+        # only the dn is needed, so ask for no attributes at all
+        response = ldap_pool.search('ou=Groups,dc=tacc,dc=utexas,dc=edu', f'(uniqueMember=uid={username},ou=People,dc=tacc,dc=utexas,dc=edu)', [NO_ATTRIBUTES])
         for entry in response:
+            if entry.get('type') != 'searchResEntry':
+                continue
             data = entry['dn'].split(',')
             cn = data[0].split('=')
             group = cn[1]
-            temp_gid = group.split('-')[1]
             try:
+                temp_gid = group.split('-')[1]
                 gid = int(temp_gid)
                 gids.append(gid)
             except Exception as e:
                 continue
     except Exception as e:
-        spawner.log.error(
+        log.error(
             "Did not get gid's from ldap. rsp: {}"
             .format(e)
         )
-    
-    if gids:
-        spawner.supplemental_gids = gids
+        return None
+    return gids
 
-    # if the instance has a configured TAS_GID to use we will use that; otherwise,
-    # we fall back on using the user's uid as the gid, which is (almost) always safe)
-    if not spawner.tas_gid:
-        spawner.tas_gid = spawner.configs.get("gid", spawner.tas_uid)
-    spawner.log.info(
-        # "Setting the following TAS data: uid:{} gid:{} homedir:{}".format(
-        #     spawner.tas_uid, spawner.tas_gid, spawner.tas_homedir
-        # )
-        "Setting the following TAS data: uid:{} gid:{}".format(
-            spawner.tas_uid, spawner.tas_gid
-        )
-    )
+
+def sync_credentials_configmap(username, log):
+    """Make sure the user's credentials configmap matches their token files.
+
+    Users whose last login predates the single credentials configmap only
+    have the old per-file configmaps; this writes the new one from the token
+    files. It is a no-op when the configmap content is already current.
+    """
+    data = {}
+    for name in (".agpy", "current"):
+        try:
+            with open(os.path.join(get_user_token_dir(username), name)) as f:
+                data[name] = f.read()
+        except OSError as e:
+            log.warning("could not read token file {} for {}: {}".format(name, username, e))
+            return
+    try:
+        write_credentials_configmap(username, data, log)
+    except Exception as e:
+        log.error("Could not write credentials configmap for {}: {}".format(username, e))
 
 
 def get_user_token_dir(username):
-    return os.path.join("/agave/jupyter/tokens", INSTANCE, TENANT, username)
+    return os.path.join(token_dir, INSTANCE, TENANT, username)
+
+
+def get_credentials_mode(spawner):
+    return spawner.config_model.credentials_mode or CREDENTIALS_MODE
+
+
+def spawn_profile_settings(spawner):
+    """The hub-side settings a spawn profile depends on, to key it on"""
+    return {
+        "credentials_mode": get_credentials_mode(spawner),
+        "credentials_entrypoint": CREDENTIALS_ENTRYPOINT,
+        # the configured command, without the entrypoint a reused profile put in front
+        "cmd": _without_credentials_entrypoint(spawner.cmd),
+        "guarantees": [MEM_GUARANTEE, CPU_GUARANTEE],
+    }
 
 
 def get_mounts(spawner):
-    safe_username = safe_string(spawner.user.name).lower()
-    safe_tenant = safe_string(TENANT).lower()
-    safe_instance = safe_string(INSTANCE).lower()
-    agpy_safe_name = "{}-{}-{}-jhub-agpy".format(
-        safe_username, safe_tenant, safe_instance
-    )
-    current_safe_name = "{}-{}-{}-jhub-current".format(
-        safe_username, safe_tenant, safe_instance
-    )
+    credentials_mode = get_credentials_mode(spawner)
+    spawner.extra_labels = {
+        **spawner.extra_labels,
+        # lets hub services such as the GC tell this hub's pods from other hubs'
+        **hub_labels(),
+        CREDENTIALS_MODE_LABEL: credentials_mode,
+    }
+    if credentials_mode == "entrypoint":
+        get_credentials_mounts(spawner)
+    else:
+        get_init_container_credentials_mounts(spawner)
+    get_volume_mounts(spawner)
+
+
+def get_init_container_credentials_mounts(spawner):
+    # one configmap holds both the .agpy and current files, see TapisOAuthenticator.save_token
+    configmap_name = get_credentials_configmap_name(spawner.user.name)
+    configmap_volume = "{}-configmap".format(configmap_name)
+    spawner.cmd = _without_credentials_entrypoint(spawner.cmd)
 
     spawner.init_containers = [
         {
@@ -369,154 +618,243 @@ def get_mounts(spawner):
             "command": [
                 "/bin/sh",
                 "-c",
-                "cp -r /agave_data/.agpy /agave_data_rw/.agpy && cp -r /agave_data/current /agave_data_rw/current && ls -lah /agave_data_rw && cat /agave_data_rw/current/current && chmod -R 777 /agave_data_rw && ls -lah /agave_data_rw",
+                "mkdir -p /agave_data_rw/.agpy /agave_data_rw/current && cp -L /agave_data/.agpy /agave_data_rw/.agpy/.agpy && cp -L /agave_data/current /agave_data_rw/current/current && chmod -R 777 /agave_data_rw && ls -lah /agave_data_rw",
             ],
             "volumeMounts": [
                 {
-                    "mountPath": "/agave_data/.agpy",
-                    "name": "{}-configmap".format(agpy_safe_name),
-                    "subPath": ".agpy",
-                },
-                {
-                    "mountPath": "/agave_data/current",
-                    "name": "{}-configmap".format(current_safe_name),
-                    "subPath": "current",
+                    "mountPath": "/agave_data",
+                    "name": configmap_volume,
                 },
                 {
-                    "mountPath": "/agave_data_rw/.agpy",
-                    "name": agpy_safe_name,
-                    "subPath": ".agpy",
+                    "mountPath": "/agave_data_rw",
+                    "name": configmap_name,
                 },
-                {
-                    "mountPath": "/agave_data_rw/current",
-                    "name": current_safe_name,
-                    "subPath": "current",
-                }
             ],
         }
     ]
 
     spawner.volumes = [
         {
-            "name": "{}-configmap".format(agpy_safe_name),
-            "configMap": {"name": agpy_safe_name, "defaultMode": 0o0777},
-        },
-        {
-            "name": "{}-configmap".format(current_safe_name),
-            "configMap": {"name": current_safe_name, "defaultMode": 0o0777},
+            "name": configmap_volume,
+            "configMap": {"name": configmap_name, "defaultMode": 0o0777},
         },
         {
-            "name": agpy_safe_name,
+            "name": configmap_name,
             "emptyDir": {},
         },
-        {
-            "name": current_safe_name,
-            "emptyDir": {},
-        }
     ]
     spawner.volume_mounts = [
         {
             "mountPath": "/etc/.agpy",
-            "name": agpy_safe_name,
+            "name": configmap_name,
             "subPath": ".agpy/.agpy",
         },
         {
             "mountPath": "/home/jupyter/.agave",
-            "name": current_safe_name,
+            "name": configmap_name,
             "subPath": "current",
         }
     ]
-    volume_mounts = spawner.configs.get("volume_mounts")
 
-    for item in spawner.user_configs:
-        if item["value"].get("volume_mounts"):
-            volume_mounts += [
-                x for x in item["value"]["volume_mounts"] if x not in volume_mounts
-            ]
+
+def get_credentials_mounts(spawner):
+    """Mount the credentials without an init container.
+
+    A short shell step copies current and .agpy from the configmap into the
+    writable ~/.agave emptyDir, then execs the usual notebook command. A
+    file in an emptyDir only exists once that step has run, after the
+    kubelet has made the container's mounts, so /etc/.agpy cannot be
+    mounted from it; it stays a read-only copy from the configmap, and the
+    writable .agpy is ~/.agave/.agpy.
+    """
+    configmap_name = get_credentials_configmap_name(spawner.user.name)
+    configmap_volume = "{}-configmap".format(configmap_name)
+    spawner.init_containers = []
+    spawner.cmd = CREDENTIALS_ENTRYPOINT + _without_credentials_entrypoint(spawner.cmd)
+
+    spawner.volumes = [
+        {
+            "name": configmap_volume,
+            "configMap": {"name": configmap_name, "defaultMode": 0o0444},
+        },
+        {
+            "name": configmap_name,
+            "emptyDir": {},
+        },
+    ]
+    spawner.volume_mounts = [
+        {
+            "mountPath": "/etc/.agpy",
+            "name": configmap_volume,
+            "subPath": ".agpy",
+            "readOnly": True,
+        },
+        {
+            "mountPath": CREDENTIALS_DIR,
+            "name": configmap_volume,
+            "readOnly": True,
+        },
+        {
+            "mountPath": "/home/jupyter/.agave",
+            "name": configmap_name,
+        },
+    ]
+
+
+def _without_credentials_entrypoint(cmd):
+    # the hook runs again on every spawn of the same spawner object
+    cmd = list(cmd or [])
+    if cmd[: len(CREDENTIALS_ENTRYPOINT)] == CREDENTIALS_ENTRYPOINT:
+        return cmd[len(CREDENTIALS_ENTRYPOINT) :]
+    return cmd
+
+
+def get_volume_mounts(spawner):
+    plan = get_mount_plan(
+        spawner.config_model,
+        spawner.configs_version,
+        spawner.user_config_models,
+        spawner.user_configs_version,
+    )
 
     template_vars = {
         "username": spawner.user.name,
         "tenant_id": TENANT,  # TODO do we need this?
     }
 
-    if hasattr(spawner, "tas_homedir"):
+    if spawner.tas_homedir:
         template_vars["tas_homedir"] = spawner.tas_homedir
 
-    if len(volume_mounts):
-        for item in volume_mounts:
-            path = item["path"].format(**template_vars)
-
-            # volume names must consist of lower case alphanumeric characters or '-',
-            # and must start and end with an alphanumeric character (e.g. 'my-name',  or '123-abc',
-            # regex used for validation is '[a-z0-9]([-a-z0-9]*[a-z0-9])?')
-            if item["mountPath"][-1] == '/':
-                item["mountPath"] = item["mountPath"][:-1]
-            vol_name = re.sub(
-                r"([^a-z0-9-\s]+?)", "", item["mountPath"].split("/")[-1].lower()
-            )
-
-            vol = {"path": path, "readOnly": eval(item["readOnly"])}
-            if item["type"] == "nfs":
-                vol["server"] = item["server"]
-
-            if item["path"] == "/work2/{tas_homedir}":
-                spawner.log.info(spawner.init_gid)
-                if spawner.init_gid == 0:
-                    continue
-            
-            spawner.volumes.append({"name": vol_name, item["type"]: vol})
-
-            spawner.volume_mounts.append(
-                {"mountPath": item["mountPath"], "name": vol_name}
-            )
+    if len(plan):
+        volumes, volume_mounts = plan.render(template_vars, init_gid=spawner.init_gid)
+        spawner.volumes.extend(volumes)
+        spawner.volume_mounts.extend(volume_mounts)
         spawner.log.info("volumes: {}".format(spawner.volumes))
         spawner.log.info("volume_mounts: {}".format(spawner.volume_mounts))
 
 
-def get_projects(spawner):
+async def get_projects(spawner):
+    """Return the project mounts available to this user, or None"""
     if not spawner.access_token:
         spawner.log.info("no access_token")
         return None
-    #url = "{}/projects/v2/".format(spawner.url)
-    projects_url = f"{base_url}/projects/v2"
-    
-    # use spawner.access_token to generate v2 token
-    # call v3 to v2 token endpoint
+    # a load or background refresh for this user uses the token from this spawn
+    projects_tokens.put(spawner.user.name, spawner.access_token)
+    try:
+        with time_phase(SPAWN_PHASE_DURATION, phase="projects"):
+            async with admission.slot("projects", spawner):
+                return await asyncio.wait_for(
+                    projects_cache.get_async(spawner.user.name), PROJECTS_TIMEOUT
+                )
+    except asyncio.TimeoutError:
+        spawner.log.error(
+            "projects lookup for {} timed out after {}s".format(
+                spawner.user.name, PROJECTS_TIMEOUT
+            )
+        )
+    except Exception as e:
+        spawner.log.warning(f"Did not get projects for {spawner.user.name}: {e}")
+    return None
+
+
+def _load_projects(username):
+    token = projects_tokens.peek(username)
+    # the token is only needed for this load
+    projects_tokens.invalidate(username)
+    if not token:
+        raise ValueError("no access token to list project mounts with")
+    projects = fetch_projects(token, app_log)
+    if projects is None:
+        raise ValueError("no project mounts returned")
+    return projects, None
+
+
+def get_v2_token(tapis_access_token, log):
+    """Return a v2 token for the v3 token, reusing it until it expires"""
+    key = hashlib.sha256(tapis_access_token.encode("utf8")).hexdigest()
+    with time_phase(SPAWN_PHASE_DURATION, phase="v2_token"):
+        token = v2_token_cache.get_or_load(
+            key, lambda k: exchange_v2_token(tapis_access_token, log)
+        )
+    return token["access_token"] if token else None
+
+
+def exchange_v2_token(tapis_access_token, log):
+    """Call the v3 to v2 token endpoint, returning the token and its expiry"""
     # tacc.develop.tapis.io/v3/oauth2/v2/token
-    spawner.log.error("getting projects")
+    rsp = None
     try:
         token_url = v2_token_url
         headers = {
-            'x-tapis-token': spawner.access_token
+            'x-tapis-token': tapis_access_token
         }
-        rsp = requests.post(token_url, headers=headers)
+        rsp = requests.post(token_url, headers=headers, timeout=PROJECTS_TIMEOUT)
         rsp.raise_for_status()
-        access_token = rsp.json()['access_token']
+        data = rsp.json()
+        return {
+            "access_token": data['access_token'],
+            "expires_at": time.time() + int(data.get('expires_in', V2_TOKEN_TTL)),
+        }
     except Exception as e:
-        spawner.log.error(f"Unable to generate v2 token; error: {e}; response: {rsp}")
+        log.error(f"Unable to generate v2 token; error: {e}; response: {rsp}")
+        return None
+
+
+def _v2_token_ttl(token):
+    # stop handing out a token a minute before it expires
+    return max(token["expires_at"] - time.time() - 60, 0)
+
+
+def fetch_projects(tapis_access_token, log):
+    """Exchange the v3 token for a v2 token and list the user's project mounts"""
+    #url = "{}/projects/v2/".format(spawner.url)
+    projects_url = f"{base_url}/projects/v2"
+    
+    # use spawner.access_token to generate v2 token
+    log.info("getting projects")
+    access_token = get_v2_token(tapis_access_token, log)
+    if not access_token:
         return None
 
     # with v2 token, send request to projects url
+    rsp = None
     try:
         ag = Agave(api_server=base_url, token=access_token)
         rsp = ag.geturl(projects_url)
         rsp.raise_for_status()
         data = rsp.json()
     except Exception as e:
-        spawner.log.warn(f"Did not get data from /projects. Exception: {e}")
-        spawner.log.warn(f"Full response from service: {rsp}")
-        spawner.log.warn(f"url used: {projects_url}")
+        log.warn(f"Did not get data from /projects. Exception: {e}")
+        log.warn(f"Full response from service: {rsp}")
+        log.warn(f"url used: {projects_url}")
         return None
 
     projects = data.get("mounts")
-    spawner.network_storage = spawner.configs.get('network_storage')
 
     try:
-        spawner.log.info("Found {} projects".format(len(projects)))
+        log.info("Found {} projects".format(len(projects)))
     except TypeError:
-        spawner.log.error("Projects data has no length.")
-        spawner.log.info(f"response: {rsp}, data: {data}")
+        log.error("Projects data has no length.")
+        log.info(f"response: {rsp}, data: {data}")
         return None
+    return projects
+
+
+v2_token_cache = TTLCache("v2_tokens", V2_TOKEN_TTL, ttl_for=_v2_token_ttl, maxsize=1000)
+projects_tokens = TTLCache("projects_tokens", PROJECTS_TOKEN_TTL, maxsize=1000)
+projects_cache = StaleWhileRevalidateCache(
+    "projects",
+    _load_projects,
+    ttl=PROJECTS_CACHE_TTL,
+    executor=blocking_executor,
+    max_age=PROJECTS_CACHE_MAX_AGE,
+)
+
+
+def add_project_mounts(spawner, projects):
+    if not projects:
+        return
+    spawner.network_storage = spawner.config_model.network_storage
 
     for p in projects:
         mountPath = p.get('mountPath')
@@ -2,27 +2,43 @@
 Custom Authenticator to use Tapis OAuth with JupyterHub
 """
 
+import asyncio
 import json
 import os
-import re
 import time
 import urllib
 import base64
 import jwt
 
 from jupyterhub.auth import LocalAuthenticator
-from kubernetes import client
-from tornado import gen, web
+from tornado import web
 from tornado.auth import OAuth2Mixin
 from tornado.httpclient import HTTPRequest, AsyncHTTPClient
 from tornado.httputil import url_concat
 from traitlets import Set
 
-from jupyterhub.common import TENANT, INSTANCE, get_tenant_configs, safe_string
+from jupyterhub.common import (
+    TENANT,
+    INSTANCE,
+    get_tenant_configs,
+    run_blocking,
+    token_dir,
+)
+from jupyterhub.jhub_metrics import (
+    LOGIN_CALLBACK_DURATION,
+    LOGIN_PHASE_DURATION,
+    TENANT_LABELS,
+    time_phase,
+)
+from jupyterhub.kube_client import write_credentials_configmap
 from .oauth2 import OAuthLoginHandler, OAuthenticator
 
 CONFIGS = get_tenant_configs()
 
+# logins allowed to write token files and configmaps at the same time
+LOGIN_IO_CONCURRENCY = int(os.environ.get("LOGIN_IO_CONCURRENCY", 16))
+login_io_slots = asyncio.Semaphore(LOGIN_IO_CONCURRENCY)
+
 
 class TapisMixin(OAuth2Mixin):
     _OAUTH_AUTHORIZE_URL = "{}/oauth2/authorize".format(
@@ -46,8 +62,19 @@ class TapisOAuthenticator(OAuthenticator):
         help="Automatically allow members of selected teams",
     )
 
-    @gen.coroutine
-    def authenticate(self, handler, data):
+    async def authenticate(self, handler, data):
+        start = time.perf_counter()
+        status = "failure"
+        try:
+            username = await self._authenticate(handler)
+            status = "success"
+            return username
+        finally:
+            LOGIN_CALLBACK_DURATION.labels(**TENANT_LABELS, status=status).observe(
+                time.perf_counter() - start
+            )
+
+    async def _authenticate(self, handler):
         code = handler.get_argument("code", False)
 
         if not code:
@@ -87,7 +114,8 @@ class TapisOAuthenticator(OAuthenticator):
             body=json.dumps(params),
             headers=headers,
         )
-        resp = yield http_client.fetch(req)
+        with time_phase(LOGIN_PHASE_DURATION, phase="token_post"):
+            resp = await http_client.fetch(req)
 
         resp_json = json.loads(resp.body)
         access_token = resp_json["result"]["access_token"]["access_token"]
@@ -98,8 +126,7 @@ class TapisOAuthenticator(OAuthenticator):
         username = data["tapis/username"].lower()
         created_at = time.time()
 
-        self.ensure_token_dir(username)
-        self.save_token(
+        await self.save_token(
             access_token, refresh_token, username, created_at, expires_in, expires_at
         )
         return username
@@ -114,15 +141,15 @@ class TapisOAuthenticator(OAuthenticator):
             )
 
     def get_user_token_dir(self, username):
-        return os.path.join("/agave/jupyter/tokens", INSTANCE, TENANT, username)
+        return os.path.join(token_dir, INSTANCE, TENANT, username)
 
     # Is this data used for accessing metadata, if so, this has to be tapis v2(agave) info
-    def save_token(
+    async def save_token(
         self, access_token, refresh_token, username, created_at, expires_in, expires_at
     ):
         tenant_id = CONFIGS.get("agave_tenant_id")
         # agavepy file
-        d = [
+        agpy = [
             {
                 "token": access_token,
                 "refresh_token": refresh_token,
@@ -133,18 +160,10 @@ class TapisOAuthenticator(OAuthenticator):
                 "verify": eval(CONFIGS.get("oauth_validate_cert")),
             }
         ]
-        with open(os.path.join(self.get_user_token_dir(username), ".agpy"), "w") as f:
-            json.dump(d, f)
-        self.log.info(
-            "Saved agavepy cache file to {}".format(
-                os.path.join(self.get_user_token_dir(username), ".agpy")
-            )
-        )
-        self.log.info(f"agavepy cache file data: {d}")
-        self.create_configmap(username, ".agpy", json.dumps(d))
+        self.log.info(f"agavepy cache file data: {agpy}")
 
         # cli file
-        d = {
+        current = {
             "tenantid": tenant_id,
             "baseurl": "{}".format(CONFIGS.get("agave_base_url").rstrip("/")),
             "devurl": "",
@@ -157,75 +176,43 @@ class TapisOAuthenticator(OAuthenticator):
             "expires_in": str(expires_in),
             "expires_at": str(expires_at),
         }
-        with open(os.path.join(self.get_user_token_dir(username), "current"), "w") as f:
-            json.dump(d, f)
-        self.log.info(
-            "Saved CLI cache file to {}".format(
-                os.path.join(self.get_user_token_dir(username), "current")
+        self.log.info("CLI cache file data: {}".format(current))
+
+        # the shared filesystem and the API server can both be slow under a
+        # login burst, so write to them concurrently and off the event loop
+        configmap_data = {".agpy": json.dumps(agpy), "current": json.dumps(current)}
+        async with login_io_slots:
+            await asyncio.gather(
+                self.write_token_files(username, configmap_data),
+                run_blocking(self.create_configmap, username, configmap_data),
             )
-        )
-        self.log.info("CLI cache file data: {}".format(d))
-        self.create_configmap(username, "current", json.dumps(d))
-
-    def create_configmap(self, username, name, d):
-        with open("/run/secrets/kubernetes.io/serviceaccount/token") as f:
-            token = f.read()
-        with open("/run/secrets/kubernetes.io/serviceaccount/namespace") as f:
-            namespace = f.read()
-
-        configuration = client.Configuration()
-        configuration.api_key["authorization"] = "Bearer {}".format(token)
-        configuration.host = "https://kubernetes.default"
-        configuration.ssl_ca_cert = "/run/secrets/kubernetes.io/serviceaccount/ca.crt"
-
-        api_instance = client.CoreV1Api(client.ApiClient(configuration))
-
-        safe_username = safe_string(username).lower()
-        safe_tenant = safe_string(TENANT).lower()
-        safe_instance = safe_string(INSTANCE).lower()
-        configmap_name_prefix = "{}-{}-{}-jhub".format(
-            safe_username, safe_tenant, safe_instance
-        )
-        # remove the . from .agpy to accomodate k8 naming rules
-        configmap_name = "{}-{}".format(
-            configmap_name_prefix, re.sub("[^A-Za-z0-9]+", "", name)
-        )
-
-        body = client.V1ConfigMap(
-            data={name: str(d)},
-            metadata={
-                "name": configmap_name,
-                "labels": {
-                    "app": configmap_name_prefix,
-                    "tenant": TENANT,
-                    "instance": INSTANCE,
-                    "username": username,
-                },
-            },
-        )
-
-        self.log.info("{}:{}".format("configmap body", body))
 
-        try:  # delete any current configmaps to ensure no stale tokens
-            api_response = api_instance.delete_namespaced_config_map(
-                configmap_name, namespace
-            )
-            self.log.info("{} configmap deleted".format(configmap_name))
-            print(str(api_response))
-        except Exception as e:
-            print(
-                "Exception when calling CoreV1Api->delete_namespaced_config_map: %s\n"
-                % e
+    async def write_token_files(self, username, files):
+        with time_phase(LOGIN_PHASE_DURATION, phase="token_files"):
+            await run_blocking(self.ensure_token_dir, username)
+            await asyncio.gather(
+                *(
+                    run_blocking(self.write_token_file, username, name, content)
+                    for name, content in files.items()
+                )
             )
 
-        try:
-            api_response = api_instance.create_namespaced_config_map(namespace, body)
-            self.log.info("{} configmap created".format(name))
-            print(str(api_response))
+    def write_token_file(self, username, name, content):
+        path = os.path.join(self.get_user_token_dir(username), name)
+        with open(path, "w") as f:
+            f.write(content)
+        self.log.info("Saved {} cache file to {}".format(name, path))
+
+    def create_configmap(self, username, data):
+        """Write the user's .agpy and current files to one configmap"""
+        try:  # replacing in place ensures no stale tokens
+            with time_phase(LOGIN_PHASE_DURATION, phase="configmap_write"):
+                write_credentials_configmap(username, data, self.log)
         except Exception as e:
-            print(
-                "Exception when calling CoreV1Api->create_namespaced_config_map: %s\n"
-                % e
+            self.log.error(
+                "Exception when writing credentials configmap for {}: {}".format(
+                    username, e
+                )
             )
 
 
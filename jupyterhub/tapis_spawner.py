@@ -0,0 +1,82 @@
+"""
+KubeSpawner that runs the spawn hook through admission control and keeps
+the user's spawn profile in its state.
+"""
+
+import asyncio
+
+from kubespawner import KubeSpawner
+
+from jupyterhub.admission import SPAWN_QUEUE
+from jupyterhub.spawner_hooks import admission
+from jupyterhub.utils import maybe_future
+
+# how often the progress stream checks the spawn's place in the queue
+QUEUE_PROGRESS_INTERVAL = 1
+# what the upstream queues are called in progress messages
+QUEUE_NAMES = {
+    "configs": "tenant configs",
+    "tas": "TAS",
+    "ldap": "LDAP",
+    "credentials_configmap": "Kubernetes",
+    "projects": "projects",
+}
+
+
+class TapisKubeSpawner(KubeSpawner):
+    """KubeSpawner whose pre-spawn hook waits its turn in the spawn queue.
+
+    The hook runs before ``start``, so time spent queued does not count
+    against ``start_timeout``. While the spawn is queued, for the hook as a
+    whole or for one upstream inside it, the progress stream reports its
+    place in that queue.
+
+    The spawn profile the hook resolved (spawn_profile.py) is saved with the
+    rest of the spawner state. Stopping the server does not clear it, so the
+    next spawn can reuse it, also after a hub restart.
+    """
+
+    spawn_profile = None
+    _hook_running = False
+
+    def get_state(self):
+        state = super().get_state()
+        if self.spawn_profile:
+            state["spawn_profile"] = self.spawn_profile
+        return state
+
+    def load_state(self, state):
+        super().load_state(state)
+        if state.get("spawn_profile"):
+            self.spawn_profile = state["spawn_profile"]
+
+    async def run_pre_spawn_hook(self):
+        self._hook_running = True
+        try:
+            async with admission.slot(SPAWN_QUEUE, self):
+                await maybe_future(super().run_pre_spawn_hook())
+        finally:
+            self._hook_running = False
+
+    async def progress(self):
+        # the stream usually opens after a fast hook is done, and then goes
+        # straight to the pod events
+        last = None
+        while self._hook_running or admission.waiting(self)[0] is not None:
+            queue, position = admission.waiting(self)
+            if queue is not None and (queue, position) != last:
+                yield {"progress": 0, "message": _queue_message(queue, position)}
+            last = (queue, position)
+            await asyncio.sleep(QUEUE_PROGRESS_INTERVAL)
+        async for event in super().progress():
+            yield event
+
+
+def _queue_message(queue, position):
+    if queue == SPAWN_QUEUE:
+        return "Server requested, waiting to start: {} ahead of you in the queue".format(
+            position - 1
+        )
+    return "Waiting for {} lookups: {} ahead of you in the queue".format(
+        QUEUE_NAMES.get(queue, queue), position - 1
+    )
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the services (prepuller.py, cull_idle.py, ...) are scripts next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
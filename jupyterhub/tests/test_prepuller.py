@@ -0,0 +1,204 @@
+import asyncio
+import copy
+from types import SimpleNamespace
+
+import pytest
+
+from jupyterhub.catalog import ImageCatalog
+from jupyterhub.config_model import CompiledConfig
+from prepuller import (
+    IMAGES_HASH_ANNOTATION,
+    Placement,
+    Prepuller,
+    normalize_image,
+    pull_plan,
+)
+
+GPU_POD_CONFIG = {
+    "nodeSelector": {"gpu": "true"},
+    "tolerations": [{"key": "gpu", "operator": "Exists", "effect": "NoSchedule"}],
+}
+
+
+def matches(selector, labels):
+    for term in filter(None, selector.split(",")):
+        key, _, value = term.partition("=")
+        if key not in labels or (value and labels[key] != value):
+            return False
+    return True
+
+
+class FakeAppsApi:
+    def __init__(self):
+        self.daemon_sets = {}
+        self.calls = []
+
+    def list_namespaced_daemon_set(self, namespace, label_selector=""):
+        return SimpleNamespace(
+            items=[
+                ds
+                for ds in self.daemon_sets.values()
+                if matches(label_selector, ds.metadata.labels)
+            ]
+        )
+
+    def create_namespaced_daemon_set(self, namespace, body):
+        self.calls.append(("create", body.metadata.name))
+        self.daemon_sets[body.metadata.name] = copy.deepcopy(body)
+
+    def replace_namespaced_daemon_set(self, name, namespace, body):
+        self.calls.append(("replace", name))
+        self.daemon_sets[name] = copy.deepcopy(body)
+
+    def delete_namespaced_daemon_set(self, name, namespace):
+        self.calls.append(("delete", name))
+        del self.daemon_sets[name]
+
+
+class FakeCoreApi:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def list_node(self):
+        return SimpleNamespace(items=self.nodes)
+
+
+def node(name, labels, images):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=name, labels=labels),
+        status=SimpleNamespace(images=[SimpleNamespace(names=[i]) for i in images]),
+    )
+
+
+def catalog(images):
+    return ImageCatalog(CompiledConfig({"images": images}), ())
+
+
+def image(name, pod_config=None):
+    item = {"name": name, "display_name": name}
+    if pod_config:
+        item["extra_pod_config"] = pod_config
+    return item
+
+
+@pytest.fixture(autouse=True)
+def hub_env(monkeypatch):
+    monkeypatch.setenv("TENANT", "tenant1")
+    monkeypatch.setenv("INSTANCE", "prod")
+
+
+def make_prepuller(apps, nodes, images):
+    current = {"catalog": catalog(images)}
+
+    async def loader():
+        return current["catalog"]
+
+    prepuller = Prepuller(
+        FakeCoreApi(nodes), apps, "jupyter", loader, node_selector={"jupyter": "true"}
+    )
+    return prepuller, current
+
+
+def test_pull_plan_groups_images_by_placement():
+    plan = pull_plan(
+        catalog(
+            [
+                image("taccsciapps/a:1"),
+                image("taccsciapps/b:1"),
+                image("taccsciapps/gpu:1", GPU_POD_CONFIG),
+            ]
+        ),
+        node_selector={"jupyter": "true"},
+    )
+    by_images = {tuple(images): placement for placement, images in plan.values()}
+    assert set(by_images) == {("taccsciapps/a:1", "taccsciapps/b:1"), ("taccsciapps/gpu:1",)}
+    gpu = by_images[("taccsciapps/gpu:1",)]
+    assert gpu.node_selector == {"gpu": "true", "jupyter": "true"}
+    assert gpu.tolerations == GPU_POD_CONFIG["tolerations"]
+
+
+def test_placement_name_includes_hub():
+    ours = Placement({"jupyter": "true"})
+    other = Placement({"jupyter": "true"}, hub={"tenant": "tenant2", "instance": "prod"})
+    assert ours.name.startswith("jhub-prepuller-prod-tenant1-")
+    assert ours.name != other.name
+    assert ours.key == other.key
+
+
+def test_sync_creates_replaces_and_deletes():
+    apps = FakeAppsApi()
+    prepuller, current = make_prepuller(
+        apps, [], [image("taccsciapps/a:1"), image("taccsciapps/gpu:1", GPU_POD_CONFIG)]
+    )
+    asyncio.run(prepuller.sync())
+    assert sorted(call for call, _ in apps.calls) == ["create", "create"]
+    for ds in apps.daemon_sets.values():
+        assert ds.metadata.labels["tenant"] == "tenant1"
+        assert ds.metadata.labels["instance"] == "prod"
+        assert ds.spec.template.spec.node_selector["jupyter"] == "true"
+
+    apps.calls.clear()
+    asyncio.run(prepuller.sync())
+    assert apps.calls == []
+
+    current["catalog"] = catalog([image("taccsciapps/a:2")])
+    asyncio.run(prepuller.sync())
+    assert sorted(call for call, _ in apps.calls) == ["delete", "replace"]
+    (ds,) = apps.daemon_sets.values()
+    assert [c.image for c in ds.spec.template.spec.init_containers] == ["taccsciapps/a:2"]
+
+
+def test_sync_leaves_other_hubs_alone(monkeypatch):
+    apps = FakeAppsApi()
+    monkeypatch.setenv("TENANT", "tenant2")
+    other, _ = make_prepuller(apps, [], [image("taccsciapps/other:1")])
+    asyncio.run(other.sync())
+    monkeypatch.setenv("TENANT", "tenant1")
+
+    ours, _ = make_prepuller(apps, [], [image("taccsciapps/a:1")])
+    asyncio.run(ours.sync())
+    assert len(apps.daemon_sets) == 2
+    assert not [call for call in apps.calls if call[0] == "delete"]
+
+
+def test_apply_skips_unchanged_images():
+    apps = FakeAppsApi()
+    prepuller, _ = make_prepuller(apps, [], [])
+    placement = Placement({"jupyter": "true"})
+    assert asyncio.run(prepuller.apply(placement, ["taccsciapps/a:1"], None))
+    existing = apps.daemon_sets[placement.name]
+    assert IMAGES_HASH_ANNOTATION in existing.spec.template.metadata.annotations
+    assert not asyncio.run(prepuller.apply(placement, ["taccsciapps/a:1"], existing))
+    assert asyncio.run(prepuller.apply(placement, ["taccsciapps/a:2"], existing))
+    assert [call for call, _ in apps.calls] == ["create", "replace"]
+
+
+def test_report_cached_fraction():
+    nodes = [
+        node("n1", {"jupyter": "true"}, ["docker.io/taccsciapps/a:1"]),
+        node("n2", {"jupyter": "true"}, []),
+        node("n3", {"jupyter": "true", "gpu": "true"}, ["docker.io/taccsciapps/gpu:1"]),
+        node("n4", {}, ["docker.io/taccsciapps/a:1"]),
+    ]
+    prepuller, current = make_prepuller(
+        FakeAppsApi(),
+        nodes,
+        [image("taccsciapps/a:1"), image("taccsciapps/gpu:1", GPU_POD_CONFIG)],
+    )
+    fractions = asyncio.run(prepuller.report(pull_plan(current["catalog"], {"jupyter": "true"})))
+    # n4 is not eligible, n3 matches the plain placement too
+    assert fractions == {"taccsciapps/a:1": pytest.approx(1 / 3), "taccsciapps/gpu:1": 1.0}
+
+
+@pytest.mark.parametrize(
+    "name, normalized",
+    [
+        ("busybox", "docker.io/library/busybox:latest"),
+        ("taccsciapps/a:1", "docker.io/taccsciapps/a:1"),
+        ("ghcr.io/org/img", "ghcr.io/org/img:latest"),
+        ("localhost:5000/img:2", "localhost:5000/img:2"),
+        ("img@sha256:abc", "docker.io/library/img@sha256:abc"),
+    ],
+)
+def test_normalize_image(name, normalized):
+    assert normalize_image(name) == normalized
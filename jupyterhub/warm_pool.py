@@ -0,0 +1,356 @@
+"""
+Warm capacity for popular spawn profiles, sized from spawn-rate history.
+
+A notebook pod cannot be started ahead of time and handed to a user: its
+uid, gid, supplemental groups and volumes are fixed when the pod is created.
+What can be done ahead of time is everything around it. For each popular
+profile (image, limits, nodeSelector and tolerations) the pool keeps
+placeholder pods at a low priority class. They request the profile's limits
+and run its image on an eligible node, so the cluster autoscaler has already
+added the node and the image is already pulled. A spawn claims a placeholder
+by deleting it and steering the notebook pod onto that node with a preferred
+node affinity. The user's pod then only schedules, mounts and starts.
+Placeholders are also preempted by any higher priority pod, so they never
+block real work.
+
+Spawns are counted per profile in buckets of WARM_POOL_BUCKET seconds, kept
+in a small SQLite file. Each reconcile sizes a profile's pool for the coming
+bucket as the larger of the spawns in the last bucket and the average for
+the same time of week over the last WARM_POOL_HISTORY_WEEKS weeks, so the
+pool fills up ahead of recurring class times.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+import uuid
+
+from kubernetes import client
+from tornado.log import app_log
+
+from jupyterhub.blocking import run_blocking
+from jupyterhub.jhub_metrics import WARM_POOL_CLAIMS, WARM_POOL_TARGET
+
+WEEK = 7 * 24 * 60 * 60
+PLACEHOLDER_COMPONENT = "warm-placeholder"
+PROFILE_LABEL = "jhub.tacc.utexas.edu/warm-profile"
+HOSTNAME_LABEL = "kubernetes.io/hostname"
+# placeholders in these phases (evicted, for one) hold no capacity
+TERMINAL_PHASES = ("Failed", "Succeeded")
+
+
+def profile_key(spec):
+    """Short, label-safe key for a profile spec"""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf8")).hexdigest()[:16]
+
+
+def claim_affinity(node_name):
+    """The preferred node affinity term steering a notebook pod onto node_name"""
+    return {
+        "weight": 100,
+        "preference": {
+            "matchExpressions": [
+                {"key": HOSTNAME_LABEL, "operator": "In", "values": [node_name]}
+            ]
+        },
+    }
+
+
+def clear_claim_affinity(spawner):
+    """Drop the affinity a previous claim left on a reused spawner, keeping configured terms"""
+    spawner.node_affinity_preferred = [
+        term
+        for term in spawner.node_affinity_preferred or []
+        if not _is_claim_affinity(term)
+    ]
+
+
+def _is_claim_affinity(term):
+    expressions = (term.get("preference") or {}).get("matchExpressions") or []
+    return (
+        term.get("weight") == 100
+        and len(expressions) == 1
+        and expressions[0].get("key") == HOSTNAME_LABEL
+        and expressions[0].get("operator") == "In"
+    )
+
+
+def spawner_profile(spawner):
+    """The profile spec of a spawner the hook has configured"""
+    pod_config = spawner.extra_pod_config or {}
+    return {
+        "image": spawner.image,
+        "cpu_limit": spawner.cpu_limit,
+        "mem_limit": spawner.mem_limit,
+        "node_selector": pod_config.get("nodeSelector") or {},
+        "tolerations": pod_config.get("tolerations") or [],
+    }
+
+
+class SpawnHistory:
+    """Spawn counts per profile and time bucket, persisted to SQLite"""
+
+    def __init__(self, path, bucket=900, weeks=4):
+        self.bucket = bucket
+        self.weeks = weeks
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS spawns "
+                "(profile TEXT, bucket INTEGER, count INTEGER, PRIMARY KEY (profile, bucket))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS profiles "
+                "(profile TEXT PRIMARY KEY, spec TEXT, last_spawn REAL)"
+            )
+
+    def record(self, spec, now=None):
+        """Count one spawn of the profile and return its key"""
+        now = time.time() if now is None else now
+        key = profile_key(spec)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO spawns (profile, bucket, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (profile, bucket) DO UPDATE SET count = count + 1",
+                (key, int(now // self.bucket)),
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO profiles (profile, spec, last_spawn) VALUES (?, ?, ?)",
+                (key, json.dumps(spec, sort_keys=True), now),
+            )
+        return key
+
+    def predict(self, key, now=None):
+        """Expected spawns of the profile in the coming bucket"""
+        now = time.time() if now is None else now
+        current = int(now // self.bucket)
+        per_week = WEEK // self.bucket
+        with self._lock:
+            recent = self._count(key, current - 1)
+            seasonal = [
+                self._count(key, current + 1 - week * per_week)
+                for week in range(1, self.weeks + 1)
+            ]
+        return max(recent, sum(seasonal) / len(seasonal) if seasonal else 0)
+
+    def popular(self, limit, now=None):
+        """The specs of the most spawned profiles over the history window"""
+        now = time.time() if now is None else now
+        since = int((now - self.weeks * WEEK) // self.bucket)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT profiles.profile, profiles.spec FROM spawns "
+                "JOIN profiles ON profiles.profile = spawns.profile "
+                "WHERE spawns.bucket >= ? GROUP BY profiles.profile "
+                "ORDER BY SUM(spawns.count) DESC LIMIT ?",
+                (since, limit),
+            ).fetchall()
+        return {key: json.loads(spec) for key, spec in rows}
+
+    def prune(self, now=None):
+        """Drop buckets older than the history window"""
+        now = time.time() if now is None else now
+        since = int((now - (self.weeks + 1) * WEEK) // self.bucket)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM spawns WHERE bucket < ?", (since,))
+            self._db.execute(
+                "DELETE FROM profiles WHERE profile NOT IN (SELECT profile FROM spawns)"
+            )
+
+    def _count(self, key, bucket):
+        row = self._db.execute(
+            "SELECT count FROM spawns WHERE profile = ? AND bucket = ?", (key, bucket)
+        ).fetchone()
+        return row[0] if row else 0
+
+
+class WarmPool:
+    """Keep placeholder pods for the popular profiles and hand them out on spawn"""
+
+    def __init__(
+        self,
+        api,
+        namespace,
+        history,
+        priority_class,
+        labels=None,
+        profiles=5,
+        min_size=0,
+        max_size=10,
+        headroom=1.0,
+        reconcile_every=60,
+    ):
+        self.api = api
+        self.namespace = namespace
+        self.history = history
+        self.priority_class = priority_class
+        self.labels = {**(labels or {}), "component": PLACEHOLDER_COMPONENT}
+        self.profiles = profiles
+        self.min_size = min_size
+        self.max_size = max_size
+        self.headroom = headroom
+        self.reconcile_every = reconcile_every
+        self._task = None
+        self._reconciling = asyncio.Lock()
+        self._targets = set()
+
+    def start(self):
+        """Start the reconcile loop on the running event loop, once"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def claim(self, spawner):
+        """Count the spawn and, if a placeholder for its profile is ready, take its node"""
+        self.start()
+        # the spawner is reused for the user's later spawns
+        clear_claim_affinity(spawner)
+        spec = spawner_profile(spawner)
+        key = await run_blocking(self.history.record, spec)
+        pods = await run_blocking(
+            self.api.list_namespaced_pod,
+            self.namespace,
+            label_selector=self._selector(key),
+            field_selector="status.phase=Running",
+        )
+        ready = [pod for pod in pods.items if pod.metadata.deletion_timestamp is None]
+        for pod in sorted(ready, key=lambda p: p.metadata.creation_timestamp):
+            try:
+                await run_blocking(
+                    self.api.delete_namespaced_pod,
+                    pod.metadata.name,
+                    self.namespace,
+                    grace_period_seconds=0,
+                )
+            except client.ApiException as e:
+                if e.status == 404:
+                    # claimed by a concurrent spawn
+                    continue
+                raise
+            spawner.node_affinity_preferred = spawner.node_affinity_preferred + [
+                claim_affinity(pod.spec.node_name)
+            ]
+            spawner.log.info(
+                "claimed warm placeholder {} on {} for {}".format(
+                    pod.metadata.name, pod.spec.node_name, spawner.user.name
+                )
+            )
+            WARM_POOL_CLAIMS.labels(result="hit").inc()
+            asyncio.ensure_future(self.reconcile())
+            return pod.spec.node_name
+        WARM_POOL_CLAIMS.labels(result="miss").inc()
+        return None
+
+    def target(self, key, now=None):
+        predicted = self.history.predict(key, now)
+        return max(self.min_size, min(self.max_size, math.ceil(predicted * self.headroom)))
+
+    async def reconcile(self):
+        """Create or delete placeholders until every popular profile is at its target"""
+        async with self._reconciling:
+            profiles = await run_blocking(self.history.popular, self.profiles)
+            pods = await run_blocking(
+                self.api.list_namespaced_pod,
+                self.namespace,
+                label_selector=self._selector(),
+            )
+            by_profile = {}
+            finished = []
+            for pod in pods.items:
+                if pod.metadata.deletion_timestamp is not None:
+                    continue
+                if pod.status is not None and pod.status.phase in TERMINAL_PHASES:
+                    finished.append(pod)
+                    continue
+                by_profile.setdefault(pod.metadata.labels.get(PROFILE_LABEL), []).append(pod)
+            for pod in finished:
+                app_log.info(
+                    "Deleting warm placeholder %s in phase %s",
+                    pod.metadata.name,
+                    pod.status.phase,
+                )
+                await self._delete(pod)
+            targets = {}
+            for key, spec in profiles.items():
+                targets[key] = await run_blocking(self.target, key)
+                WARM_POOL_TARGET.labels(profile=key).set(targets[key])
+                missing = targets[key] - len(by_profile.get(key, []))
+                for _ in range(missing):
+                    await run_blocking(
+                        self.api.create_namespaced_pod,
+                        self.namespace,
+                        self.placeholder(key, spec),
+                    )
+            for key in self._targets - set(targets):
+                WARM_POOL_TARGET.remove(key)
+            self._targets = set(targets)
+            for key, existing in by_profile.items():
+                extra = len(existing) - targets.get(key, 0)
+                # pending placeholders go first, they hold no warm node yet
+                existing.sort(
+                    key=lambda p: (p.status.phase == "Running", p.metadata.creation_timestamp)
+                )
+                for pod in existing[: max(extra, 0)]:
+                    await self._delete(pod)
+            return targets
+
+    def placeholder(self, key, spec):
+        resources = {
+            name: str(spec[limit])
+            for name, limit in (("cpu", "cpu_limit"), ("memory", "mem_limit"))
+            if spec[limit]
+        }
+        return client.V1Pod(
+            metadata=client.V1ObjectMeta(
+                name="warm-{}-{}".format(key[:10], uuid.uuid4().hex[:6]),
+                labels={**self.labels, PROFILE_LABEL: key},
+            ),
+            spec=client.V1PodSpec(
+                priority_class_name=self.priority_class,
+                node_selector=spec["node_selector"] or None,
+                tolerations=spec["tolerations"] or None,
+                containers=[
+                    client.V1Container(
+                        name="placeholder",
+                        image=spec["image"],
+                        command=["/bin/sh", "-c", "sleep infinity"],
+                        resources=client.V1ResourceRequirements(
+                            requests=resources or None, limits=resources or None
+                        ),
+                    )
+                ],
+                termination_grace_period_seconds=0,
+                automount_service_account_token=False,
+            ),
+        )
+
+    async def _delete(self, pod):
+        try:
+            await run_blocking(
+                self.api.delete_namespaced_pod,
+                pod.metadata.name,
+                self.namespace,
+                grace_period_seconds=0,
+            )
+        except client.ApiException as e:
+            if e.status != 404:
+                raise
+
+    def _selector(self, key=None):
+        selector = ",".join("{}={}".format(k, v) for k, v in sorted(self.labels.items()))
+        if key:
+            selector += ",{}={}".format(PROFILE_LABEL, key)
+        return selector
+
+    async def _run(self):
+        while True:
+            try:
+                await self.reconcile()
+                await run_blocking(self.history.prune)
+            except Exception as e:
+                app_log.error("Warm pool reconcile failed: %s", e)
+            await asyncio.sleep(self.reconcile_every)
\ No newline at end of file